@@ -0,0 +1,195 @@
+''' Online detectors that flag chamber hardware faults from the trial stream '''
+import json
+import math
+import queue
+import subprocess
+import threading
+import time
+from log import get_logger
+
+class Cusum:
+    """
+    Two-sided CUSUM of samples standardized against an EWMA baseline. Signals once
+    the cumulative drift exceeds h standard deviations, ignoring drifts below k per
+    sample. The baseline only learns from samples that are not drifting, so a
+    sustained shift is not absorbed before it is signalled, and is learnt again
+    from scratch afterwards, so one shift gives one signal.
+    The standard deviation is floored at min_std, so a quiet baseline does not
+    turn every outlier into a shift. The defaults give roughly one false signal
+    per 900 in-control samples.
+    """
+
+    def __init__(self, alpha=0.01, k=0.5, h=10.0, warmup=50, min_std=1e-3):
+        self.alpha = alpha
+        self.k = k
+        self.h = h
+        self.warmup = warmup
+        self.min_std = min_std
+        # Baseline the last shift was measured against
+        self.signalled_from = None
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.high = 0.0
+        self.low = 0.0
+
+    def update(self, x):
+        """ Returns "high" or "low" when a shift is detected, None otherwise. """
+        self.n += 1
+        if self.n <= self.warmup:
+            # Plain running mean and variance until the baseline is established
+            delta = x - self.mean
+            self.mean += delta / self.n
+            self.var += (delta * (x - self.mean) - self.var) / self.n
+            return None
+        z = (x - self.mean) / max(math.sqrt(self.var), self.min_std)
+        self.high = max(0.0, self.high + z - self.k)
+        self.low = max(0.0, self.low - z - self.k)
+        if self.high > self.h or self.low > self.h:
+            shift = "high" if self.high > self.h else "low"
+            self.signalled_from = self.mean
+            self.reset()
+            return shift
+        if self.high == 0.0 and self.low == 0.0:
+            delta = x - self.mean
+            self.mean += self.alpha * delta
+            self.var = (1 - self.alpha) * (self.var + self.alpha * delta * delta)
+        return None
+
+class AnomalyMonitor:
+    """
+    Watches one mouse's trials for the patterns hardware faults leave behind:
+    - reward latencies below min_reward_latency on consecutive trials
+      (magazine sensor stuck, feeder jammed);
+    - a run of omissions (stimulus LED or touchscreen dead);
+    - CUSUM shifts in correct latency, reward latency and omission rate;
+    - no trials for inactivity_timeout seconds.
+
+    observe() only queues the trial. The detectors run on their own thread, so
+    the metrics path is not slowed down. Every alert goes to the log, to publish(topic,
+    payload) on mouse_<chamber_id>/alert, and to hook(alert), where given.
+    Conditions are reported once when they start and once when they clear.
+    """
+
+    def __init__(self, mouse_id, chamber_id=None, publish=None, hook=None, min_reward_latency=150,
+                 low_reward_run=5, omission_run=20, inactivity_timeout=600, check_interval=5):
+        self.mouse_id = mouse_id
+        self.chamber_id = chamber_id or mouse_id
+        self.publish = publish
+        self.hook = hook
+        self.min_reward_latency = min_reward_latency
+        self.low_reward_run = low_reward_run
+        self.omission_run = omission_run
+        self.inactivity_timeout = inactivity_timeout
+        self.check_interval = check_interval
+        self.log = get_logger("anomaly", mouse_id, self.chamber_id)
+        # Latencies are roughly log-normal and tracked as logs. Omissions are 0/1, so their
+        # spread is floored as if the omission rate were at least 20%.
+        self.cusums = {"Correct Latency": Cusum(min_std=0.05), "Reward Latency": Cusum(min_std=0.05),
+                       "Omission Rate": Cusum(min_std=0.4)}
+        self.stage = None
+        self.trials = 0
+        self.low_rewards = 0
+        self.omissions = 0
+        self.active = set()
+        self.last_trial = time.monotonic()
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="AnomalyMonitor", daemon=True)
+        self.thread.start()
+
+    def observe(self, stage, trial):
+        self.queue.put((stage, trial, time.monotonic()))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.check_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                return
+            if item:
+                self.process(*item)
+            self.check_inactivity(time.monotonic())
+
+    def process(self, stage, trial, now):
+        if stage != self.stage:
+            # Latencies and omission rates differ between stages, so the baselines start over
+            self.stage = stage
+            for cusum in self.cusums.values():
+                cusum.reset()
+        self.trials += 1
+        self.last_trial = now
+        self.set_condition("inactive", False, "Trials resumed")
+
+        # The magazine latency is measured after every go trial, rewarded or not. A no-go
+        # (inhibition) trial reports its premature latency there instead, 0 after a correct
+        # withhold, so it neither extends nor breaks a run of low reward latencies.
+        nogo = trial[4] > 0 or trial[5] > 0
+        reward_latency = trial[8]
+        if not nogo:
+            self.low_rewards = self.low_rewards + 1 if reward_latency < self.min_reward_latency else 0
+            self.set_condition("reward_latency_low", self.low_rewards >= self.low_reward_run,
+                               f"Reward latency below {self.min_reward_latency} ms on {self.low_rewards} consecutive trials, "
+                               f"check the magazine sensor and feeder", reward_latency)
+        self.omissions = self.omissions + 1 if trial[3] > 0 else 0
+        self.set_condition("omissions", self.omissions >= self.omission_run,
+                           f"{self.omissions} consecutive omissions, check the stimulus lights and touchscreen", self.omissions)
+
+        samples = {"Omission Rate": float(trial[3] > 0)}
+        if not nogo:
+            samples["Reward Latency"] = math.log(max(reward_latency, 1))
+        if trial[0] > 0:
+            samples["Correct Latency"] = math.log(max(trial[6], 1))
+        for name, value in samples.items():
+            shift = self.cusums[name].update(value)
+            if shift:
+                baseline = self.cusums[name].signalled_from
+                if name.endswith("Latency"):
+                    message = f"{name} shifted {shift} from a baseline of {math.exp(baseline):.0f} ms"
+                    value = math.exp(value)
+                else:
+                    message = f"{name} shifted {shift} from a baseline of {100 * baseline:.0f}%"
+                self.alert(f"{name.lower().replace(' ', '_')}_shift", message, value)
+
+    def check_inactivity(self, now):
+        idle = now - self.last_trial
+        if idle > self.inactivity_timeout:
+            self.set_condition("inactive", True, f"No trials for {idle / 60:.0f} minutes", idle)
+
+    def set_condition(self, name, active, message, value=None):
+        """ Alerts when a condition starts and reports when it clears. """
+        if active and name not in self.active:
+            self.active.add(name)
+            self.alert(name, message, value)
+        elif not active and name in self.active:
+            self.active.discard(name)
+            self.log.info(f"Cleared {name}")
+
+    def alert(self, name, message, value=None):
+        alert = {"mouse_id": self.mouse_id, "chamber_id": self.chamber_id, "stage": self.stage, "alert": name,
+                 "message": message, "value": None if value is None else float(value), "trial": self.trials,
+                 "time": time.time()}
+        self.log.warning(f"Alert {name}: {message}")
+        if self.publish:
+            self.publish(f"mouse_{self.chamber_id}/alert", json.dumps(alert))
+        if self.hook:
+            try:
+                self.hook(alert)
+            except Exception:
+                self.log.exception(f"Alert hook failed for {name}")
+
+def command_hook(command):
+    """ Returns a hook that runs a shell command for every alert, with the alert as JSON on stdin. """
+    def hook(alert):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        process.stdin.write(json.dumps(alert).encode("utf-8"))
+        process.stdin.close()
+    return hook
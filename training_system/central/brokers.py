@@ -0,0 +1,168 @@
+''' Pools of broker connections, with chambers mapped to brokers from config and failover to standbys '''
+import json
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+DEFAULT_PORT = 1883
+
+def parse_address(address):
+    """ Splits "host" or "host:port" into (host, port). """
+    host, _, port = address.partition(":")
+    return host, int(port) if port else DEFAULT_PORT
+
+def load_config(path):
+    """
+    Reads a broker config of the form
+        {"brokers": {"rack1": "192.168.0.69", "rack2": "192.168.0.70:1884"},
+         "chambers": {"3": ["rack1", "rack2"], "4": ["rack2", "rack1"]},
+         "default": ["rack1"]}
+    where every chamber lists its primary broker first, then its standbys in the
+    order the firmware tries them. Chambers that are not listed use "default".
+    """
+    with open(path) as f:
+        config = json.load(f)
+    for names in list(config.get("chambers", {}).values()) + [config.get("default", [])]:
+        for name in names:
+            if name not in config["brokers"]:
+                raise ValueError(f"Unknown broker '{name}' in {path}")
+    return config
+
+def chamber_brokers(config, chamber_id):
+    """ Returns the (name, address) of every broker of a chamber, primary first. """
+    names = config.get("chambers", {}).get(str(chamber_id), config.get("default"))
+    if not names:
+        raise ValueError(f"No brokers configured for chamber {chamber_id}")
+    return [(name, config["brokers"][name]) for name in names]
+
+def all_brokers(config):
+    return list(config["brokers"].items())
+
+class BrokerPool:
+    """
+    One client per broker, all connected and each subscribed by on_connect. The
+    firmware moves to its next broker when it cannot reach the current one, so a
+    chamber that fails over is heard on the standby at once, and every client
+    reconnects and resubscribes on its own. Commands are published on the broker
+    the chamber was last heard on, or the first connected one before that.
+
+    Stands in for a paho client in mqtt.py: publish and user_data_get apply to the
+    whole pool, and on_message gets the pool as its client. on_connect, on_disconnect
+    and on_subscribe get the client of the broker concerned. Every message received
+    and published is also recorded to capture, if given.
+    """
+
+    def __init__(self, brokers, client_id=None, userdata=None, on_connect=None, on_disconnect=None,
+                 on_subscribe=None, on_message=None, on_failover=None, clean_session=False, keepalive=60, capture=None):
+        self.userdata = userdata
+        self.on_message = on_message
+        self.on_failover = on_failover
+        self.capture = capture
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.addresses = {}
+        self.traffic = {}
+        # Counts at the last report, for the rates
+        self.reported = {}
+        self.reported_at = time.monotonic()
+        self.active = None
+        self.stopped = threading.Event()
+        self.thread = None
+        for name, address in brokers:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, clean_session=clean_session)
+            client.user_data_set(userdata)
+            client.on_connect = on_connect
+            client.on_disconnect = on_disconnect
+            client.on_subscribe = on_subscribe
+            client.on_message = lambda client, userdata, msg, name=name: self.received(name, msg)
+            client.reconnect_delay_set(min_delay=1, max_delay=30)
+            # Retry in the background until the broker is reachable
+            client.connect_async(*parse_address(address), keepalive)
+            self.clients[name] = client
+            self.addresses[name] = address
+            self.traffic[name] = {"messages_in": 0, "messages_out": 0, "bytes_in": 0, "bytes_out": 0}
+            self.reported[name] = dict(self.traffic[name])
+
+    def user_data_get(self):
+        return self.userdata
+
+    def received(self, name, msg):
+        with self.lock:
+            traffic = self.traffic[name]
+            traffic["messages_in"] += 1
+            traffic["bytes_in"] += len(msg.payload)
+            old, self.active = self.active, name
+        if self.capture:
+            self.capture.received(msg.topic, msg.payload)
+        if old is not None and old != name and self.on_failover:
+            self.on_failover(old, name)
+        if self.on_message:
+            self.on_message(self, self.userdata, msg)
+
+    def current(self):
+        """ Returns the name of the broker commands are published on. """
+        with self.lock:
+            if self.active is not None and self.clients[self.active].is_connected():
+                return self.active
+            connected = [name for name, client in self.clients.items() if client.is_connected()]
+            # Queued on the last known broker if none is connected
+            return connected[0] if connected else self.active or next(iter(self.clients))
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        name = self.current()
+        with self.lock:
+            traffic = self.traffic[name]
+            traffic["messages_out"] += 1
+            traffic["bytes_out"] += len(payload.encode("utf-8") if isinstance(payload, str) else payload or b"")
+        if self.capture:
+            self.capture.sent(topic, payload)
+        return self.clients[name].publish(topic, payload, qos=qos, retain=retain)
+
+    def loop_start(self):
+        for client in self.clients.values():
+            client.loop_start()
+
+    def close(self):
+        self.stop()
+        for client in self.clients.values():
+            client.disconnect()
+            client.loop_stop()
+        if self.capture:
+            self.capture.close()
+
+    def stats(self):
+        """ Returns the connection state, message counts and rates per second of every broker since the last call. """
+        now = time.monotonic()
+        with self.lock:
+            elapsed = max(now - self.reported_at, 1e-9)
+            stats = {}
+            for name, traffic in self.traffic.items():
+                stats[name] = {"address": self.addresses[name], "connected": self.clients[name].is_connected(),
+                               "active": name == self.active, **traffic,
+                               "in_rate": (traffic["messages_in"] - self.reported[name]["messages_in"]) / elapsed,
+                               "out_rate": (traffic["messages_out"] - self.reported[name]["messages_out"]) / elapsed}
+                self.reported[name] = dict(traffic)
+            self.reported_at = now
+        return stats
+
+    def start(self, interval, report):
+        """ Calls report(stats()) in a background thread every interval seconds. """
+        def run():
+            while not self.stopped.wait(interval):
+                report(self.stats())
+        self.thread = threading.Thread(target=run, name="BrokerPool", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+def format_stats(stats):
+    lines = [f"{'Broker':<12}{'Address':<22}{'State':<14}{'In/s':>8}{'Out/s':>8}{'In':>10}{'Out':>10}{'kB in':>10}"]
+    for name, broker in stats.items():
+        state = ("connected" if broker["connected"] else "down") + (" *" if broker["active"] else "")
+        lines.append(f"{name:<12}{broker['address']:<22}{state:<14}{broker['in_rate']:>8.1f}{broker['out_rate']:>8.1f}"
+                     f"{broker['messages_in']:>10}{broker['messages_out']:>10}{broker['bytes_in'] / 1000:>10.1f}")
+    return "\n".join(lines)
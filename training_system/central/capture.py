@@ -0,0 +1,268 @@
+''' Capture of a session's MQTT traffic, replay of a capture as the chamber, and latency comparison of two runs '''
+import argparse
+import bisect
+import struct
+import threading
+import time
+import numpy as np
+import paho.mqtt.client as mqtt
+from brokers import parse_address
+
+MAGIC = b"MQCAP"
+CAPTURE_VERSION = 1
+# Version and wall-clock time of the start of the capture
+HEADER = struct.Struct("<Bd")
+# Seconds since the start (perf_counter), kind, topic id and payload length
+RECORD = struct.Struct("<dBHI")
+# Directions are seen from the central PC. A TOPIC record names a topic id, with the name as payload.
+INBOUND, OUTBOUND, TOPIC = 0, 1, 2
+
+class Capture:
+    """
+    Records messages to a compact binary file. Topics are written once and then
+    referred to by id, so a ping takes 19 bytes. Timestamps come from
+    time.perf_counter and are relative to the start of the capture.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.topics = {}
+        self.start = time.perf_counter()
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + HEADER.pack(CAPTURE_VERSION, time.time()))
+
+    def record(self, direction, topic, payload):
+        now = time.perf_counter() - self.start
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        with self.lock:
+            if topic not in self.topics:
+                self.topics[topic] = len(self.topics)
+                name = topic.encode("utf-8")
+                self.file.write(RECORD.pack(now, TOPIC, self.topics[topic], len(name)) + name)
+            self.file.write(RECORD.pack(now, direction, self.topics[topic], len(payload or b"")) + (payload or b""))
+
+    def received(self, topic, payload):
+        self.record(INBOUND, topic, payload)
+
+    def sent(self, topic, payload):
+        self.record(OUTBOUND, topic, payload)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_capture(path):
+    """ Returns the wall-clock start of a capture and its (time, direction, topic, payload) messages. """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f"{path} is not a capture")
+    version, started = HEADER.unpack_from(data, len(MAGIC))
+    if version != CAPTURE_VERSION:
+        raise ValueError(f"Unsupported capture version {version} in {path}")
+    offset = len(MAGIC) + HEADER.size
+    topics, messages = {}, []
+    # A record cut short by a crash ends the capture
+    while offset + RECORD.size <= len(data):
+        seconds, kind, topic_id, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + length]
+        offset += length
+        if len(payload) < length:
+            break
+        if kind == TOPIC:
+            topics[topic_id] = payload.decode("utf-8")
+        else:
+            messages.append((seconds, kind, topics[topic_id], payload))
+    return started, messages
+
+def response_latencies(messages):
+    """
+    Returns, for every trial received, its time and the time until the next stage
+    command was sent. This is the latency of the whole pipeline, including the wait
+    for the next ping, and is NaN for a trial that was not answered before the next
+    trial arrived. Resends of a command after its first send are not answers.
+    """
+    trials = [seconds for seconds, direction, topic, _ in messages if direction == INBOUND and topic.endswith("/data")]
+    stages = np.array([seconds for seconds, direction, topic, _ in messages
+                       if direction == OUTBOUND and topic.endswith("/stage")])
+    latencies = []
+    for k, seconds in enumerate(trials):
+        i = np.searchsorted(stages, seconds, side="right")
+        following = trials[k + 1] if k + 1 < len(trials) else np.inf
+        latencies.append(stages[i] - seconds if i < len(stages) and stages[i] < following else np.nan)
+    return np.array(trials), np.array(latencies)
+
+def compare(recorded, replayed, tolerance=0.1):
+    """
+    Compares the response latencies of two captures trial by trial. Returns the
+    summary of both runs and the trials whose latency differs by more than
+    tolerance seconds, as (trial, time in the recorded run, recorded, replayed).
+    """
+    times, before = response_latencies(recorded)
+    _, after = response_latencies(replayed)
+    n = min(len(before), len(after))
+    summary = {}
+    for name, latencies in [("recorded", before), ("replayed", after)]:
+        answered = latencies[~np.isnan(latencies)]
+        summary[name] = {"trials": len(latencies), "unanswered": int(np.isnan(latencies).sum()),
+                         "median": float(np.median(answered)) if len(answered) else np.nan,
+                         "p90": float(np.percentile(answered, 90)) if len(answered) else np.nan,
+                         "max": float(answered.max()) if len(answered) else np.nan}
+    difference = after[:n] - before[:n]
+    diverged = [(i, times[i], before[i], after[i]) for i in range(n)
+                if abs(difference[i]) > tolerance or np.isnan(before[i]) != np.isnan(after[i])]
+    return summary, diverged
+
+def format_comparison(summary, diverged, limit=20):
+    ms = lambda value: "-" if np.isnan(value) else f"{value * 1000:.0f}"
+    lines = [f"{'Run':<10}{'Trials':>8}{'Unanswered':>12}{'Median ms':>11}{'P90 ms':>9}{'Max ms':>9}"]
+    for name, run in summary.items():
+        lines.append(f"{name:<10}{run['trials']:>8}{run['unanswered']:>12}{ms(run['median']):>11}{ms(run['p90']):>9}{ms(run['max']):>9}")
+    if not diverged:
+        lines.append("Response latencies agree on every trial.")
+        return "\n".join(lines)
+    lines.append(f"Response latency diverged on {len(diverged)} trial(s):")
+    for trial, seconds, before, after in diverged[:limit]:
+        lines.append(f"  trial {trial + 1} at {seconds:.1f} s: recorded {ms(before)} ms, replayed {ms(after)} ms")
+    if len(diverged) > limit:
+        lines.append(f"  ... and {len(diverged) - limit} more")
+    return "\n".join(lines)
+
+def rename_chamber(topic, chamber_id):
+    return f"mouse_{chamber_id}/{topic.split('/', 1)[1]}" if chamber_id else topic
+
+def replay(messages, address, speed=1.0, output=None, chamber_id=None, linger=5.0, answer_timeout=100.0):
+    """
+    Plays the chamber's side of a capture into a broker, while the central pipeline
+    under test answers as it would a chamber. The recorded trials are published at
+    their recorded times divided by speed, or back to back if speed is None.
+    Like the firmware, the replay runs one trial per stage command: from the first
+    recorded ping after a trial, it pings every 500 ms (scaled by speed) until the
+    next command arrives, and the rest of the schedule is delayed by any wait past
+    the recorded time of the next trial. Recorded pings are not replayed, and
+    commands beyond the one the replay waits for, such as resends, are not counted.
+    Both sides are captured to output, and the replayed messages are returned.
+    """
+    capture = Capture(output or "replay.cap")
+    recorded = [(seconds, rename_chamber(topic, chamber_id), payload)
+                for seconds, direction, topic, payload in messages if direction == INBOUND]
+    pings = [seconds for seconds, topic, _ in recorded if topic.endswith("/request")]
+    inbound = [(seconds, topic, payload) for seconds, topic, payload in recorded if not topic.endswith("/request")]
+    chambers = sorted({topic.split("/", 1)[0] for _, topic, _ in recorded})
+    connected = threading.Event()
+    answers = threading.Condition()
+    # Stage commands counted as answers, and trials sent
+    answered, sent = [0], [0]
+
+    def on_connect(client, userdata, flags, reason_code, properties):
+        client.subscribe([(f"{chamber}/stage", 1) for chamber in chambers])
+        connected.set()
+
+    def on_message(client, userdata, msg):
+        capture.sent(msg.topic, msg.payload)
+        with answers:
+            # The first command answers the start of the session, then one per trial sent
+            if answered[0] <= sent[0]:
+                answered[0] += 1
+                answers.notify_all()
+
+    def publish(topic, payload):
+        capture.received(topic, payload)
+        # QoS 1, unlike the firmware, so a replay at max speed is not thinned out by the broker
+        client.publish(topic, payload, qos=1)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(*parse_address(address), 60)
+    client.loop_start()
+    connected.wait(10)
+
+    ping_interval = 0.5 / speed if speed else 0.01
+    start = time.perf_counter()
+    first = recorded[0][0] if recorded else 0.0
+    # Time the replay has fallen behind the recorded schedule, waiting for stage commands
+    behind = 0.0
+
+    def due(seconds):
+        return start + (seconds - first) / speed + behind if speed else time.perf_counter()
+
+    def sleep_until(seconds):
+        delay = due(seconds) - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    previous = None
+    for seconds, topic, payload in inbound:
+        if topic.endswith("/data"):
+            # The chamber starts waiting for its command with the first ping after the previous trial
+            i = 0 if previous is None else bisect.bisect_right(pings, previous)
+            sleep_until(pings[i] if i < len(pings) and pings[i] < seconds else seconds)
+            waited = time.perf_counter()
+            with answers:
+                while answered[0] <= sent[0] and time.perf_counter() - waited < answer_timeout:
+                    publish(f"{topic.split('/', 1)[0]}/request", b"ping")
+                    answers.wait(ping_interval)
+                if answered[0] <= sent[0]:
+                    print(f"No stage command for trial {sent[0] + 1} within {answer_timeout:.0f} s, replay stopped.")
+                    break
+            behind += max(time.perf_counter() - due(seconds), 0.0)
+            previous = seconds
+        sleep_until(seconds)
+        with answers:
+            publish(topic, payload)
+            if topic.endswith("/data"):
+                sent[0] += 1
+    # Answers to the last trials
+    time.sleep(linger)
+    client.disconnect()
+    client.loop_stop()
+    capture.close()
+    return read_capture(capture.path)[1]
+
+def summarize(messages):
+    topics = {}
+    for _, direction, topic, payload in messages:
+        key = (topic, "in" if direction == INBOUND else "out")
+        count, size = topics.get(key, (0, 0))
+        topics[key] = (count + 1, size + len(payload))
+    lines = [f"{'Topic':<30}{'Dir':<5}{'Messages':>10}{'Bytes':>10}"]
+    for (topic, direction), (count, size) in sorted(topics.items()):
+        lines.append(f"{topic:<30}{direction:<5}{count:>10}{size:>10}")
+    duration = messages[-1][0] - messages[0][0] if messages else 0
+    lines.append(f"{len(messages)} messages over {duration:.1f} s")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a capture from main.py --capture, replay it into a central "
+                                                 "pipeline, or compare the response latencies of two captures.")
+    parser.add_argument("capture", type=str, help="Capture file.")
+    parser.add_argument("--replay", action="store_true", help="Replay the chamber's side of the capture into the broker.")
+    parser.add_argument("--ip_address", type=str, default="192.168.0.135", help="Broker to replay into, host or host:port.")
+    parser.add_argument("--speed", type=str, default="1", help="Replay speed, e.g. 1, 10 or max.")
+    parser.add_argument("--chamber_id", type=str, help="Replay on mouse_<chamber_id>/* instead of the recorded topics.")
+    parser.add_argument("--output", type=str, help="Capture of the replay, defaults to <capture>.replay.")
+    parser.add_argument("--linger", type=float, default=5, help="Seconds to wait for answers after the last message.")
+    parser.add_argument("--compare", type=str, help="Compare the response latencies with this capture instead.")
+    parser.add_argument("--tolerance", type=float, default=100, help="Latency difference in ms reported as a divergence.")
+    args = parser.parse_args()
+
+    _, messages = read_capture(args.capture)
+    if args.replay:
+        speed = None if args.speed == "max" else float(args.speed)
+        replayed = replay(messages, args.ip_address, speed, args.output or f"{args.capture}.replay", args.chamber_id, args.linger)
+        print(format_comparison(*compare(messages, replayed, args.tolerance / 1000)))
+    elif args.compare:
+        print(format_comparison(*compare(messages, read_capture(args.compare)[1], args.tolerance / 1000)))
+    else:
+        print(summarize(messages))
+        _, latencies = response_latencies(messages)
+        if len(latencies) and not np.isnan(latencies).all():
+            print(f"Response latency: median {np.nanmedian(latencies) * 1000:.0f} ms, "
+                  f"p90 {np.nanpercentile(latencies, 90) * 1000:.0f} ms over {len(latencies)} trials")
+
+if __name__ == "__main__":
+    main()
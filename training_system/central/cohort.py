@@ -0,0 +1,138 @@
+''' Summarizes past cohorts from their mouse_<id> directories into one table '''
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from metrics import compute_threshold, false_alarm, hit_rate, response_counts, \
+    responsivity_index, sensitivity_index, trial_latencies
+from triallog import find_mouse_dirs, load_mouse_trials, mouse_id_from_dir, session_files, \
+    session_label, stage_segments
+
+COLUMNS = ["mouse_id", "session", "stage", "trials", "trials_to_criterion", "correct", "incorrect",
+           "premature", "omission", "correct_withholding", "incorrect_withholding", "hit_rate",
+           "false_alarm_rate", "sensitivity_index", "responsivity_index", "mean_correct_latency",
+           "median_correct_latency", "p90_correct_latency", "iqr_correct_latency",
+           "mean_incorrect_latency", "mean_reward_latency", "mean_premature_latency"]
+
+def trials_to_criterion(stage, trials):
+    """ Replays compute_threshold after every trial and returns the first trial that met it. """
+    correct = np.cumsum(trials[:, 0])
+    count = np.cumsum(response_counts(stage, trials))
+    correct_latency = np.cumsum(trials[:, 6] * (trials[:, 0] > 0))
+    mean_correct_latency = np.divide(correct_latency, correct, out=np.zeros(len(trials)), where=correct > 0)
+    for i in range(len(trials)):
+        metrics = {"Correct": correct[i], "Count": count[i], "Mean Correct Latency": mean_correct_latency[i]}
+        if compute_threshold(stage, metrics):
+            return i + 1
+    return None
+
+def latency_stats(latencies):
+    if len(latencies) == 0:
+        return 0, 0, 0, 0
+    q25, median, q75, p90 = np.percentile(latencies, [25, 50, 75, 90])
+    return latencies.mean(), median, p90, q75 - q25
+
+def summarize_stage(mouse_id, session, stage, trials):
+    totals = trials.sum(axis=0)
+    correct, incorrect, premature, omission, c_wh, i_wh = totals[:6]
+    latencies = trial_latencies(trials)
+    mean_cl, median_cl, p90_cl, iqr_cl = latency_stats(latencies["Correct"])
+    return {
+        "mouse_id": mouse_id,
+        "session": session,
+        "stage": stage,
+        "trials": len(trials),
+        "trials_to_criterion": trials_to_criterion(stage, trials),
+        "correct": int(correct),
+        "incorrect": int(incorrect),
+        "premature": int(premature),
+        "omission": int(omission),
+        "correct_withholding": int(c_wh),
+        "incorrect_withholding": int(i_wh),
+        "hit_rate": hit_rate(correct, incorrect, omission),
+        "false_alarm_rate": false_alarm(c_wh, i_wh),
+        "sensitivity_index": sensitivity_index(correct, incorrect, omission, c_wh, i_wh),
+        "responsivity_index": responsivity_index(correct, incorrect, omission, c_wh, i_wh),
+        "mean_correct_latency": mean_cl,
+        "median_correct_latency": median_cl,
+        "p90_correct_latency": p90_cl,
+        "iqr_correct_latency": iqr_cl,
+        "mean_incorrect_latency": latency_stats(latencies["Incorrect"])[0],
+        "mean_reward_latency": latency_stats(latencies["Reward"])[0],
+        "mean_premature_latency": latency_stats(latencies["Premature"])[0],
+    }
+
+def summarize_session(mouse_dir):
+    """ Returns one summary row per stage of a mouse_<id> directory. """
+    trials = load_mouse_trials(mouse_dir)
+    mouse_id = mouse_id_from_dir(mouse_dir)
+    session = session_label(mouse_dir)
+    rows = []
+    for stage, start, stop in stage_segments(mouse_dir, len(trials)):
+        if stop > start:
+            row = summarize_stage(mouse_id, session, stage, trials[start:stop])
+            rows.append({key: float(value) if isinstance(value, np.floating) else value for key, value in row.items()})
+    return rows
+
+# Bumped when the summary rows change, so cached rows from older versions are recomputed
+SUMMARY_VERSION = 2
+
+def cache_key(mouse_dir):
+    return [SUMMARY_VERSION] + [[path, os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in session_files(mouse_dir)]
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f"Ignoring unreadable cache {path}")
+        return {}
+
+def summarize_cohort(roots, cache_path=None, workers=None):
+    """ Summarizes every session below roots, only re-parsing sessions whose files changed. """
+    cache = load_cache(cache_path) if cache_path else {}
+    mouse_dirs = find_mouse_dirs(roots)
+    keys = {mouse_dir: cache_key(mouse_dir) for mouse_dir in mouse_dirs}
+    stale = [mouse_dir for mouse_dir in mouse_dirs
+             if mouse_dir not in cache or cache[mouse_dir]["key"] != keys[mouse_dir]]
+
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for mouse_dir, rows in zip(stale, pool.map(summarize_session, stale, chunksize=8)):
+                cache[mouse_dir] = {"key": keys[mouse_dir], "rows": rows}
+
+    if cache_path:
+        # Sessions that disappeared are dropped from the cache
+        with open(cache_path, "w") as f:
+            json.dump({mouse_dir: cache[mouse_dir] for mouse_dir in mouse_dirs}, f)
+
+    rows = [row for mouse_dir in mouse_dirs for row in cache[mouse_dir]["rows"]]
+    return rows, len(mouse_dirs), len(stale)
+
+def write_table(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize mouse_<id> directories of past cohorts.")
+    parser.add_argument("roots", type=str, nargs="+", help="Directories to search for mouse_<id> folders.")
+    parser.add_argument("--output", type=str, default="cohort_summary.csv", help="Summary table to write.")
+    parser.add_argument("--cache", type=str, default=".cohort_cache.json", help="Per-session cache, empty to disable.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rows, sessions, parsed = summarize_cohort(args.roots, args.cache or None, args.workers)
+    write_table(rows, args.output)
+    print(f"Summarized {sessions} sessions ({parsed} parsed, {sessions - parsed} cached) into "
+          f"{len(rows)} rows in {time.perf_counter() - start:.2f} s: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+''' Local web dashboard that streams every chamber's metrics to the browser over Server-Sent Events '''
+import argparse
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from brokers import BrokerPool, all_brokers, load_config
+
+# Metrics needed to draw a chamber, everything else stays on the central PC
+DASHBOARD_KEYS = ["Total Trials", "Count", "Correct", "Incorrect", "Premature", "Omission",
+                  "Correct Withholding Percentage", "Inter Trial Duration", "Cumulative Reward Latency",
+                  "Mean Correct Latency", "Mean Incorrect Latency", "Mean Reward Latency",
+                  "Mean Premature Latency"]
+
+def metrics_payload(mouse_id, stage, metrics):
+    """ Compact JSON message published by the watcher after every trial. """
+    values = {key: round(float(metrics[key]), 2) for key in DASHBOARD_KEYS if key in metrics}
+    return json.dumps({"mouse_id": mouse_id, "stage": stage, "metrics": values}, separators=(",", ":"))
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Mouse training dashboard</title>
+<style>
+  body { font-family: sans-serif; background: #f4f4f4; margin: 16px; }
+  #chambers { display: flex; flex-wrap: wrap; gap: 16px; }
+  .chamber { background: white; border-radius: 6px; padding: 12px 16px; width: 420px; box-shadow: 0 1px 3px #aaa; }
+  .chamber h2 { font-size: 16px; margin: 0 0 4px 0; }
+  .subtitle { font-size: 12px; color: #555; margin-bottom: 8px; }
+  .bar { background: lightgray; border: 2px solid gray; border-radius: 8px; height: 22px; position: relative; }
+  .fill { background: seagreen; height: 100%; border-radius: 6px; }
+  .bar span { position: absolute; width: 100%; text-align: center; top: 2px; color: white; font-weight: bold; text-shadow: 0 0 2px black; }
+  .label { text-align: center; font-size: 13px; margin: 4px 0 10px 0; }
+  .breakdown { display: flex; align-items: flex-end; height: 100px; gap: 8px; border-bottom: 1px solid #888; }
+  .breakdown div { flex: 1; text-align: center; font-size: 11px; color: white; }
+  .names { display: flex; gap: 8px; font-size: 11px; margin-bottom: 8px; }
+  .names div { flex: 1; text-align: center; }
+  table { border-collapse: collapse; width: 100%; font-size: 12px; }
+  td, th { border: 1px solid #ccc; padding: 2px 6px; }
+  .met { color: green; } .not-met { color: red; }
+</style>
+</head>
+<body>
+<h1>Mouse training dashboard</h1>
+<div id="chambers"></div>
+<script>
+const BREAKDOWN_COLORS = {"Correct": "blue", "Incorrect": "red", "Premature": "purple", "Omission": "orange", "Correct Withholding": "teal"};
+
+// Same targets and latency thresholds as visual.generate_plot
+function layout(stage, m) {
+  if (stage === "hab1") return {target: 30, value: m["Count"], label: "Responses", hab: true};
+  if (stage === "hab2") return {target: 70, value: m["Count"], label: "Responses", hab: true};
+  let stim = 2, threshold = 1500, value = m["Correct"];
+  if (stage.startsWith("5csr_citi_")) {
+    stim = parseFloat(stage.split("_").pop());
+    threshold = stage === "5csr_citi_2" ? stim * 1000 * 0.75 : stim * 1000 / 2;
+  } else if (stage.startsWith("rcpt_")) {
+    stim = stage === "rcpt_viti_175" ? 1.75 : stage === "rcpt_viti_15" ? 1.5 : 2;
+    value = m["Count"];
+  }
+  return {target: 30, value: value, label: "Correct Responses", stim: stim, threshold: threshold, rcpt: stage.startsWith("rcpt_")};
+}
+
+// Mouse IDs and stages come from the broker, so they are escaped before going into markup
+function escape(text) {
+  return String(text).replace(/[&<>"']/g, c => ({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;"})[c]);
+}
+
+function render(state) {
+  const m = state.metrics, l = layout(state.stage, m);
+  let card = document.getElementById("chamber-" + state.mouse_id);
+  if (!card) {
+    card = document.createElement("div");
+    card.className = "chamber";
+    card.id = "chamber-" + state.mouse_id;
+    document.getElementById("chambers").appendChild(card);
+  }
+  const progress = Math.min((l.value || 0) / l.target, 1);
+  let subtitle = "Trials: " + m["Total Trials"];
+  if (!l.hab) {
+    subtitle += ", stimulus duration: " + l.stim + " s";
+    if (state.stage !== "5csr" && !state.stage.startsWith("5csr_citi_")) subtitle += ", inter trial duration: " + Math.floor(m["Inter Trial Duration"] / 1000) + " s";
+  }
+  let html = "<h2>Mouse " + escape(state.mouse_id) + " - " + escape(state.stage) + "</h2><div class='subtitle'>" + subtitle + "</div>" +
+    "<div class='bar'><div class='fill' style='width:" + (progress * 100) + "%'></div><span>" + Math.floor(progress * 100) + "%</span></div>" +
+    "<div class='label'>" + l.label + ": " + Math.floor(l.value || 0) + "/" + l.target + "</div>";
+  if (l.hab) {
+    html += "<table><tr><th>Latency Type</th><th>Value</th></tr>" +
+      "<tr><td>Cumulative Reward (ms)</td><td>" + m["Cumulative Reward Latency"].toFixed(2) + "</td></tr>" +
+      "<tr><td>Mean Reward (ms)</td><td>" + m["Mean Reward Latency"].toFixed(2) + "</td></tr></table>";
+  } else {
+    const total = m["Total Trials"] || 1;
+    const values = {"Correct": 100 * m["Correct"] / total, "Incorrect": 100 * m["Incorrect"] / total,
+                    "Premature": 100 * m["Premature"] / total, "Omission": 100 * m["Omission"] / total};
+    if (l.rcpt) values["Correct Withholding"] = m["Correct Withholding Percentage"];
+    html += "<div class='breakdown'>" + Object.keys(values).map(k =>
+      "<div style='background:" + BREAKDOWN_COLORS[k] + ";height:" + values[k] + "%'>" + values[k].toFixed(0) + "%</div>").join("") + "</div>" +
+      "<div class='names'>" + Object.keys(values).map(k => "<div>" + k + "</div>").join("") + "</div>";
+    const met = m["Mean Correct Latency"] < l.threshold;
+    const cls = met ? "met" : "not-met";
+    html += "<table><tr><th>Latency Type</th><th>Value</th><th>Status</th></tr>" +
+      "<tr><td>Mean Correct Latency (ms)</td><td class='" + cls + "'>" + m["Mean Correct Latency"].toFixed(2) + "</td><td class='" + cls + "'>" + (met ? "threshold met" : "threshold not met") + "</td></tr>" +
+      ["Incorrect", "Reward", "Premature"].map(k => "<tr><td>Mean " + k + " Latency (ms)</td><td>" + m["Mean " + k + " Latency"].toFixed(2) + "</td><td></td></tr>").join("") +
+      "</table>";
+  }
+  card.innerHTML = html;
+}
+
+const events = new EventSource("/events");
+events.onmessage = e => render(JSON.parse(e.data));
+</script>
+</body>
+</html>
+"""
+
+class Dashboard:
+    """ Keeps the latest metrics of every chamber and fans them out to connected browsers. """
+
+    def __init__(self):
+        self.latest = {}
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def update(self, message):
+        try:
+            state = json.loads(message)
+        except ValueError:
+            state = None
+        # Called on the paho network thread, which a bad message must not take down
+        if not isinstance(state, dict) or state.get("mouse_id") is None:
+            print(f"Ignoring malformed metrics message: {message}")
+            return
+        with self.lock:
+            self.latest[state["mouse_id"]] = message
+            for client in self.clients:
+                client.put(message)
+
+    def subscribe(self):
+        client = queue.Queue()
+        with self.lock:
+            # New browsers immediately get the current state of every chamber
+            for message in self.latest.values():
+                client.put(message)
+            self.clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.remove(client)
+
+def make_handler(dashboard):
+    class DashboardHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/":
+                body = PAGE.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif self.path == "/events":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                client = dashboard.subscribe()
+                try:
+                    while True:
+                        try:
+                            message = client.get(timeout=15)
+                            self.wfile.write(f"data: {message}\n\n".encode("utf-8"))
+                        except queue.Empty:
+                            # Comment line keeps idle connections open through proxies
+                            self.wfile.write(b": keepalive\n\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    dashboard.unsubscribe(client)
+            else:
+                self.send_error(404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return DashboardHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a live dashboard of every chamber's metrics.")
+    parser.add_argument("--ip_address", type=str, default="192.168.0.135", help="IP of network.")
+    parser.add_argument("--brokers", type=str, help="JSON broker config, to follow every broker in it instead of --ip_address.")
+    parser.add_argument("--port", type=int, default=8000, help="Port of the dashboard web server.")
+    args = parser.parse_args()
+
+    dashboard = Dashboard()
+
+    # Watchers publish on the broker their chamber was last heard on, so every broker is followed
+    pool = BrokerPool(all_brokers(load_config(args.brokers)) if args.brokers else [(args.ip_address, args.ip_address)],
+                      on_connect=lambda client, userdata, flags, reason_code, properties: client.subscribe("+/metrics"),
+                      on_message=lambda client, userdata, msg: dashboard.update(msg.payload.decode("utf-8", errors="replace")),
+                      clean_session=True)
+    pool.loop_start()
+
+    server = ThreadingHTTPServer(("", args.port), make_handler(dashboard))
+    server.daemon_threads = True
+    print(f"Dashboard running on http://localhost:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Dashboard stopped.")
+    pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+''' Exports sessions to Parquet datasets partitioned by mouse and stage '''
+import argparse
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sketch import LATENCY_TYPES
+from triallog import TRIAL_COLUMNS, load_metrics_log, load_mouse_trials, mouse_id_from_dir, \
+    resolve_mouse_dirs, session_label, stage_segments
+
+# Keys written by Watcher.save_metrics, in file order
+METRIC_KEYS = ["Total Trials", "Correct", "Incorrect", "Premature", "Omission", "Correct Withholding",
+               "Incorrect Withholding", "Cumulative Correct Latency", "Cumulative Incorrect Latency",
+               "Cumulative Reward Latency", "Cumulative Premature Latency"] + \
+              [f"Mean {latency_type} Latency" for latency_type in LATENCY_TYPES] + \
+              [f"{statistic} {latency_type} Latency" for latency_type in LATENCY_TYPES for statistic in ["Median", "P90", "IQR"]] + \
+              ["Correct Percentage", "Omission Percentage", "Correct Withholding Percentage",
+               "Difference Withholding", "False Alarm Rate", "Hit Rate", "Sensitivity Index",
+               "Responsivity Index", "Rolling Sensitivity Index", "Rolling Responsivity Index",
+               "Inter Trial Duration"]
+
+def column_name(key):
+    return key.lower().replace(" ", "_")
+
+# Outcome flags fit in int8, latencies in milliseconds in int32
+TRIAL_SCHEMA = pa.schema(
+    [("session", pa.string()), ("trial_number", pa.int32()), ("session_trial", pa.int32())] +
+    [(column_name(column), pa.int8() if i < 6 else pa.int32()) for i, column in enumerate(TRIAL_COLUMNS)]
+)
+
+METRIC_SCHEMA = pa.schema(
+    [("session", pa.string()), ("trial_number", pa.int32())] +
+    [(column_name(key), pa.float64()) for key in METRIC_KEYS[1:]]
+)
+
+def partition_path(root, table, mouse_id, stage, session):
+    return os.path.join(root, table, f"mouse_id={mouse_id}", f"stage={stage}", f"{session}.parquet")
+
+def trial_table(trials, start, session):
+    columns = {
+        "session": [session] * len(trials),
+        "trial_number": list(range(1, len(trials) + 1)),
+        "session_trial": list(range(start + 1, start + len(trials) + 1)),
+    }
+    for i, column in enumerate(TRIAL_COLUMNS):
+        columns[column_name(column)] = trials[:, i].round().astype("int64")
+    return pa.Table.from_pydict(columns, schema=TRIAL_SCHEMA)
+
+def metric_table(snapshots, session):
+    columns = {
+        "session": [session] * len(snapshots),
+        "trial_number": [int(snapshot.get("Total Trials", i + 1)) for i, snapshot in enumerate(snapshots)],
+    }
+    for key in METRIC_KEYS[1:]:
+        # Older sessions lack the newer metrics, which are left null
+        columns[column_name(key)] = [snapshot.get(key) for snapshot in snapshots]
+    return pa.Table.from_pydict(columns, schema=METRIC_SCHEMA)
+
+def export_session(mouse_dir, output, session=None, compression="zstd", row_group_size=10000):
+    """
+    Writes one Parquet file per stage of a session for the trials and for the metric
+    trajectory. Each session gets its own files, so exporting a new session appends to
+    the dataset without rewriting it, and exporting the same session again replaces it.
+    """
+    mouse_id = mouse_id_from_dir(mouse_dir)
+    session = session or session_label(mouse_dir)
+    trials = load_mouse_trials(mouse_dir)
+    written = []
+    for stage, start, stop in stage_segments(mouse_dir, len(trials)):
+        tables = {
+            "trials": trial_table(trials[start:stop], start, session),
+            "metrics": metric_table(load_metrics_log(os.path.join(mouse_dir, stage, "data.txt")), session),
+        }
+        for name, table in tables.items():
+            if table.num_rows == 0:
+                continue
+            path = partition_path(output, name, mouse_id, stage, session)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write next to the final path first so readers never see a partial file
+            pq.write_table(table, path + ".tmp", compression=compression, row_group_size=row_group_size)
+            os.replace(path + ".tmp", path)
+            written.append(path)
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Export sessions to partitioned Parquet files.")
+    parser.add_argument("paths", type=str, nargs="+", help="mouse_<id> directories, or directories to search for them.")
+    parser.add_argument("--output", type=str, default="export", help="Root of the Parquet dataset.")
+    parser.add_argument("--compression", type=str, default="zstd", choices=["zstd", "snappy", "gzip", "none"])
+    args = parser.parse_args()
+
+    mouse_dirs = resolve_mouse_dirs(args.paths)
+    for mouse_dir in mouse_dirs:
+        written = export_session(mouse_dir, args.output, compression=args.compression)
+        print(f"Exported {mouse_dir}: {len(written)} files")
+
+if __name__ == "__main__":
+    main()
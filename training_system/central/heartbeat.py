@@ -0,0 +1,202 @@
+''' Chamber liveness from the ping stream, with ping jitter and stage-to-trial round-trip times '''
+import argparse
+import threading
+import time
+from brokers import BrokerPool, all_brokers, format_stats, load_config
+
+ALIVE, STALE, DEAD = "alive", "stale", "dead"
+
+class Heartbeat:
+    """
+    Tracks every chamber in constant memory. Ping intervals and round-trip times
+    are smoothed the way TCP smooths its RTT (RFC 6298): a mean with gain alpha
+    and a mean deviation with gain beta.
+
+    An idle chamber pings every 500 ms, so it is stale after stale_after seconds of
+    silence and dead after dead_after. A chamber running a trial does not ping, so
+    while a stage command is unanswered it is only stale once the silence exceeds
+    the usual round trip (mean + 4 deviations), and dead after trial_timeout.
+    Nor does it ping during the intertrial interval that follows a trial, which
+    restarts on every touch, so from a trial to the next ping it is only stale after
+    iti_timeout seconds and dead after trial_timeout.
+    """
+
+    def __init__(self, stale_after=2.0, dead_after=10.0, trial_timeout=600.0, iti_timeout=60.0,
+                 alpha=0.125, beta=0.25, on_change=None):
+        self.stale_after = stale_after
+        self.dead_after = dead_after
+        self.trial_timeout = trial_timeout
+        self.iti_timeout = iti_timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.on_change = on_change
+        self.chambers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def chamber(self, chamber_id):
+        if chamber_id not in self.chambers:
+            self.chambers[chamber_id] = {
+                "last_seen": None, "last_ping": None, "pings": 0, "trials": 0,
+                "interval": None, "jitter": 0.0,
+                "stage_sent": None, "rtt": None, "rtt_deviation": 0.0, "last_rtt": None,
+                "in_iti": False, "liveness": DEAD,
+            }
+        return self.chambers[chamber_id]
+
+    def smooth(self, state, mean_key, deviation_key, sample, initial_deviation):
+        if state[mean_key] is None:
+            state[mean_key], state[deviation_key] = sample, initial_deviation
+        else:
+            state[deviation_key] += self.beta * (abs(sample - state[mean_key]) - state[deviation_key])
+            state[mean_key] += self.alpha * (sample - state[mean_key])
+
+    def ping(self, chamber_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            state = self.chamber(chamber_id)
+            # Intervals spanning a trial measure the trial, not the ping rate
+            if state["last_ping"] is not None and state["stage_sent"] is None:
+                self.smooth(state, "interval", "jitter", now - state["last_ping"], 0.0)
+            state["last_ping"] = state["last_seen"] = now
+            state["pings"] += 1
+            state["in_iti"] = False
+
+    def stage_sent(self, chamber_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            state = self.chamber(chamber_id)
+            # A resent command keeps the time of the original one
+            if state["stage_sent"] is None:
+                state["stage_sent"] = now
+
+    def trial(self, chamber_id, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            state = self.chamber(chamber_id)
+            if state["stage_sent"] is not None:
+                state["last_rtt"] = now - state["stage_sent"]
+                # The first round trip starts with a wide deviation, as in RFC 6298
+                self.smooth(state, "rtt", "rtt_deviation", state["last_rtt"], state["last_rtt"] / 2)
+                state["stage_sent"] = None
+            state["last_seen"] = now
+            state["last_ping"] = None
+            state["trials"] += 1
+            # Silent until the intertrial interval ends with a ping
+            state["in_iti"] = True
+
+    def liveness_of(self, state, now):
+        if state["last_seen"] is None:
+            return DEAD
+        if state["stage_sent"] is not None:
+            silence = now - max(state["last_seen"], state["stage_sent"])
+            if silence > self.trial_timeout:
+                return DEAD
+            expected = state["rtt"] + 4 * state["rtt_deviation"] if state["rtt"] is not None else self.trial_timeout
+            return STALE if silence > max(expected, self.stale_after) else ALIVE
+        silence = now - state["last_seen"]
+        if state["in_iti"]:
+            if silence > self.trial_timeout:
+                return DEAD
+            return STALE if silence > self.iti_timeout else ALIVE
+        if silence > self.dead_after:
+            return DEAD
+        return STALE if silence > self.stale_after else ALIVE
+
+    def stats_of(self, state, now):
+        return {
+            "liveness": self.liveness_of(state, now),
+            "silence": None if state["last_seen"] is None else now - state["last_seen"],
+            "pings": state["pings"],
+            "trials": state["trials"],
+            "ping_interval": state["interval"],
+            "ping_jitter": state["jitter"],
+            "rtt": state["rtt"],
+            "rtt_deviation": state["rtt_deviation"],
+            "last_rtt": state["last_rtt"],
+            "waiting_for_trial": state["stage_sent"] is not None,
+            "in_iti": state["in_iti"],
+        }
+
+    def status(self, now=None):
+        """ Returns the liveness and statistics of every chamber, times in seconds. """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return {chamber_id: self.stats_of(state, now) for chamber_id, state in self.chambers.items()}
+
+    def check(self, now=None):
+        """ Calls on_change(chamber_id, old, new, stats) for every chamber whose liveness changed. """
+        now = time.monotonic() if now is None else now
+        changes = []
+        with self.lock:
+            for chamber_id, state in self.chambers.items():
+                stats = self.stats_of(state, now)
+                if stats["liveness"] != state["liveness"]:
+                    changes.append((chamber_id, state["liveness"], stats["liveness"], stats))
+                    state["liveness"] = stats["liveness"]
+        # Outside the lock, so on_change may call status()
+        if self.on_change:
+            for change in changes:
+                self.on_change(*change)
+
+    def start(self, interval=0.5):
+        """ Checks liveness in a background thread every interval seconds. """
+        def run():
+            while not self.stopped.wait(interval):
+                self.check()
+        self.thread = threading.Thread(target=run, name="Heartbeat", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+def format_status(status):
+    ms = lambda value: "-" if value is None else f"{value * 1000:.0f}"
+    lines = [f"{'Chamber':<10}{'State':<8}{'Silence':>9}{'Pings':>8}{'Trials':>8}{'Ping ms':>9}{'Jitter':>8}{'RTT ms':>9}{'RTT dev':>9}"]
+    for chamber_id, stats in sorted(status.items()):
+        lines.append(f"{chamber_id:<10}{stats['liveness']:<8}{ms(stats['silence']):>9}{stats['pings']:>8}{stats['trials']:>8}"
+                     f"{ms(stats['ping_interval']):>9}{ms(stats['ping_jitter']):>8}{ms(stats['rtt']):>9}{ms(stats['rtt_deviation']):>9}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Monitor the liveness of every chamber on a broker.")
+    parser.add_argument("--ip_address", type=str, default="192.168.0.135", help="IP of network.")
+    parser.add_argument("--brokers", type=str, help="JSON broker config, to monitor every broker in it instead of --ip_address.")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between status tables.")
+    args = parser.parse_args()
+
+    heartbeat = Heartbeat(on_change=lambda chamber_id, old, new, stats: print(f"Chamber {chamber_id}: {old} -> {new}"))
+
+    def on_message(client, userdata, msg):
+        # Topics are mouse_<chamber_id>/<kind>, as published by the firmware and the central PC
+        chamber, kind = msg.topic.split("/", 1)
+        chamber_id = chamber[len("mouse_"):]
+        if kind == "request":
+            heartbeat.ping(chamber_id)
+        elif kind == "stage":
+            heartbeat.stage_sent(chamber_id)
+        elif kind == "data":
+            heartbeat.trial(chamber_id)
+
+    # Chambers publish on one broker at a time, so every broker is watched
+    pool = BrokerPool(all_brokers(load_config(args.brokers)) if args.brokers else [(args.ip_address, args.ip_address)],
+                      on_connect=lambda client, userdata, flags, reason_code, properties:
+                          client.subscribe([("+/request", 0), ("+/stage", 0), ("+/data", 0)]),
+                      on_message=on_message, clean_session=True)
+    pool.loop_start()
+    heartbeat.start()
+    try:
+        while True:
+            time.sleep(args.interval)
+            print(format_status(heartbeat.status()))
+            print(format_stats(pool.stats()))
+    except KeyboardInterrupt:
+        pass
+    heartbeat.stop()
+    pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+''' Background writer that appends incoming trial payloads to the trial log '''
+import shutil
+import threading
+from collections import deque
+from segments import SegmentWriter
+from log import get_logger
+
+class TrialIngest:
+    """
+    The paho network thread only queues payloads here. A writer thread drains
+    everything queued so far and appends it with a single write, so a burst of
+    trials after a reconnect is written at once and the watcher sees it as one batch.
+    Binary payloads are decoded together and written as ordinary log rows to the
+    segmented log in directory. numpy and the decoder are imported by the writer
+    thread, off the startup path.
+    """
+
+    def __init__(self, directory, log=None):
+        self.directory = directory
+        # Every session starts a fresh trial log
+        shutil.rmtree(directory, ignore_errors=True)
+        self.segments = SegmentWriter(directory)
+        self.log = log or get_logger("ingest")
+        self.pending = deque()
+        self.last_seq = None
+        self.wakeup = threading.Event()
+        self.running = True
+        self.writer = threading.Thread(target=self.write_loop, name="TrialIngest", daemon=True)
+        self.writer.start()
+
+    def put(self, payload):
+        self.pending.append(payload)
+        self.wakeup.set()
+
+    def depth(self):
+        """ Payloads received but not yet written. """
+        return len(self.pending)
+
+    def drain(self):
+        from payload import is_binary
+        payloads = []
+        while self.pending:
+            payloads.append(self.pending.popleft())
+        rows = iter(self.decode([payload for payload in payloads if is_binary(payload)]))
+        lines = []
+        for payload in payloads:
+            line = next(rows) if is_binary(payload) else payload.strip() + b"\n"
+            if line is not None:
+                lines.append(line)
+        return lines
+
+    def decode(self, payloads):
+        """ Decodes binary payloads in one batch, with None for the ones that are dropped. """
+        import numpy as np
+        from payload import decode_payloads, format_rows, is_valid
+        valid = [is_valid(payload) for payload in payloads]
+        for payload, ok in zip(payloads, valid):
+            if not ok:
+                self.log.warning(f"Dropped unsupported binary payload ({len(payload)} bytes, version {payload[0]}).")
+        records, trials = decode_payloads([payload for payload, ok in zip(payloads, valid) if ok])
+        if len(records) == 0:
+            return [None] * len(payloads)
+
+        # Each seq is compared with the one before it, carried over from the previous batch
+        seq = records["seq"].astype(np.int64)
+        previous = np.concatenate([[seq[0] - 1 if self.last_seq is None else self.last_seq], seq[:-1]])
+        duplicate = seq == previous
+        for i in np.flatnonzero(seq > previous + 1):
+            self.log.warning(f"Missing {seq[i] - previous[i] - 1} trial(s) before seq {seq[i]}.")
+        for i in np.flatnonzero(seq < previous):
+            self.log.warning(f"Chamber restarted, seq went from {previous[i]} to {seq[i]}.")
+        self.last_seq = int(seq[-1])
+
+        if duplicate.any():
+            self.log.warning(f"Dropped {int(duplicate.sum())} duplicate trial(s).")
+        decoded = iter([None if dup else row for row, dup in zip(format_rows(trials), duplicate)])
+        return [next(decoded) if ok else None for ok in valid]
+
+    def write_loop(self):
+        # Loaded here at once, so the first trial does not wait for it
+        import payload  # noqa: F401
+        while self.running or self.pending:
+            self.wakeup.wait(timeout=1)
+            self.wakeup.clear()
+            lines = self.drain()
+            if not lines:
+                continue
+            self.segments.append(lines)
+            self.log.debug(f"Saved {len(lines)} trial(s) to {self.directory}.")
+
+    def close(self):
+        """ Writes everything still queued and stops the writer thread. Does nothing once closed. """
+        if not self.running:
+            return
+        self.running = False
+        self.wakeup.set()
+        self.writer.join()
+        self.segments.close()
@@ -0,0 +1,122 @@
+''' Non-blocking logging with per-mouse context, rate limiting and optional JSON files '''
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOGGER_NAME = "training"
+
+# Context attributes that loggers from get_logger add to their records
+CONTEXT_FIELDS = ["mouse_id", "chamber_id"]
+
+class ContextAdapter(logging.LoggerAdapter):
+    """ Adds the mouse and chamber to every record, merged with the extra of the call. """
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs.get("extra", {})}
+        return msg, kwargs
+
+class RateLimitFilter(logging.Filter):
+    """
+    Aggregates records logged with extra={"rate_limit": key}. The first record of a
+    key passes, later ones within `interval` seconds are only counted, and the next
+    record after the interval passes with the number suppressed in the meantime.
+    Records without a key always pass.
+    """
+
+    def __init__(self, interval=60):
+        super().__init__()
+        self.interval = interval
+        self.lock = threading.Lock()
+        # key -> (time the last record passed, records suppressed since)
+        self.keys = {}
+
+    def filter(self, record):
+        key = getattr(record, "rate_limit", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            last, suppressed = self.keys.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self.keys[key] = (last, suppressed + 1)
+                return False
+            self.keys[key] = (now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} more in the last {now - last:.0f} s)"
+        return True
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        context = " ".join(f"{field.split('_')[0]}={getattr(record, field)}" for field in CONTEXT_FIELDS
+                           if getattr(record, field, None) is not None)
+        record.context = f"[{context}] " if context else ""
+        return super().format(record)
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, with the context fields as keys. """
+
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class ExcInfoQueueHandler(logging.handlers.QueueHandler):
+    """ Queues records with their exception, which the base class folds into the message. """
+
+    def prepare(self, record):
+        # The listener's formatters place the traceback themselves, e.g. in the JSON "exception" key
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+_listener = None
+
+def setup_logging(level="INFO", json_file=None, max_bytes=10_000_000, backup_count=5, rate_limit_interval=60):
+    """
+    Routes the training loggers through a queue, so callers never wait on the terminal
+    or the disk. A listener thread writes to the console and, if json_file is given,
+    to a size-rotated JSON lines file.
+    """
+    global _listener
+    stop_logging()
+    console = logging.StreamHandler()
+    console.setFormatter(ConsoleFormatter("%(asctime)s %(levelname)-7s %(context)s%(message)s", "%H:%M:%S"))
+    handlers = [console]
+    if json_file:
+        file_handler = logging.handlers.RotatingFileHandler(json_file, maxBytes=max_bytes, backupCount=backup_count)
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    records = queue.SimpleQueue()
+    queue_handler = ExcInfoQueueHandler(records)
+    # Suppressed records are dropped before they are queued
+    queue_handler.addFilter(RateLimitFilter(rate_limit_interval))
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = [queue_handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """ Writes every queued record and stops the listener thread. """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def get_logger(name, mouse_id=None, chamber_id=None):
+    context = {"mouse_id": mouse_id, "chamber_id": chamber_id}
+    return ContextAdapter(logging.getLogger(f"{LOGGER_NAME}.{name}"), {k: v for k, v in context.items() if v is not None})
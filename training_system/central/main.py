@@ -1,24 +1,92 @@
+import time
+START_TIME = time.perf_counter()
+
 import argparse
-from watcher import start_watching
-from mqtt import initialize_network
+import os
+# Only paho is needed to reach the broker, heavier modules are imported once connected
+from mqtt import initialize_network, close_network
+from brokers import chamber_brokers, load_config
+from log import get_logger, setup_logging, stop_logging
 
 def main():
     parser = argparse.ArgumentParser(description="Initialize mouse training system.")
     parser.add_argument("--ip_address", type=str, default="192.168.0.135", help="IP of network.")
+    parser.add_argument("--brokers", type=str,
+                      help="JSON config mapping chambers to their primary and standby brokers, instead of --ip_address.")
     parser.add_argument("--mouse_id", type=str, required=True, help="ID of the mouse.")
+    parser.add_argument("--chamber_id", type=str, help="ID of the chamber's topics (mouse_<id> in its firmware), defaults to the mouse ID.")
     parser.add_argument("--stage", type=str, choices=["hab1", "hab2", "5csr", "5csr_citi_10", "5csr_citi_8", "5csr_citi_4", "5csr_citi_2", "5csr_viti", 
                       "rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", "rcpt_viti_15", "5cpt"], required=True, help="Current training stage.")
     parser.add_argument("--duration", type=int, required=False, default=10800, help="Duration of data collection.")
     parser.add_argument("--terminate_stage", type=str, choices=["hab1", "hab2", "5csr", "5csr_citi_10", "5csr_citi_8", "5csr_citi_4", "5csr_citi_2", "5csr_viti", 
                       "rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", "rcpt_viti_15", "5cpt"], help="Terminate at this stage.")
+    parser.add_argument("--threshold_latency", type=str, choices=["mean", "median", "p90"], default="mean", 
+                      help="Correct latency statistic used for stage thresholds.")
+    parser.add_argument("--db", type=str, default="training.db", help="SQLite store for session history, empty to disable.")
+    parser.add_argument("--cohort", type=str, help="Cohort the mouse belongs to.")
+    parser.add_argument("--dashboard", action="store_true", 
+                      help="Publish metrics for dashboard.py instead of rendering a plot per trial.")
+    parser.add_argument("--headless", action="store_true", help="Render plots with a non-interactive backend.")
+    parser.add_argument("--no_plots", action="store_true", help="Do not render a plot per trial.")
+    parser.add_argument("--report", action="store_true", help="Render a session summary report when the session ends.")
+    parser.add_argument("--export", type=str, help="Append the finished session to this Parquet dataset.")
+    parser.add_argument("--alert_command", type=str,
+                      help="Shell command run for every hardware alert, with the alert as JSON on stdin.")
+    parser.add_argument("--inactivity_timeout", type=float, default=10, help="Minutes without trials before alerting.")
+    parser.add_argument("--queue_policy", type=str, choices=["block", "drop", "shed"], default="block",
+                      help="What gives once --max_queue trials await processing: block reading them, drop plots and "
+                           "metric snapshots, or shed them to the trial log until the queue drains.")
+    parser.add_argument("--max_queue", type=int, default=50, help="Trials awaiting processing before the queue is overloaded.")
+    parser.add_argument("--capture", type=str,
+                      help="Record every MQTT message of the session to this file, for capture.py to replay.")
+    parser.add_argument("--log_level", type=str, choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                      help="Lowest level of the log lines shown.")
+    parser.add_argument("--log_file", type=str, help="Also write the log as JSON lines to this rotating file.")
     args = parser.parse_args()
+    setup_logging(args.log_level, args.log_file)
+    log = get_logger("main", args.mouse_id, args.chamber_id or args.mouse_id)
+    threshold_latency = {"mean": "Mean Correct Latency", "median": "Median Correct Latency", 
+                         "p90": "P90 Correct Latency"}[args.threshold_latency]
 
     # Create MQTT Topic with mouse_id and starting stage and create txt file
     # Subscribe to ESP32 topic to save to txt file
-    mqtt = initialize_network(args.mouse_id, args.stage, args.ip_address)
+    if args.headless:
+        # Must be set before matplotlib is first imported
+        os.environ["MPLBACKEND"] = "Agg"
+    brokers = chamber_brokers(load_config(args.brokers), args.chamber_id or args.mouse_id) if args.brokers else None
+    capture = None
+    if args.capture:
+        from capture import Capture
+        capture = Capture(args.capture)
+    mqtt = initialize_network(args.mouse_id, args.stage, args.ip_address, START_TIME, args.chamber_id, brokers,
+                              capture=capture)
+
+    import_start = time.perf_counter()
+    from watcher import start_watching
+    from store import TrialStore
+    from anomaly import command_hook
+    log.info(f"Loaded processing modules in {time.perf_counter() - import_start:.3f} s")
+
+    log.info(f"Monitoring trials for Mouse ID {args.mouse_id}, Stage {args.stage}...")
+    store = TrialStore(args.db) if args.db else None
+    start_watching(args.mouse_id, args.stage, args.duration, args.terminate_stage, mqtt, threshold_latency,
+                   store, args.cohort, args.dashboard, not args.no_plots,
+                   command_hook(args.alert_command) if args.alert_command else None, args.inactivity_timeout * 60,
+                   args.queue_policy, args.max_queue)
+    close_network(mqtt)
+    if store:
+        store.close()
+
+    if args.report:
+        from report import render_report
+        for file_path in render_report(f"mouse_{args.mouse_id}"):
+            log.info(f"Saved report: {file_path}")
 
-    print(f"Monitoring test.txt for Mouse ID {args.mouse_id}, Stage {args.stage}...")
-    start_watching(args.mouse_id, args.stage, args.duration, args.terminate_stage, mqtt)
+    if args.export:
+        from export import export_session
+        written = export_session(f"mouse_{args.mouse_id}", args.export)
+        log.info(f"Exported session to {len(written)} Parquet files in {args.export}")
+    stop_logging()
 
 if __name__ == "__main__":
     main()
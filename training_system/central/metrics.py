@@ -1,4 +1,12 @@
 ''' Cntains all possible metrics that are computed for Hab1, Hab2, 5 CSR, CPT'''
+import numpy as np
+
+STAGE_SEQUENCE = ["hab1", "hab2", "5csr_citi_10", "5csr_citi_8", 
+                  "5csr_citi_4", "5csr_citi_2", "5csr_viti", 
+                  "rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", 
+                  "rcpt_viti_15"]
+
+RCPT_STAGES = ["rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", "rcpt_viti_15"]
 
 def correct_perc(correct, incorrect):
     if(correct==0 and incorrect==0):
@@ -29,13 +37,101 @@ def hit_rate(correct, incorrect, omission):
         return 0
     return correct/(correct+incorrect+omission) * 100
 
-def sensitivity_index():
-    raise NotImplementedError
+def _z(p):
+    '''Inverse of the standard normal CDF (Acklam's approximation), works on scalars and arrays'''
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+         3.754408661907416e+00]
+    p = np.asarray(p, dtype=float)
+    # Tails use the same expression, mirrored for the upper tail
+    tail = np.minimum(p, 1 - p)
+    q = np.sqrt(-2 * np.log(np.clip(tail, 1e-300, 0.5)))
+    z_tail = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+             ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1)
+    z_tail = np.where(p > 0.5, -z_tail, z_tail)
+    r = (p - 0.5) ** 2
+    z_central = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5]) * (p - 0.5) / \
+                (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
+    z = np.where(tail < 0.02425, z_tail, z_central)
+    return z.item() if z.ndim == 0 else z
+
+def _corrected_rates(correct, incorrect, omission, c_wh, i_wh):
+    '''
+    Log-linear corrected hit and false alarm rates (0-1), so that rates of 0% or 100% stay finite.
+    Same formulas as hit_rate and false_alarm with 0.5 added to every count, on scalars and arrays
+    '''
+    hits = (correct + 0.5) / (correct + incorrect + omission + 1)
+    false_alarms = (i_wh + 0.5) / (c_wh + i_wh + 1)
+    return hits, false_alarms
+
+def sensitivity_index(correct, incorrect, omission, c_wh, i_wh):
+    '''d' = z(hit rate) - z(false alarm rate)'''
+    hits, false_alarms = _corrected_rates(correct, incorrect, omission, c_wh, i_wh)
+    return _z(hits) - _z(false_alarms)
     
-def responsivity_index():
-    raise NotImplementedError
+def responsivity_index(correct, incorrect, omission, c_wh, i_wh):
+    '''c = -(z(hit rate) + z(false alarm rate)) / 2, negative values mean a liberal responder'''
+    hits, false_alarms = _corrected_rates(correct, incorrect, omission, c_wh, i_wh)
+    return -(_z(hits) + _z(false_alarms)) / 2
+
+def signal_detection(correct, incorrect, omission, c_wh, i_wh):
+    '''Vectorized d' and c over arrays of counts, e.g. one entry per trial, session or mouse'''
+    counts = (np.asarray(x, dtype=float) for x in (correct, incorrect, omission, c_wh, i_wh))
+    hits, false_alarms = _corrected_rates(*counts)
+    z_hits, z_false_alarms = _z(hits), _z(false_alarms)
+    return z_hits - z_false_alarms, -(z_hits + z_false_alarms) / 2
+
+def rolling_signal_detection(trials, window=None):
+    '''
+    d' and c after every trial of an (N, 11) trial array, cumulative over the session,
+    or over the last `window` trials if given
+    '''
+    trials = np.atleast_2d(np.asarray(trials, dtype=float))
+    counts = np.cumsum(trials[:, [0, 1, 3, 4, 5]], axis=0)
+    if window is not None and window < len(counts):
+        counts[window:] = counts[window:] - counts[:-window]
+    return signal_detection(*counts.T)
+
+def response_counts(stage, trials):
+    '''
+    Responses counted towards the "Count" threshold, one entry per trial of a single
+    trial or an (N, 11) trial array.
+    Hab1 counts rewards collected, Hab2 counts rewarded touches and rCPT counts
+    correct go trials plus successful withholds on no-go trials.
+    '''
+    trials = np.atleast_2d(trials)
+    if stage == "hab1":
+        return (trials[:, 8] > 0).astype(int)
+    elif stage == "hab2":
+        return ((trials[:, 8] > 0) & (trials[:, 0] > 0)).astype(int)
+    elif stage in RCPT_STAGES:
+        go_trial = (trials[:, 4] == 0) & (trials[:, 5] == 0)
+        return np.where(go_trial, trials[:, 0] > 0, trials[:, 4] > 0).astype(int)
+    return np.zeros(len(trials), dtype=int)
+
+def trial_latencies(trials):
+    '''
+    Latencies of a single trial or an (N, 11) trial array by type ("Correct", "Incorrect",
+    "Reward", "Premature"), each only over the trials where it was measured.
+    No-go (inhibition) trials carry the premature latency in column 8 and the reward
+    latency in column 9, go trials carry the reward latency in column 8.
+    '''
+    trials = np.atleast_2d(trials)
+    nogo = (trials[:, 4] > 0) | (trials[:, 5] > 0)
+    reward = np.where(nogo, trials[:, 9], trials[:, 8])
+    premature = np.where(nogo, trials[:, 8], trials[:, 9])
+    return {"Correct": trials[trials[:, 0] > 0, 6],
+            "Incorrect": trials[trials[:, 1] > 0, 7],
+            "Reward": reward[reward > 0],
+            "Premature": premature[(trials[:, 2] > 0) | (trials[:, 5] > 0)]}
 
-def compute_threshold(task, metrics):
+def compute_threshold(task, metrics, latency="Mean Correct Latency"):
+    '''latency selects the correct latency statistic, e.g. "Median Correct Latency"'''
     if task == "hab1":
         '''Requires 30 or more responses within 2 days'''
         if(metrics["Count"] >= 30):
@@ -52,7 +148,7 @@ def compute_threshold(task, metrics):
         
     elif task == "5csr_citi_10":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Correct"] >= 30) & (metrics["Mean Correct Latency"] < 5000):
+        if(metrics["Correct"] >= 30) & (metrics[latency] < 5000):
             return True
         else:
             return False
@@ -60,49 +156,49 @@ def compute_threshold(task, metrics):
 
     elif task == "5csr_citi_8":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Correct"] >= 30) & (metrics["Mean Correct Latency"] < 4000):
+        if(metrics["Correct"] >= 30) & (metrics[latency] < 4000):
             return True
         else:
             return False
     
     elif task == "5csr_citi_4":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Correct"] >= 30) & (metrics["Mean Correct Latency"] < 2000):
+        if(metrics["Correct"] >= 30) & (metrics[latency] < 2000):
             return True
         else:
             return False
     
     elif task == "5csr_citi_2" or "5csr_viti":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Correct"] >= 30) & (metrics["Mean Correct Latency"] < 1500):
+        if(metrics["Correct"] >= 30) & (metrics[latency] < 1500):
             return True
         else:
             return False
     
     elif task == "rcpt_viti_2_to_1":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Count"] >= 30) & (metrics["Mean Correct Latency"] < 1500):
+        if(metrics["Count"] >= 30) & (metrics[latency] < 1500):
             return True
         else:
             return False
         
     elif task == "rcpt_viti_2":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Count"] >= 30) & (metrics["Mean Correct Latency"] < 1500):
+        if(metrics["Count"] >= 30) & (metrics[latency] < 1500):
             return True
         else:
             return False
     
     elif task == "rcpt_viti_175":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Count"] >= 30) & (metrics["Mean Correct Latency"] < 1500):
+        if(metrics["Count"] >= 30) & (metrics[latency] < 1500):
             return True
         else:
             return False
     
     elif task == "rcpt_viti_15":
         '''30 correct respones + MCL of less than half of stim duration'''
-        if(metrics["Count"] >= 30) & (metrics["Mean Correct Latency"] < 1500):
+        if(metrics["Count"] >= 30) & (metrics[latency] < 1500):
             return True
         else:
             return False
\ No newline at end of file
@@ -1,46 +1,112 @@
-import paho.mqtt.client as mqtt
 import threading
+import time
+import uuid
+from brokers import BrokerPool
+from outbox import Outbox
+from ingest import TrialIngest
+from log import get_logger
+from heartbeat import ALIVE, Heartbeat
 
-def initialize_network(mouse_id, stage, ip):
+# Pending stage commands are resent if the chamber keeps pinging this long after
+# they were sent. A chamber running a trial does not ping, so an idle chamber that
+# still pings has not received its command. A resend carries the command's id, so
+# the firmware ignores it if the broker also redelivers the original.
+RESEND_AFTER = 2
+
+def initialize_network(mouse_id, stage, ip, start_time=None, chamber_id=None, brokers=None, report_interval=600,
+                       capture=None):
     """
-    Initializes the MQTT client, subscribes to topics, and publishes the stage.
+    Initializes the MQTT clients, subscribes to topics, and publishes the stage.
     Waits for a 'ping' confirmation before publishing the stage.
-    """
-    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    If start_time (time.perf_counter()) is given, the time until the first
+    subscription is acknowledged is reported.
 
-    # Set up userdata with mouse_id.
-    mqttc.user_data_set({'mouse_id': mouse_id})
-    mqttc.on_connect = on_connect
-    mqttc.on_message = on_message
+    Topics belong to the chamber, named mouse_<chamber_id> as in the firmware, while
+    trials are saved for mouse_id. chamber_id defaults to mouse_id.
 
-    # Connect to the broker.
-    mqttc.connect(ip, 1883, 60)
-    
-    # Start the network loop in a background thread.
-    mqttc.loop_start()
+    brokers lists the (name, address) of the chamber's brokers, primary first, as
+    returned by brokers.chamber_brokers. Without it, the only broker is ip.
+    Every broker's client keeps a persistent session, so the broker holds QoS 1
+    messages for it while it is disconnected, and reconnects and resubscribes on
+    its own. The throughput of every broker is logged every report_interval seconds.
+    Every message received and published is recorded to capture (a capture.Capture), if given.
+    """
+    chamber_id = chamber_id or mouse_id
+    log = get_logger("mqtt", mouse_id, chamber_id)
+    heartbeat = Heartbeat(on_change=lambda chamber, old, new, stats: log_liveness(log, old, new, stats))
+    userdata = {
+        'mouse_id': mouse_id,
+        'chamber_id': chamber_id,
+        'start_time': start_time,
+        'outbox': Outbox(f"outbox_mouse_{chamber_id}.jsonl"),
+        'ingest': TrialIngest(f"mouse_{mouse_id}/trials", get_logger("ingest", mouse_id, chamber_id)),
+        'log': log,
+        'heartbeat': heartbeat,
+    }
+    mqttc = BrokerPool(brokers or [(ip, ip)], f"central_mouse_{chamber_id}", userdata, on_connect, on_disconnect,
+                       on_subscribe, on_message,
+                       on_failover=lambda old, new: log.warning(f"Chamber moved from broker {old} to {new}."),
+                       capture=capture)
 
-    # Subscribe to topics.
-    mqttc.subscribe(f"mouse_{mouse_id}/data")
-    mqttc.subscribe(f"mouse_{mouse_id}/request")
+    # Start the network loops in background threads.
+    mqttc.loop_start()
+    mqttc.start(report_interval, lambda stats: log_throughput(log, stats))
+    heartbeat.start()
 
     # Wait for a ping before publishing the stage.
     if wait_for_ping(mqttc, timeout=100):
-        mqttc.publish(f"mouse_{mouse_id}/stage", stage)
-        print(f"Published stage '{stage}' after receiving ping.")
+        publish_stage(mqttc, stage)
+        log.info(f"Published stage '{stage}' after receiving ping.")
     else:
-        print("Timeout waiting for ping. Stage not published during initialization.")
+        log.warning("Timeout waiting for ping. Stage not published during initialization.")
 
     return mqttc
 
+def close_network(client):
+    """ Stops the network loops and flushes queued trials to disk. """
+    client.close()
+    userdata = client.user_data_get()
+    userdata['heartbeat'].stop()
+    userdata['ingest'].close()
+    userdata['outbox'].close()
+
+def log_throughput(log, stats):
+    for name, broker in stats.items():
+        log.info(f"Broker {name} ({'connected' if broker['connected'] else 'down'}): "
+                 f"{broker['in_rate']:.1f} messages/s in, {broker['out_rate']:.1f} out")
+
+def log_liveness(log, old, new, stats):
+    """ Reports a chamber going silent as soon as the heartbeat notices, instead of after a ping timeout. """
+    rtt = "-" if stats["last_rtt"] is None else f"{stats['last_rtt']:.1f} s"
+    message = f"Chamber {old} -> {new}, silent for {stats['silence'] or 0:.1f} s (last stage-to-trial round trip {rtt})"
+    if new == ALIVE:
+        log.info(message)
+    else:
+        log.warning(message)
+
+def publish_stage(client, stage):
+    """
+    Publishes a stage command through the outbox, so it is resent until the chamber runs it.
+    The command is "<stage> <id>", and the firmware runs a given id only once.
+    """
+    userdata = client.user_data_get()
+    topic = f"mouse_{userdata['chamber_id']}/stage"
+    payload = f"{stage} {uuid.uuid4().hex[:8]}"
+    userdata['stage_published'] = True
+    userdata['outbox'].add(topic, payload)
+    userdata['heartbeat'].stage_sent(userdata['chamber_id'])
+    client.publish(topic, payload, qos=1)
+
 def wait_for_ping(client, timeout=10):
     ping_event = threading.Event()
-    userdata = client._userdata
+    userdata = client.user_data_get()
     userdata['ping_event'] = ping_event
     userdata['waiting_for_ping'] = True  # Set the flag indicating we are waiting for a ping
 
-    print("Waiting for ping on request topic before publishing stage...")
+    userdata['log'].debug("Waiting for ping on request topic before publishing stage...")
     received = ping_event.wait(timeout)
-    print("Ping received!" if received else "Ping wait timed out.")
+    if not received:
+        userdata['log'].warning("Ping wait timed out.")
 
     # Clean up: remove both the ping event and waiting flag
     userdata.pop('waiting_for_ping', None)
@@ -49,24 +115,55 @@ def wait_for_ping(client, timeout=10):
 
 
 def on_connect(client, userdata, flags, reason_code, properties):
-    print(f"Connected with result code {reason_code}")
+    userdata['log'].info(f"Connected to {client.host}:{client.port} with result code {reason_code}, "
+                         f"session present: {flags.session_present}")
+    chamber_id = userdata['chamber_id']
+    # Subscribing again is harmless if the broker kept the session, and required if it did not
+    client.subscribe([(f"mouse_{chamber_id}/data", 1), (f"mouse_{chamber_id}/request", 0)])
+
+def on_disconnect(client, userdata, flags, reason_code, properties):
+    if reason_code.is_failure:
+        userdata['log'].warning(f"Disconnected from {client.host}:{client.port} with result code {reason_code}, reconnecting...")
+    else:
+        userdata['log'].info(f"Disconnected from {client.host}:{client.port}.")
+
+def on_subscribe(client, userdata, mid, reason_code_list, properties):
+    start_time = userdata.pop('start_time', None)
+    if start_time is not None:
+        userdata['log'].info(f"Time to first subscribe: {time.perf_counter() - start_time:.3f} s")
 
 def on_message(client, userdata, msg):
-    payload_str = msg.payload.decode('utf-8')
-    mouse_id = userdata.get('mouse_id', 'default')
-    print(f"Received on {msg.topic}: {payload_str}")
+    chamber_id = userdata.get('chamber_id', 'default')
+    log = userdata['log']
 
-    if msg.topic == f"mouse_{mouse_id}/request" and payload_str == 'ping':
+    if msg.topic == f"mouse_{chamber_id}/request" and msg.payload == b'ping':
+        userdata['heartbeat'].ping(chamber_id)
+        # One line per minute with the number of pings, instead of one every 500 ms
+        log.info(f"Ping on {msg.topic}", extra={"rate_limit": msg.topic})
         # Only react if we are explicitly waiting for a ping
         if userdata.get('waiting_for_ping', False):
             ping_event = userdata.get('ping_event')
             if ping_event:
                 ping_event.set()
-                print("Ping processed for waiting event!")
+                log.debug("Ping processed for waiting event!")
+        elif userdata.get('stage_published'):
+            # A new command is about to be published while waiting, so only resend otherwise.
+            # Before this session's first command, a pending one is the previous session's.
+            for topic, payload in userdata['outbox'].due(RESEND_AFTER):
+                client.publish(topic, payload, qos=1)
+                log.warning(f"Resent unanswered command '{payload}' on {topic}.")
+    elif not userdata.get('stage_published'):
+        # Left over from the previous session in this chamber, either queued by the broker for
+        # the persistent session or run across the handover. It answers none of our commands.
+        log.warning(f"Dropped a trial on {msg.topic} received before this session's first stage command.")
     else:
-        # Save any non-ping messages to a file.
-        filename = f"mouse_{mouse_id}/mouse_{mouse_id}.txt"
-        with open(filename, "a") as file:
-            file.write(payload_str + "\n")
-        print(f"Data saved to {filename}.")
-
+        # Already loaded by the ingest writer thread, and kept off the startup path
+        from payload import is_binary
+        if is_binary(msg.payload):
+            log.debug(f"Received on {msg.topic}: {len(msg.payload)} byte binary trial")
+        else:
+            log.debug(f"Received on {msg.topic}: {msg.payload.decode('utf-8', errors='replace')}")
+        # A trial answers the last stage command, then goes to the trial log.
+        userdata['heartbeat'].trial(chamber_id)
+        userdata['outbox'].ack(f"mouse_{chamber_id}/stage")
+        userdata['ingest'].put(msg.payload)
@@ -0,0 +1,82 @@
+''' Durable write-ahead outbox for the stage commands sent to the chambers '''
+import json
+import os
+import threading
+import time
+
+class Outbox:
+    """
+    Every command is appended and fsynced before it is published, and stays pending
+    until the chamber answers with a trial. The firmware runs exactly one trial per
+    stage command, so a lost command would otherwise stall the chamber for good.
+    Stage commands supersede each other, so only the latest one per topic is kept.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_seq = 1
+        self.load()
+
+    def load(self):
+        """ Rebuilds the pending commands of a previous run and compacts the file. """
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-write
+                        continue
+                    if "ack" in record:
+                        self.pending.pop(record["ack"], None)
+                    else:
+                        self.pending[record["seq"]] = record
+                    self.next_seq = max(self.next_seq, record.get("seq", record.get("ack", 0)) + 1)
+        self.file = open(self.path, "w")
+        for record in self.pending.values():
+            self.append(record)
+
+    def append(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, topic, payload):
+        """ Records a command before it is published and returns its sequence number. """
+        with self.lock:
+            for seq in [seq for seq, record in self.pending.items() if record["topic"] == topic]:
+                self.pending.pop(seq)
+            record = {"seq": self.next_seq, "topic": topic, "payload": payload, "time": time.time()}
+            self.next_seq += 1
+            self.pending[record["seq"]] = record
+            self.append(record)
+            return record["seq"]
+
+    def ack(self, topic):
+        """ Marks every pending command on topic as answered. """
+        with self.lock:
+            acked = [seq for seq, record in self.pending.items() if record["topic"] == topic]
+            for seq in acked:
+                self.pending.pop(seq)
+            if not self.pending:
+                # Nothing left to recover, start the log over
+                self.file.seek(0)
+                self.file.truncate()
+            else:
+                for seq in acked:
+                    self.append({"ack": seq})
+
+    def due(self, age):
+        """ Returns the pending commands sent more than age seconds ago and restarts their clock. """
+        now = time.time()
+        with self.lock:
+            records = [record for record in self.pending.values() if now - record["time"] > age]
+            for record in records:
+                record["time"] = now
+            return [(record["topic"], record["payload"]) for record in records]
+
+    def close(self):
+        with self.lock:
+            self.file.close()
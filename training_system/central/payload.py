@@ -0,0 +1,49 @@
+''' Binary trial payload sent by the chambers, and its batched decoding '''
+import io
+import numpy as np
+
+# Leading byte of every binary payload. ASCII payloads start with a digit, so the two never collide.
+PAYLOAD_VERSION = 1
+
+# Little-endian, 36 bytes, mirrors TrialPayload in the firmware.
+# outcomes and latencies are the trial row, in TRIAL_COLUMNS order.
+TRIAL_DTYPE = np.dtype([
+    ("version", "u1"),
+    ("outcomes", "u1", (6,)),
+    ("reserved", "u1"),
+    ("seq", "<u4"),
+    ("device_ms", "<u4"),
+    ("latencies", "<u4", (5,)),
+])
+
+def is_binary(payload):
+    """ Binary payloads start with a version byte, which is never a printable character. """
+    return len(payload) > 0 and payload[0] < 0x20
+
+def is_valid(payload):
+    return len(payload) == TRIAL_DTYPE.itemsize and payload[0] == PAYLOAD_VERSION
+
+def decode_payloads(payloads):
+    """
+    Decodes valid binary payloads with a single numpy.frombuffer call.
+    Returns the structured records, for seq and device_ms, and the trial rows.
+    """
+    records = np.frombuffer(b"".join(payloads), dtype=TRIAL_DTYPE)
+    trials = np.hstack([records["outcomes"], records["latencies"]]).astype(np.int64)
+    return records, trials
+
+def encode_trial(row, seq, device_ms=0):
+    """ Packs one trial row the way the firmware does, for tools and simulated chambers. """
+    record = np.zeros(1, dtype=TRIAL_DTYPE)
+    record["version"] = PAYLOAD_VERSION
+    record["outcomes"] = row[:6]
+    record["seq"] = seq
+    record["device_ms"] = device_ms
+    record["latencies"] = row[6:11]
+    return record.tobytes()
+
+def format_rows(trials):
+    """ Formats trial rows as lines of the trial log. """
+    buffer = io.BytesIO()
+    np.savetxt(buffer, trials, fmt="%d")
+    return buffer.getvalue().splitlines(keepends=True)
@@ -0,0 +1,180 @@
+''' Renders one summary figure per session from its stored trial log '''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from metrics import response_counts, rolling_signal_detection, trial_latencies
+from triallog import load_mouse_trials, mouse_id_from_dir, resolve_mouse_dirs, session_label, stage_segments
+
+OUTCOMES = [("Correct", 0, "blue"), ("Incorrect", 1, "red"), ("Premature", 2, "purple"),
+            ("Omission", 3, "orange"), ("Correct Withholding", 4, "teal"), ("Incorrect Withholding", 5, "gray")]
+
+LATENCIES = [("Correct", "blue"), ("Incorrect", "red"), ("Reward", "seagreen"), ("Premature", "purple")]
+
+def rolling_mean(values, window):
+    """ Mean over the last `window` entries (fewer at the start), for every entry. """
+    sums = np.cumsum(values, dtype=float)
+    sums[window:] = sums[window:] - sums[:-window]
+    return sums / np.minimum(np.arange(1, len(values) + 1), window)
+
+def session_series(trials, segments, window):
+    """ Every series of the report, computed once over the whole trial array. """
+    correct_per_stage = np.zeros(len(trials))
+    count = np.zeros(len(trials))
+    for stage, start, stop in segments:
+        # Correct and Count restart with every stage, as they do in the watcher
+        correct_per_stage[start:stop] = np.cumsum(trials[start:stop, 0])
+        count[start:stop] = np.cumsum(response_counts(stage, trials[start:stop]))
+    go_trials = trials[:, [0, 1, 3]].sum(axis=1)
+    hits = rolling_mean(trials[:, 0], window)
+    go = rolling_mean(go_trials, window)
+    sensitivity, _ = rolling_signal_detection(trials, window)
+    correct = trials[:, 0] > 0
+    correct_latency = np.where(correct, trials[:, 6], np.nan)
+    rolling_correct_latency = np.divide(rolling_mean(np.where(correct, trials[:, 6], 0), window),
+                                        rolling_mean(correct, window),
+                                        out=np.full(len(trials), np.nan), where=rolling_mean(correct, window) > 0)
+    return {
+        "trial": np.arange(1, len(trials) + 1),
+        "correct": correct_per_stage,
+        "count": count,
+        "rolling_hit_rate": np.divide(100 * hits, go, out=np.zeros(len(trials)), where=go > 0),
+        "rolling_sensitivity": sensitivity,
+        "correct_latency": correct_latency,
+        "rolling_correct_latency": rolling_correct_latency,
+        "outcome": np.argmax(trials[:, :6] > 0, axis=1),
+        "has_outcome": (trials[:, :6] > 0).any(axis=1),
+    }
+
+def mark_transitions(ax, segments):
+    for stage, start, stop in segments:
+        ax.axvline(start + 0.5, color="black", linestyle="--", linewidth=0.8)
+        ax.text(start + 1, 1.0, stage, transform=ax.get_xaxis_transform(), fontsize=7, va="bottom", rotation=0)
+
+def render_figure(title, trials, segments, window, file_path):
+    """ Draws every panel for the given trials, with segments as (stage, start, stop) row ranges. """
+    series = session_series(trials, segments, window)
+    x = series["trial"]
+
+    fig, axes = plt.subplots(3, 2, figsize=(14, 11), constrained_layout=True)
+    fig.suptitle(f"{title} ({len(trials)} trials)")
+
+    ax = axes[0, 0]
+    ax.plot(x, series["correct"], color="blue", label="Correct (per stage)")
+    ax.plot(x, series["count"], color="seagreen", label="Count (per stage)")
+    ax.axhline(30, color="gray", linestyle=":", linewidth=0.8)
+    ax.set_title("Learning curve", pad=14)
+    ax.set_xlabel("Trial")
+    ax.legend(fontsize=8)
+    mark_transitions(ax, segments)
+
+    ax = axes[0, 1]
+    ax.plot(x, series["rolling_hit_rate"], color="blue")
+    ax.set_ylim(0, 100)
+    ax.set_ylabel("Hit rate (%)")
+    ax.set_xlabel("Trial")
+    ax.set_title(f"Rolling hit rate and d' ({window} trials)", pad=14)
+    ax_sensitivity = ax.twinx()
+    ax_sensitivity.plot(x, series["rolling_sensitivity"], color="darkred", linewidth=0.8)
+    ax_sensitivity.set_ylabel("d'", color="darkred")
+    mark_transitions(ax, segments)
+
+    ax = axes[1, 0]
+    ax.scatter(x, series["correct_latency"], s=6, color="blue", alpha=0.5, label="Correct latency")
+    ax.plot(x, series["rolling_correct_latency"], color="black", label=f"Rolling mean ({window} trials)")
+    ax.set_title("Correct latency over time", pad=14)
+    ax.set_xlabel("Trial")
+    ax.set_ylabel("Latency (ms)")
+    ax.legend(fontsize=8)
+    mark_transitions(ax, segments)
+
+    ax = axes[1, 1]
+    for name, column, color in OUTCOMES:
+        selected = series["has_outcome"] & (series["outcome"] == column)
+        ax.vlines(x[selected], column, column + 0.8, color=color, linewidth=1)
+    ax.set_yticks([column + 0.4 for _, column, _ in OUTCOMES])
+    ax.set_yticklabels([name for name, _, _ in OUTCOMES], fontsize=8)
+    ax.set_xlabel("Trial")
+    ax.set_title("Trial outcomes", pad=14)
+    mark_transitions(ax, segments)
+
+    ax = axes[2, 0]
+    latencies_by_type = trial_latencies(trials)
+    for name, color in LATENCIES:
+        latencies = latencies_by_type[name]
+        if len(latencies):
+            ax.hist(latencies, bins=30, alpha=0.5, color=color, label=f"{name} (n={len(latencies)})")
+    ax.set_title("Latency distributions")
+    ax.set_xlabel("Latency (ms)")
+    ax.legend(fontsize=8)
+
+    ax = axes[2, 1]
+    ax.axis("off")
+    table = ax.table(
+        cellText=[[stage, stop - start, int(trials[start:stop, 0].sum())] for stage, start, stop in segments],
+        colLabels=["Stage", "Trials", "Correct"],
+        loc="center"
+    )
+    table.auto_set_font_size(False)
+    table.set_fontsize(10)
+    ax.set_title("Stage transitions")
+
+    fig.savefig(file_path, bbox_inches="tight")
+    plt.close(fig)
+    return file_path
+
+def render_report(mouse_dir, output=None, window=20, per_stage=True):
+    """
+    Renders the summary figure of one mouse_<id> directory and, unless per_stage is
+    unset, one figure per stage. Returns the paths of the saved figures.
+    """
+    mouse_id = mouse_id_from_dir(mouse_dir)
+    trials = load_mouse_trials(mouse_dir)
+    if len(trials) == 0:
+        return []
+    segments = stage_segments(mouse_dir, len(trials)) or [("unknown", 0, len(trials))]
+
+    # Reports of several sessions can share an output folder, so name them by session there
+    if output:
+        folder_path, name = output, f"report_mouse_{mouse_id}_{session_label(mouse_dir)}"
+    else:
+        folder_path, name = mouse_dir, f"report_mouse_{mouse_id}"
+    os.makedirs(folder_path, exist_ok=True)
+
+    file_paths = [render_figure(f"Mouse {mouse_id} - session summary", trials, segments, window,
+                                os.path.join(folder_path, f"{name}.png"))]
+    if per_stage:
+        for stage, start, stop in segments:
+            if stop > start:
+                file_paths.append(render_figure(f"Mouse {mouse_id} - {stage}", trials[start:stop],
+                                                [(stage, 0, stop - start)], window,
+                                                os.path.join(folder_path, f"{name}_{stage}.png")))
+    return file_paths
+
+def render_reports(mouse_dirs, output=None, window=20, per_stage=True, workers=None):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_report, mouse_dir, output, window, per_stage) for mouse_dir in mouse_dirs]
+        return [future.result() for future in futures]
+
+def main():
+    parser = argparse.ArgumentParser(description="Render session summary reports from stored trial logs.")
+    parser.add_argument("paths", type=str, nargs="+", help="mouse_<id> directories, or directories to search for them.")
+    parser.add_argument("--output", type=str, help="Directory for the reports, defaults to each mouse directory.")
+    parser.add_argument("--window", type=int, default=20, help="Trials in the rolling windows.")
+    parser.add_argument("--summary_only", action="store_true", help="Skip the figures of the individual stages.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes.")
+    args = parser.parse_args()
+
+    mouse_dirs = resolve_mouse_dirs(args.paths)
+    reports = render_reports(mouse_dirs, args.output, args.window, not args.summary_only, args.workers)
+    for mouse_dir, file_paths in zip(mouse_dirs, reports):
+        if not file_paths:
+            print(f"No trials in {mouse_dir}")
+        for file_path in file_paths:
+            print(f"Saved report: {file_path}")
+
+if __name__ == "__main__":
+    main()
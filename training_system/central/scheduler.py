@@ -0,0 +1,170 @@
+''' Assigns the mice of a cohort to free chambers and rotates them between sessions '''
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+from metrics import STAGE_SEQUENCE
+from store import TrialStore
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+class Scheduler:
+    """
+    Keeps every chamber busy with one main.py session at a time. Mice wait in a
+    queue and start each session from the stage the store last recorded for them.
+    A chamber is given the next mouse as soon as its session ends, either after
+    its duration or once the mouse reaches the terminate stage, at which point the
+    mouse leaves the queue for good.
+    """
+
+    def __init__(self, chambers, mice, store, duration, terminate=None, start_stage="hab1", rest=0,
+                 main_args=(), log_dir="scheduler_logs"):
+        self.store = store
+        self.duration = duration
+        self.terminate = terminate
+        self.start_stage = start_stage
+        self.rest = rest
+        self.main_args = list(main_args)
+        self.log_dir = log_dir
+        self.started_at = time.time()
+        # Running session of each chamber, None while the chamber is free
+        self.running = {chamber: None for chamber in chambers}
+        self.idle_since = {chamber: self.started_at for chamber in chambers}
+        self.idle = {chamber: 0.0 for chamber in chambers}
+        # (mouse_id, time from which it may start its next session)
+        self.queue = [(mouse_id, 0.0) for mouse_id in mice]
+        self.finished = []
+        self.sessions = []
+
+    def stage_for(self, mouse_id):
+        return self.store.latest_stage(mouse_id) or self.start_stage
+
+    def next_mouse(self, now):
+        """ Takes the first mouse of the queue that is ready and has not reached the terminate stage. """
+        for i, (mouse_id, ready_at) in enumerate(self.queue):
+            if ready_at > now:
+                continue
+            self.queue.pop(i)
+            stage = self.stage_for(mouse_id)
+            if stage == self.terminate:
+                print(f"Mouse {mouse_id} already reached {stage}.")
+                self.finished.append(mouse_id)
+                return self.next_mouse(now)
+            return mouse_id, stage
+        return None
+
+    def start(self, chamber, mouse_id, stage, now):
+        os.makedirs(self.log_dir, exist_ok=True)
+        log_path = os.path.join(self.log_dir, f"mouse_{mouse_id}_chamber_{chamber}_{time.strftime('%Y%m%d_%H%M%S')}.log")
+        command = [sys.executable, MAIN, "--mouse_id", mouse_id, "--chamber_id", chamber, "--stage", stage,
+                   "--duration", str(self.duration)] + self.main_args
+        if self.terminate:
+            command += ["--terminate_stage", self.terminate]
+        log = open(log_path, "w")
+        # Own process group, so a Ctrl-C reaches the sessions only through stop()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.running[chamber] = {"mouse_id": mouse_id, "stage": stage, "process": process, "log": log, "started_at": now}
+        self.idle[chamber] += now - self.idle_since[chamber]
+        print(f"Chamber {chamber}: started mouse {mouse_id} at {stage} (log {log_path}).")
+
+    def finish(self, chamber, now):
+        session = self.running[chamber]
+        session["log"].close()
+        self.running[chamber] = None
+        self.idle_since[chamber] = now
+        mouse_id = session["mouse_id"]
+        stage = self.stage_for(mouse_id)
+        returncode = session["process"].returncode
+        self.sessions.append({"chamber": chamber, "mouse_id": mouse_id, "from_stage": session["stage"], "to_stage": stage,
+                              "started_at": session["started_at"], "ended_at": now, "returncode": returncode})
+        if returncode != 0:
+            print(f"Warning: session of mouse {mouse_id} in chamber {chamber} exited with code {returncode}.")
+        if stage == self.terminate:
+            print(f"Chamber {chamber}: mouse {mouse_id} reached {stage} and leaves the queue.")
+            self.finished.append(mouse_id)
+        else:
+            print(f"Chamber {chamber}: session of mouse {mouse_id} ended at {stage}.")
+            self.queue.append((mouse_id, now + self.rest))
+
+    def step(self):
+        """ Collects ended sessions, then gives every free chamber the next ready mouse. """
+        now = time.time()
+        for chamber, session in self.running.items():
+            if session and session["process"].poll() is not None:
+                self.finish(chamber, now)
+        for chamber, session in self.running.items():
+            if session is None:
+                selected = self.next_mouse(now)
+                if selected is None:
+                    break
+                self.start(chamber, *selected, now)
+
+    def done(self):
+        return not self.queue and all(session is None for session in self.running.values())
+
+    def report(self):
+        """ Prints the idle time of every chamber and the session throughput so far. """
+        now = time.time()
+        elapsed = max(now - self.started_at, 1e-9)
+        print(f"{'Chamber':<10}{'Sessions':>10}{'Idle (h)':>12}{'Utilization':>14}")
+        for chamber, session in self.running.items():
+            idle = self.idle[chamber] + (now - self.idle_since[chamber] if session is None else 0)
+            sessions = sum(1 for record in self.sessions if record["chamber"] == chamber)
+            print(f"{chamber:<10}{sessions:>10}{idle / 3600:>12.2f}{100 * (1 - idle / elapsed):>13.1f}%")
+        print(f"{len(self.sessions)} sessions in {elapsed / 3600:.2f} h, {len(self.sessions) / (elapsed / 86400):.1f} sessions/day, "
+              f"{len(self.queue)} mice queued, {len(self.finished)} finished")
+
+    def stop(self):
+        """ Interrupts the running sessions, which end them the same way as a keyboard interrupt. """
+        for chamber, session in self.running.items():
+            if session:
+                session["process"].send_signal(signal.SIGINT)
+        for chamber, session in self.running.items():
+            if session:
+                session["process"].wait()
+                self.finish(chamber, time.time())
+
+    def run(self, poll_interval=5, report_interval=3600):
+        last_report = time.time()
+        try:
+            while not self.done():
+                self.step()
+                if time.time() - last_report >= report_interval:
+                    self.report()
+                    last_report = time.time()
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("Scheduler stopped, ending running sessions...")
+            self.stop()
+        self.report()
+
+def main():
+    parser = argparse.ArgumentParser(description="Schedule the mice of a cohort across a pool of chambers. "
+                                                 "Arguments after -- are passed on to main.py.")
+    parser.add_argument("--chambers", type=str, nargs="+", required=True, help="Chamber IDs (mouse_<id> in their firmware).")
+    parser.add_argument("--mice", type=str, nargs="+", required=True, help="Mouse IDs, in queue order.")
+    parser.add_argument("--duration", type=int, default=10800, help="Duration of each session in seconds.")
+    parser.add_argument("--terminate_stage", type=str, choices=STAGE_SEQUENCE, help="Mice leave the queue at this stage.")
+    parser.add_argument("--start_stage", type=str, choices=STAGE_SEQUENCE, default="hab1", help="Stage of mice without history.")
+    parser.add_argument("--rest", type=float, default=0, help="Minimum hours between two sessions of the same mouse.")
+    parser.add_argument("--ip_address", type=str, default="192.168.0.135", help="IP of network.")
+    parser.add_argument("--db", type=str, default="training.db", help="SQLite store the sessions record their stages in.")
+    parser.add_argument("--cohort", type=str, help="Cohort the mice belong to.")
+    parser.add_argument("--log_dir", type=str, default="scheduler_logs", help="Directory for the output of every session.")
+    parser.add_argument("--poll_interval", type=float, default=5, help="Seconds between checks for ended sessions.")
+    parser.add_argument("--report_interval", type=float, default=1, help="Hours between utilization reports.")
+    args, main_args = parser.parse_known_args()
+    main_args = [arg for arg in main_args if arg != "--"] + ["--ip_address", args.ip_address, "--db", args.db]
+    if args.cohort:
+        main_args += ["--cohort", args.cohort]
+
+    store = TrialStore(args.db)
+    scheduler = Scheduler(args.chambers, args.mice, store, args.duration, args.terminate_stage, args.start_stage,
+                          args.rest * 3600, main_args, args.log_dir)
+    scheduler.run(args.poll_interval, args.report_interval * 3600)
+    store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+''' Trial log written in rotated segments, compressed once closed, with a sparse index for random access '''
+import argparse
+import bisect
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+
+INDEX_NAME = "index.jsonl"
+
+def segment_path(directory, segment, compressed=False):
+    return os.path.join(directory, f"{segment:06d}.txt" + (".gz" if compressed else ""))
+
+def load_index(directory):
+    """
+    Returns the index entries, ordered by trial, and the gzip member offsets of
+    every compressed segment. An entry {"segment", "trial", "time", "offset"} says
+    that the trial numbered "trial" (from 0) was appended at "time" and starts at
+    byte "offset" of its segment.
+    """
+    entries, members = [], {}
+    path = os.path.join(directory, INDEX_NAME)
+    if not os.path.exists(path):
+        return entries, members
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash mid-write
+                continue
+            if "members" in record:
+                members[record["segment"]] = record["members"]
+            else:
+                entries.append(record)
+    return entries, members
+
+def segment_entries(entries, segment):
+    return [entry for entry in entries if entry["segment"] == segment]
+
+class SegmentWriter:
+    """
+    Appends trial rows to the live segment of a directory. The segment is closed once
+    it holds max_bytes or is max_age seconds old, and a thread then compresses it
+    into one gzip member per index entry, so a reader only decompresses the members
+    around the trials it asks for. An index entry is added when a segment starts and
+    then at most every index_interval seconds, which bounds the index to a line a
+    minute and is also the resolution of reads by time.
+    """
+
+    def __init__(self, directory, max_bytes=1_000_000, max_age=86400, index_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_interval = index_interval
+        self.lock = threading.Lock()
+        self.compress_queue = queue.SimpleQueue()
+        self.compressor = threading.Thread(target=self.compress_loop, name="SegmentCompressor", daemon=True)
+        self.compressor.start()
+        self.load()
+
+    def load(self):
+        """ Continues the last segment of an existing log, and compresses closed segments left uncompressed. """
+        entries, members = load_index(self.directory)
+        self.segment, self.trials, self.size, self.started, self.last_entry = 1, 0, 0, None, None
+        if entries:
+            last = entries[-1]
+            try:
+                with open(segment_path(self.directory, last["segment"]), "rb") as f:
+                    f.seek(last["offset"])
+                    tail = f.read()
+            except FileNotFoundError:
+                tail = b""
+            self.segment = last["segment"]
+            self.trials = last["trial"] + tail.count(b"\n")
+            self.size = last["offset"] + len(tail)
+            self.started = segment_entries(entries, self.segment)[0]["time"]
+            self.last_entry = last["time"]
+            for segment in sorted({entry["segment"] for entry in entries} - set(members) - {self.segment}):
+                self.compress_queue.put(segment)
+
+    def append(self, lines, now=None):
+        """ Appends complete rows (bytes, one per trial) and indexes them. """
+        now = time.time() if now is None else now
+        if self.size and (self.size >= self.max_bytes or now - self.started >= self.max_age):
+            self.rotate()
+        entry = None
+        if self.size == 0 or now - self.last_entry >= self.index_interval:
+            entry = {"segment": self.segment, "trial": self.trials, "time": now, "offset": self.size}
+        data = b"".join(lines)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(segment_path(self.directory, self.segment), "ab") as f:
+            f.write(data)
+        # Indexed only once the rows are on disk, so readers never see an entry without its segment
+        if entry:
+            self.add_entry(entry)
+            self.last_entry = now
+            if self.size == 0:
+                self.started = now
+        self.size += len(data)
+        self.trials += len(lines)
+
+    def add_entry(self, record):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(os.path.join(self.directory, INDEX_NAME), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def rotate(self):
+        self.compress_queue.put(self.segment)
+        self.segment += 1
+        self.size = 0
+
+    def compress(self, segment):
+        path = segment_path(self.directory, segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        offsets = [entry["offset"] for entry in segment_entries(load_index(self.directory)[0], segment)]
+        members, compressed = [], []
+        for start, stop in zip(offsets, offsets[1:] + [len(data)]):
+            members.append(sum(len(member) for member in compressed))
+            compressed.append(gzip.compress(data[start:stop]))
+        # Readers fall back to the compressed segment once the plain one is gone
+        temporary = segment_path(self.directory, segment, compressed=True) + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(b"".join(compressed))
+        os.replace(temporary, segment_path(self.directory, segment, compressed=True))
+        self.add_entry({"segment": segment, "members": members})
+        os.remove(path)
+
+    def compress_loop(self):
+        while True:
+            segment = self.compress_queue.get()
+            if segment is None:
+                return
+            self.compress(segment)
+
+    def close(self):
+        """ Finishes the compressions already queued. The live segment stays open for the next writer. """
+        self.compress_queue.put(None)
+        self.compressor.join()
+
+def read_chunk(directory, entries, members, i):
+    """ Returns the rows of index entry i, up to the next entry of the same segment. """
+    entry = entries[i]
+    following = entries[i + 1] if i + 1 < len(entries) else None
+    stop = following["offset"] if following and following["segment"] == entry["segment"] else None
+    try:
+        with open(segment_path(directory, entry["segment"]), "rb") as f:
+            f.seek(entry["offset"])
+            data = f.read(-1 if stop is None else stop - entry["offset"])
+        # Rows still being written are left out
+        return data[:data.rfind(b"\n") + 1]
+    except FileNotFoundError:
+        pass
+    if entry["segment"] not in members:
+        # Compressed since the index was read
+        members.update(load_index(directory)[1])
+    if entry["segment"] not in members:
+        # Neither file exists yet, e.g. an entry read while its rows are being written
+        return b""
+    starts = members[entry["segment"]]
+    k = segment_entries(entries, entry["segment"]).index(entry)
+    with open(segment_path(directory, entry["segment"], compressed=True), "rb") as f:
+        f.seek(starts[k])
+        data = f.read(-1 if k + 1 == len(starts) else starts[k + 1] - starts[k])
+    return gzip.decompress(data)
+
+def read_trials(directory, start=0, stop=None):
+    """ Returns the rows of trials start to stop (from 0, stop excluded) as a list of bytes. """
+    entries, members = load_index(directory)
+    if not entries:
+        return []
+    i = max(bisect.bisect_right([entry["trial"] for entry in entries], start) - 1, 0)
+    rows = []
+    for j in range(i, len(entries)):
+        if stop is not None and entries[j]["trial"] >= stop:
+            break
+        lines = read_chunk(directory, entries, members, j).splitlines(keepends=True)
+        first = entries[j]["trial"]
+        rows += lines[max(start - first, 0):None if stop is None else max(stop - first, 0)]
+    return rows
+
+def read_between(directory, start_time=None, stop_time=None):
+    """
+    Returns the rows appended between two times (seconds since the epoch), to the
+    resolution of the index: every row of an index entry whose span overlaps them.
+    """
+    entries, members = load_index(directory)
+    rows = []
+    for j, entry in enumerate(entries):
+        end = entries[j + 1]["time"] if j + 1 < len(entries) else float("inf")
+        if (start_time is None or end > start_time) and (stop_time is None or entry["time"] < stop_time):
+            rows += read_chunk(directory, entries, members, j).splitlines(keepends=True)
+    return rows
+
+class SegmentTail:
+    """ Follows a segmented log across rotations and returns the complete rows appended since the last read. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segment = 1
+        self.offset = 0
+
+    def read_segment(self):
+        try:
+            with open(segment_path(self.directory, self.segment), "rb") as f:
+                f.seek(self.offset)
+                return f.read()
+        except FileNotFoundError:
+            pass
+        try:
+            with gzip.open(segment_path(self.directory, self.segment, compressed=True)) as f:
+                return f.read()[self.offset:]
+        except FileNotFoundError:
+            return b""
+
+    def read(self):
+        data = b""
+        while True:
+            # Checked before reading, so the segment is known to be complete when the next one exists.
+            # The next one may already be compressed, which happens before the plain file is removed.
+            closed = os.path.exists(segment_path(self.directory, self.segment + 1)) or \
+                os.path.exists(segment_path(self.directory, self.segment + 1, compressed=True))
+            new = self.read_segment()
+            end = len(new) if closed else new.rfind(b"\n") + 1
+            data += new[:end]
+            self.offset += end
+            if not closed:
+                return data
+            self.segment += 1
+            self.offset = 0
+
+def parse_time(value):
+    """ Parses a duration such as "90s", "30m", "1h" or "2d" into seconds. """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def main():
+    parser = argparse.ArgumentParser(description="Print trial rows from a segmented trial log.")
+    parser.add_argument("directory", type=str, help="Segment directory, e.g. mouse_3/trials.")
+    parser.add_argument("--trials", type=int, nargs=2, metavar=("START", "STOP"), help="Trials START to STOP, from 0.")
+    parser.add_argument("--last", type=str, help="Trials of the last period, e.g. 30m, 1h or 2d.")
+    args = parser.parse_args()
+
+    if args.trials:
+        rows = read_trials(args.directory, *args.trials)
+    elif args.last:
+        rows = read_between(args.directory, time.time() - parse_time(args.last))
+    else:
+        rows = read_trials(args.directory)
+    for row in rows:
+        print(row.decode("utf-8").rstrip("\n"))
+
+if __name__ == "__main__":
+    main()
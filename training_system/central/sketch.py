@@ -0,0 +1,116 @@
+''' Constant-memory streaming latency sketches used for median, p90 and IQR metrics '''
+import math
+
+LATENCY_TYPES = ["Correct", "Incorrect", "Reward", "Premature"]
+
+class LatencySketch:
+    """
+    Log-bucketed latency histogram with bounded relative error.
+
+    Every latency is counted in the bucket ceil(log_gamma(x)), so any quantile
+    is returned within `accuracy` of the true value. Latencies are bounded by the
+    trial timeouts, which bounds the number of buckets and thus the memory used.
+    Sketches built with the same accuracy can be merged by adding bucket counts.
+    """
+
+    def __init__(self, accuracy=0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        """ Counts a single latency in milliseconds. """
+        value = float(value)
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """ Adds the counts of another sketch, e.g. from a previous session. """
+        if other.accuracy != self.accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy.")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def quantile(self, q):
+        """ Returns the latency at quantile q (0 to 1), or 0 if nothing was counted. """
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                estimate = 2 * self.gamma ** index / (self.gamma + 1)
+                # Never report outside of what was actually observed
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def p90(self):
+        return self.quantile(0.9)
+
+    def iqr(self):
+        return self.quantile(0.75) - self.quantile(0.25)
+
+    def to_dict(self):
+        return {
+            "accuracy": self.accuracy,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["accuracy"])
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.total = data["total"]
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+def new_latency_sketches():
+    """ Returns one empty sketch per latency type. """
+    return {latency_type: LatencySketch() for latency_type in LATENCY_TYPES}
+
+def merge_latency_sketches(sessions):
+    """ Merges a list of {latency type: sketch} dicts, e.g. one per session. """
+    merged = new_latency_sketches()
+    for sketches in sessions:
+        for latency_type, sketch in sketches.items():
+            merged[latency_type].merge(sketch)
+    return merged
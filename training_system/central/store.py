@@ -0,0 +1,198 @@
+''' Longitudinal SQLite store for sessions, trials, stage transitions and metric snapshots '''
+import argparse
+import json
+from contextlib import closing
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from log import get_logger
+
+TRIAL_FIELDS = ["correct", "incorrect", "premature", "omission", "correct_withholding",
+                "incorrect_withholding", "correct_latency", "incorrect_latency",
+                "reward_latency", "premature_latency", "inter_trial_duration"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    mouse_id TEXT NOT NULL,
+    cohort TEXT,
+    start_stage TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    ended_at REAL
+);
+CREATE TABLE IF NOT EXISTS trials (
+    session_id TEXT NOT NULL,
+    mouse_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    trial_number INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    {", ".join(f"{field} REAL" for field in TRIAL_FIELDS)}
+);
+CREATE TABLE IF NOT EXISTS stage_transitions (
+    session_id TEXT NOT NULL,
+    mouse_id TEXT NOT NULL,
+    from_stage TEXT NOT NULL,
+    to_stage TEXT NOT NULL,
+    trials INTEGER NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metric_snapshots (
+    session_id TEXT NOT NULL,
+    mouse_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    trial_number INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    metrics TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_cohort ON sessions (cohort, mouse_id);
+CREATE INDEX IF NOT EXISTS idx_trials_mouse_stage_time ON trials (mouse_id, stage, timestamp);
+CREATE INDEX IF NOT EXISTS idx_transitions_mouse_stage_time ON stage_transitions (mouse_id, from_stage, timestamp);
+CREATE INDEX IF NOT EXISTS idx_snapshots_mouse_stage_time ON metric_snapshots (mouse_id, stage, timestamp);
+"""
+
+INSERTS = {
+    "session": "INSERT INTO sessions (session_id, mouse_id, cohort, start_stage, started_at) VALUES (?, ?, ?, ?, ?)",
+    "session_end": "UPDATE sessions SET ended_at = ? WHERE session_id = ?",
+    "trial": f"INSERT INTO trials (session_id, mouse_id, stage, trial_number, timestamp, {', '.join(TRIAL_FIELDS)}) "
+             f"VALUES ({', '.join('?' * (5 + len(TRIAL_FIELDS)))})",
+    "transition": "INSERT INTO stage_transitions (session_id, mouse_id, from_stage, to_stage, trials, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+    "snapshot": "INSERT INTO metric_snapshots (session_id, mouse_id, stage, trial_number, timestamp, metrics) VALUES (?, ?, ?, ?, ?, ?)",
+}
+
+class TrialStore:
+    """
+    Writes are queued and committed in batches by a single writer thread, so the
+    watcher never waits on the disk. The database runs in WAL mode, which lets
+    analysis queries read while a session is being written. A batch that fails
+    is rolled back and logged, and the writer carries on with the next one.
+    """
+
+    def __init__(self, path="training.db", batch_size=200, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.log = get_logger("store")
+        # Rows lost to failed batches
+        self.failed = 0
+        with closing(self.connect()) as conn:
+            conn.executescript(SCHEMA)
+        self.writer = threading.Thread(target=self.write_loop, name="TrialStoreWriter", daemon=True)
+        self.writer.start()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def write_loop(self):
+        """ Drains the queue and commits everything pending in one transaction. """
+        conn = self.connect()
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [item for item in batch if item is not None]
+            try:
+                with conn:
+                    # Group consecutive rows of the same kind into one executemany call
+                    start = 0
+                    for i in range(1, len(batch) + 1):
+                        if i == len(batch) or batch[i][0] != batch[start][0]:
+                            conn.executemany(INSERTS[batch[start][0]], [row for _, row in batch[start:i]])
+                            start = i
+            except sqlite3.Error:
+                # The connection's context manager has rolled the transaction back
+                self.failed += len(batch)
+                self.log.exception(f"Failed to write {len(batch)} row(s) to {self.path}, batch rolled back.")
+        conn.close()
+
+    def close(self):
+        """ Flushes all pending writes and stops the writer thread. """
+        self.queue.put(None)
+        self.writer.join()
+        if self.failed:
+            self.log.error(f"{self.failed} row(s) could not be written to {self.path}.")
+
+    def start_session(self, mouse_id, stage, cohort=None):
+        session_id = uuid.uuid4().hex
+        self.queue.put(("session", (session_id, mouse_id, cohort, stage, time.time())))
+        return session_id
+
+    def end_session(self, session_id):
+        self.queue.put(("session_end", (time.time(), session_id)))
+
+    def add_trial(self, session_id, mouse_id, stage, trial_number, trial):
+        row = (session_id, mouse_id, stage, trial_number, time.time(), *(float(value) for value in trial[:len(TRIAL_FIELDS)]))
+        self.queue.put(("trial", row))
+
+    def add_stage_transition(self, session_id, mouse_id, from_stage, to_stage, trials):
+        self.queue.put(("transition", (session_id, mouse_id, from_stage, to_stage, int(trials), time.time())))
+
+    def add_metric_snapshot(self, session_id, mouse_id, stage, metrics):
+        row = (session_id, mouse_id, stage, int(metrics["Total Trials"]), time.time(), json.dumps(metrics, default=float))
+        self.queue.put(("snapshot", row))
+
+    def query(self, sql, params=()):
+        with closing(self.connect()) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def trials_to_criterion(self, cohort=None):
+        """ Returns (mouse_id, stage, trials) for every stage a mouse advanced out of. """
+        sql = """
+            SELECT tr.mouse_id, tr.stage, COUNT(*) FROM trials tr
+            JOIN sessions s ON s.session_id = tr.session_id
+            WHERE (? IS NULL OR s.cohort = ?)
+            AND EXISTS (SELECT 1 FROM stage_transitions st WHERE st.mouse_id = tr.mouse_id AND st.from_stage = tr.stage)
+            GROUP BY tr.mouse_id, tr.stage
+        """
+        return self.query(sql, (cohort, cohort))
+
+    def latest_stage(self, mouse_id):
+        """ Returns the stage a mouse should continue from, or None if it has no history. """
+        rows = self.query(
+            """
+            SELECT stage, timestamp FROM (
+                SELECT to_stage AS stage, timestamp FROM stage_transitions WHERE mouse_id = ?
+                UNION ALL
+                SELECT start_stage AS stage, started_at AS timestamp FROM sessions WHERE mouse_id = ?
+            ) ORDER BY timestamp DESC LIMIT 1
+            """,
+            (mouse_id, mouse_id),
+        )
+        return rows[0][0] if rows else None
+
+    def session_trials(self, session_id):
+        return self.query("SELECT * FROM trials WHERE session_id = ? ORDER BY timestamp, rowid", (session_id,))
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the longitudinal training store.")
+    parser.add_argument("--db", type=str, default="training.db", help="Path of the SQLite store.")
+    parser.add_argument("--cohort", type=str, help="Only report mice of this cohort.")
+    args = parser.parse_args()
+
+    store = TrialStore(args.db)
+    start = time.perf_counter()
+    rows = store.trials_to_criterion(args.cohort)
+    elapsed = time.perf_counter() - start
+    store.close()
+
+    print(f"{'Mouse':<12}{'Stage':<20}{'Trials to criterion':>20}")
+    for mouse_id, stage, trials in rows:
+        print(f"{mouse_id:<12}{stage:<20}{trials:>20}")
+    print(f"{len(rows)} rows in {elapsed * 1000:.1f} ms")
+
+if __name__ == "__main__":
+    main()
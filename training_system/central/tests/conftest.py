@@ -0,0 +1,5 @@
+''' The central modules are imported by bare name, as main.py does '''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
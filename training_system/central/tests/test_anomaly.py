@@ -0,0 +1,65 @@
+import random
+from anomaly import AnomalyMonitor, Cusum
+
+def go(reward_latency=800, correct_latency=600):
+    return [1, 0, 0, 0, 0, 0, correct_latency, 0, reward_latency, 0, 5000]
+
+def nogo(withheld=True, premature_latency=300):
+    # Inhibition rows carry the premature latency in the reward latency column
+    return [0, 0, 0, 0, int(withheld), int(not withheld), 0, 0, 0 if withheld else premature_latency, 0, 5000]
+
+def omission(reward_latency=900):
+    # The magazine is still checked after an omission
+    return [0, 0, 0, 1, 0, 0, 0, 0, reward_latency, 0, 5000]
+
+def monitor_alerts():
+    alerts = []
+    monitor = AnomalyMonitor("1", hook=alerts.append, check_interval=60)
+    return monitor, alerts
+
+def feed(monitor, trials, stage="rcpt"):
+    for i, trial in enumerate(trials):
+        monitor.process(stage, trial, float(i))
+
+def test_nogo_trials_do_not_trigger_low_reward_latency():
+    monitor, alerts = monitor_alerts()
+    rng = random.Random(1)
+    trials = [go(rng.uniform(600, 1000)) if rng.random() < 0.7 else nogo(withheld=rng.random() < 0.8) for _ in range(300)]
+    # A block of correct withholds, each with 0 in the reward latency column
+    trials[100:110] = [nogo()] * 10
+    feed(monitor, trials)
+    monitor.close()
+    assert [alert["alert"] for alert in alerts] == []
+
+def test_nogo_trials_neither_extend_nor_break_a_low_reward_run():
+    monitor, alerts = monitor_alerts()
+    feed(monitor, [go(50), nogo(), go(50), nogo(), go(50), go(50), nogo(withheld=False), go(50)])
+    monitor.close()
+    assert [alert["alert"] for alert in alerts] == ["reward_latency_low"]
+    assert alerts[0]["trial"] == 8
+
+def test_omission_run_and_clear():
+    monitor, alerts = monitor_alerts()
+    feed(monitor, [omission()] * 20 + [go()])
+    monitor.close()
+    assert [alert["alert"] for alert in alerts] == ["omissions"]
+    assert "omissions" not in monitor.active
+
+def test_reward_latency_shift_on_go_trials_only():
+    monitor, alerts = monitor_alerts()
+    rng = random.Random(2)
+    baseline = [go(rng.uniform(700, 900)) if i % 3 else nogo() for i in range(150)]
+    shifted = [go(rng.uniform(2500, 3000)) if i % 3 else nogo() for i in range(60)]
+    feed(monitor, baseline + shifted)
+    monitor.close()
+    shifts = [alert for alert in alerts if alert["alert"] == "reward_latency_shift"]
+    assert len(shifts) == 1 and shifts[0]["trial"] > 150
+    assert "shifted high" in shifts[0]["message"]
+
+def test_cusum_signals_once_per_shift():
+    cusum = Cusum(min_std=0.05)
+    rng = random.Random(3)
+    signals = [cusum.update(rng.gauss(0, 0.1)) for _ in range(500)]
+    assert not any(signals)
+    signals = [cusum.update(rng.gauss(1, 0.1)) for _ in range(40)]
+    assert signals.count("high") == 1 and "low" not in signals
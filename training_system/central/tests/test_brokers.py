@@ -0,0 +1,81 @@
+import json
+import types
+import pytest
+from brokers import BrokerPool, all_brokers, chamber_brokers, load_config, parse_address
+
+CONFIG = {"brokers": {"rack1": "10.0.0.1", "rack2": "10.0.0.2:1884", "rack3": "10.0.0.3"},
+          "chambers": {"3": ["rack2", "rack1"]},
+          "default": ["rack1", "rack3"]}
+
+def message(topic, payload):
+    return types.SimpleNamespace(topic=topic, payload=payload)
+
+@pytest.fixture
+def pool():
+    failovers = []
+    received = []
+    pool = BrokerPool(list(CONFIG["brokers"].items()),
+                      on_message=lambda client, userdata, msg: received.append(msg.payload),
+                      on_failover=lambda old, new: failovers.append((old, new)), clean_session=True)
+    pool.failovers, pool.messages = failovers, received
+    yield pool
+    pool.close()
+
+def connect(pool, *names):
+    for name, client in pool.clients.items():
+        client.is_connected = lambda connected=name in names: connected
+
+def test_load_config_and_failover_order(tmp_path):
+    path = tmp_path / "brokers.json"
+    path.write_text(json.dumps(CONFIG))
+    config = load_config(str(path))
+    assert chamber_brokers(config, 3) == [("rack2", "10.0.0.2:1884"), ("rack1", "10.0.0.1")]
+    # Chambers that are not listed use the default brokers, primary first
+    assert chamber_brokers(config, "7") == [("rack1", "10.0.0.1"), ("rack3", "10.0.0.3")]
+    assert [name for name, _ in all_brokers(config)] == ["rack1", "rack2", "rack3"]
+    assert parse_address("10.0.0.2:1884") == ("10.0.0.2", 1884)
+    assert parse_address("10.0.0.1") == ("10.0.0.1", 1883)
+
+def test_load_config_rejects_unknown_brokers(tmp_path):
+    path = tmp_path / "brokers.json"
+    path.write_text(json.dumps({**CONFIG, "chambers": {"3": ["rack9"]}}))
+    with pytest.raises(ValueError):
+        load_config(str(path))
+
+def test_current_follows_the_chamber(pool):
+    # Nothing connected or heard yet: queued on the first broker
+    connect(pool)
+    assert pool.current() == "rack1"
+    connect(pool, "rack2", "rack3")
+    assert pool.current() == "rack2"
+    pool.received("rack3", message("mouse_3/request", b"hab1"))
+    assert pool.current() == "rack3"
+    # The broker last heard on went down, so the first connected one takes over
+    connect(pool, "rack2")
+    assert pool.current() == "rack2"
+    connect(pool)
+    assert pool.current() == "rack3"
+
+def test_failover_is_reported_once_per_switch(pool):
+    connect(pool, "rack1", "rack2")
+    for name in ["rack1", "rack1", "rack2", "rack2", "rack1"]:
+        pool.received(name, message("mouse_3/data", b"1 0 0 0 0 0 500 0 900 0 4000"))
+    assert pool.failovers == [("rack1", "rack2"), ("rack2", "rack1")]
+    assert len(pool.messages) == 5
+
+def test_traffic_counted_per_broker(pool):
+    connect(pool, "rack1", "rack2")
+    pool.received("rack2", message("mouse_3/request", b"ping"))
+    pool.received("rack2", message("mouse_3/data", b"12345"))
+    pool.publish("mouse_3/stage", "hab2 1a2b3c4d")
+    pool.publish("mouse_3/stage", b"\x01\x02")
+    stats = pool.stats()
+    assert stats["rack2"]["messages_in"] == 2 and stats["rack2"]["bytes_in"] == 9
+    assert stats["rack2"]["messages_out"] == 2 and stats["rack2"]["bytes_out"] == 15
+    assert stats["rack2"]["active"] and stats["rack2"]["connected"]
+    assert stats["rack1"]["messages_in"] == stats["rack1"]["messages_out"] == 0
+    assert stats["rack3"]["connected"] is False
+    assert stats["rack2"]["in_rate"] > 0
+    # Rates are since the last call, totals are not
+    stats = pool.stats()
+    assert stats["rack2"]["in_rate"] == 0 and stats["rack2"]["messages_in"] == 2
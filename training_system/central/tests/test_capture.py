@@ -0,0 +1,63 @@
+import math
+import numpy as np
+from capture import INBOUND, OUTBOUND, Capture, compare, read_capture, rename_chamber, response_latencies
+
+def session(trial_times, answer_after=0.2, resend_after=None):
+    """ A chamber's traffic: a stage command before the first trial, then one answering every trial. """
+    messages = [(0.0, INBOUND, "mouse_3/request", b"ping"), (0.01, OUTBOUND, "mouse_3/stage", b"hab1")]
+    for seconds in trial_times:
+        messages.append((seconds, INBOUND, "mouse_3/data", b"1,0,0,0,0,0,500,0,800,0,5000"))
+        messages.append((seconds + answer_after, OUTBOUND, "mouse_3/stage", b"hab1"))
+        if resend_after:
+            messages.append((seconds + answer_after + resend_after, OUTBOUND, "mouse_3/stage", b"hab1"))
+    return messages
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "session.cap")
+    capture = Capture(path)
+    capture.received("mouse_3/request", b"ping")
+    capture.sent("mouse_3/stage", "hab1")
+    capture.received("mouse_3/data", b"\x01" * 36)
+    capture.received("mouse_3/request", b"ping")
+    capture.close()
+    started, messages = read_capture(path)
+    assert started > 0
+    assert [(direction, topic, payload) for _, direction, topic, payload in messages] == [
+        (INBOUND, "mouse_3/request", b"ping"), (OUTBOUND, "mouse_3/stage", b"hab1"),
+        (INBOUND, "mouse_3/data", b"\x01" * 36), (INBOUND, "mouse_3/request", b"ping")]
+    times = [seconds for seconds, *_ in messages]
+    assert times == sorted(times)
+
+def test_torn_record_ends_the_capture(tmp_path):
+    path = str(tmp_path / "torn.cap")
+    capture = Capture(path)
+    capture.received("mouse_3/request", b"ping")
+    capture.received("mouse_3/data", b"1,0,0,0,0,0,500,0,800,0,5000")
+    capture.close()
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+    assert len(read_capture(path)[1]) == 1
+
+def test_response_latencies_ignore_resends():
+    times, latencies = response_latencies(session([1.0, 2.0, 3.0], answer_after=0.2, resend_after=0.3))
+    assert list(times) == [1.0, 2.0, 3.0]
+    assert np.allclose(latencies, 0.2)
+
+def test_unanswered_trial_is_nan():
+    messages = session([1.0, 2.0])
+    # The answer to the first trial was never sent
+    del messages[3]
+    _, latencies = response_latencies(messages)
+    assert math.isnan(latencies[0]) and math.isclose(latencies[1], 0.2)
+
+def test_compare_reports_diverged_trials():
+    recorded = session([1.0, 2.0, 3.0], answer_after=0.2)
+    replayed = session([1.0, 2.0, 3.0], answer_after=0.2)
+    replayed[5] = (2.5, OUTBOUND, "mouse_3/stage", b"hab1")
+    summary, diverged = compare(recorded, replayed, tolerance=0.1)
+    assert summary["recorded"]["trials"] == summary["replayed"]["trials"] == 3
+    assert [trial for trial, *_ in diverged] == [1]
+
+def test_rename_chamber():
+    assert rename_chamber("mouse_3/data", "7") == "mouse_7/data"
+    assert rename_chamber("mouse_3/data", None) == "mouse_3/data"
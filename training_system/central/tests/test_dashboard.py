@@ -0,0 +1,18 @@
+from dashboard import Dashboard, metrics_payload
+
+def test_latest_state_per_chamber_goes_to_new_browsers():
+    dashboard = Dashboard()
+    dashboard.update(metrics_payload("1", "hab1", {"Total Trials": 3, "Count": 2}))
+    dashboard.update(metrics_payload("1", "hab1", {"Total Trials": 4, "Count": 3}))
+    dashboard.update(metrics_payload("2", "hab2", {"Total Trials": 1}))
+    client = dashboard.subscribe()
+    messages = [client.get_nowait() for _ in range(client.qsize())]
+    assert len(messages) == 2 and '"Total Trials":4.0' in messages[0]
+
+def test_malformed_messages_are_skipped(capsys):
+    dashboard = Dashboard()
+    client = dashboard.subscribe()
+    for message in ["not json", "[1, 2]", '{"stage": "hab1"}', '{"mouse_id": null}']:
+        dashboard.update(message)
+    assert client.empty() and dashboard.latest == {}
+    assert capsys.readouterr().out.count("Ignoring malformed metrics message") == 4
@@ -0,0 +1,82 @@
+import json
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+import export
+from export import export_session
+from segments import SegmentWriter
+
+def row(correct, latency):
+    return f"{correct} {1 - correct} 0 0 0 0 {latency if correct else 0} {0 if correct else latency} 900 0 4000\n".encode()
+
+def write_snapshots(mouse_dir, stage, snapshots):
+    os.makedirs(os.path.join(mouse_dir, stage))
+    with open(os.path.join(mouse_dir, stage, "data.txt"), "w") as f:
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                f.write(f"{key}: {value}\n")
+            f.write("-" * 40 + "\n")
+
+@pytest.fixture
+def mouse_dir(tmp_path):
+    mouse_dir = str(tmp_path / "mouse_3")
+    writer = SegmentWriter(os.path.join(mouse_dir, "trials"))
+    # 4 trials of 5csr_citi_10, then 2 of 5csr_citi_8
+    writer.append([row(1, 500), row(0, 700), row(1, 450), row(1, 400), row(1, 300), row(0, 650)], now=1000)
+    writer.close()
+    with open(os.path.join(mouse_dir, "session.json"), "w") as f:
+        json.dump({"session_id": "abc123", "mouse_id": "3", "start_stage": "5csr_citi_10"}, f)
+    write_snapshots(mouse_dir, "5csr_citi_10", [{"Total Trials": i, "Correct": i, "Hit Rate": 50.0} for i in range(1, 5)])
+    # Older sessions lack the newer metrics
+    write_snapshots(mouse_dir, "5csr_citi_8", [{"Total Trials": i, "Correct": 1} for i in range(1, 3)])
+    return mouse_dir
+
+def test_hive_partitions(mouse_dir, tmp_path):
+    output = str(tmp_path / "export")
+    written = export_session(mouse_dir, output)
+    relative = sorted(os.path.relpath(path, output) for path in written)
+    assert relative == [os.path.join(table, "mouse_id=3", f"stage={stage}", "abc123.parquet")
+                        for table in ["metrics", "trials"] for stage in ["5csr_citi_10", "5csr_citi_8"]]
+    assert not any(name.endswith(".tmp") for _, _, names in os.walk(output) for name in names)
+
+    trials = pq.read_table(os.path.join(output, "trials"), partitioning="hive")
+    by_stage = {stage: trials.filter(pc.equal(trials["stage"], stage))
+                for stage in ["5csr_citi_10", "5csr_citi_8"]}
+    assert by_stage["5csr_citi_10"]["session_trial"].to_pylist() == [1, 2, 3, 4]
+    assert by_stage["5csr_citi_8"]["session_trial"].to_pylist() == [5, 6]
+    assert by_stage["5csr_citi_8"]["trial_number"].to_pylist() == [1, 2]
+    assert by_stage["5csr_citi_8"]["incorrect_latency"].to_pylist() == [0, 650]
+    assert set(trials["mouse_id"].to_pylist()) == {3}
+    assert set(trials["session"].to_pylist()) == {"abc123"}
+
+    metrics = pq.read_table(os.path.join(output, "metrics", "mouse_id=3", "stage=5csr_citi_8", "abc123.parquet"))
+    assert metrics["correct"].to_pylist() == [1.0, 1.0]
+    assert metrics["hit_rate"].null_count == 2
+
+def test_column_types(mouse_dir, tmp_path):
+    written = export_session(mouse_dir, str(tmp_path / "export"))
+    trials = pq.read_table(next(path for path in written if os.sep + "trials" + os.sep in path))
+    assert trials.schema == export.TRIAL_SCHEMA
+    assert trials.schema.field("correct").type == pa.int8()
+    assert trials.schema.field("correct_latency").type == pa.int32()
+    assert trials.schema.field("session").type == pa.string()
+    metrics = pq.read_table(next(path for path in written if os.sep + "metrics" + os.sep in path))
+    assert metrics.schema == export.METRIC_SCHEMA
+
+def test_export_again_replaces_the_session(mouse_dir, tmp_path):
+    output = str(tmp_path / "export")
+    first = export_session(mouse_dir, output)
+    assert export_session(mouse_dir, output) == first
+    assert pq.read_table(os.path.join(output, "trials"), partitioning="hive").num_rows == 6
+
+@pytest.mark.parametrize("compression, codec", [("zstd", "ZSTD"), ("snappy", "SNAPPY"), ("gzip", "GZIP"), ("none", "UNCOMPRESSED")])
+def test_compression_option(mouse_dir, tmp_path, monkeypatch, capsys, compression, codec):
+    output = str(tmp_path / "export")
+    monkeypatch.setattr("sys.argv", ["export.py", mouse_dir, "--output", output, "--compression", compression])
+    export.main()
+    assert f"Exported {mouse_dir}: 4 files" in capsys.readouterr().out
+    path = os.path.join(output, "trials", "mouse_id=3", "stage=5csr_citi_10", "abc123.parquet")
+    metadata = pq.ParquetFile(path).metadata
+    assert {metadata.row_group(0).column(i).compression for i in range(metadata.num_columns)} == {codec}
@@ -0,0 +1,55 @@
+from heartbeat import ALIVE, DEAD, STALE, Heartbeat
+
+def run_trial(heartbeat, start, rtt=1.0):
+    heartbeat.stage_sent("3", now=start)
+    heartbeat.trial("3", now=start + rtt)
+
+def test_idle_chamber_goes_stale_then_dead():
+    heartbeat = Heartbeat()
+    heartbeat.ping("3", now=0.0)
+    assert heartbeat.status(now=1.0)["3"]["liveness"] == ALIVE
+    assert heartbeat.status(now=3.0)["3"]["liveness"] == STALE
+    assert heartbeat.status(now=11.0)["3"]["liveness"] == DEAD
+
+def test_iti_after_trial_is_expected_silence():
+    heartbeat = Heartbeat()
+    heartbeat.ping("3", now=0.0)
+    run_trial(heartbeat, 0.5)
+    # A 6 s ITI, restarted by a few touches
+    for now in [3.0, 6.0, 12.0, 30.0]:
+        assert heartbeat.status(now=now)["3"]["liveness"] == ALIVE
+    heartbeat.ping("3", now=31.0)
+    stats = heartbeat.status(now=31.5)["3"]
+    assert stats["liveness"] == ALIVE and not stats["in_iti"]
+    assert heartbeat.status(now=34.0)["3"]["liveness"] == STALE
+
+def test_iti_that_never_ends_is_stale_then_dead():
+    heartbeat = Heartbeat(iti_timeout=60.0, trial_timeout=600.0)
+    heartbeat.ping("3", now=0.0)
+    run_trial(heartbeat, 0.5)
+    assert heartbeat.status(now=100.0)["3"]["liveness"] == STALE
+    assert heartbeat.status(now=700.0)["3"]["liveness"] == DEAD
+
+def test_check_reports_changes_once():
+    changes = []
+    heartbeat = Heartbeat(on_change=lambda chamber_id, old, new, stats: changes.append((chamber_id, old, new)))
+    heartbeat.ping("3", now=0.0)
+    heartbeat.check(now=0.1)
+    run_trial(heartbeat, 0.5)
+    for now in [2.0, 5.0, 8.0]:
+        heartbeat.check(now=now)
+    heartbeat.ping("3", now=8.5)
+    heartbeat.check(now=9.0)
+    heartbeat.check(now=12.0)
+    assert changes == [("3", DEAD, ALIVE), ("3", ALIVE, STALE)]
+
+def test_ping_intervals_exclude_trials():
+    heartbeat = Heartbeat()
+    for i in range(5):
+        heartbeat.ping("3", now=i * 0.5)
+    run_trial(heartbeat, 2.5, rtt=4.0)
+    heartbeat.ping("3", now=10.0)
+    heartbeat.ping("3", now=10.5)
+    stats = heartbeat.status(now=10.6)["3"]
+    assert abs(stats["ping_interval"] - 0.5) < 1e-9
+    assert stats["rtt"] == 4.0 and stats["trials"] == 1
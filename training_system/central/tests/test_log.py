@@ -0,0 +1,89 @@
+import json
+import logging
+import pytest
+import log
+from log import LOGGER_NAME, RateLimitFilter, get_logger, setup_logging, stop_logging
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(log.time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def json_log(tmp_path):
+    path = tmp_path / "session.jsonl"
+    yield path
+    stop_logging()
+    # Back to the defaults, so other tests log as if setup_logging was never called
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.handlers = []
+    logger.setLevel(logging.NOTSET)
+    logger.propagate = True
+
+def read_entries(path):
+    stop_logging()
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def record(message, key=None):
+    record = logging.LogRecord("training.test", logging.WARNING, __file__, 1, message, None, None)
+    if key is not None:
+        record.rate_limit = key
+    return record
+
+def test_burst_passes_first_and_summarizes_the_rest(clock):
+    limiter = RateLimitFilter(interval=60)
+    passed = []
+    for i in range(10):
+        clock.now += 1
+        if limiter.filter(record("Queue full", "queue")):
+            passed.append(i)
+    assert passed == [0]
+    clock.now += 55
+    summary = record("Queue full", "queue")
+    assert limiter.filter(summary)
+    assert summary.getMessage() == "Queue full (9 more in the last 64 s)"
+    # The count starts again after a summary
+    clock.now += 60
+    quiet = record("Queue full", "queue")
+    assert limiter.filter(quiet) and quiet.getMessage() == "Queue full"
+
+def test_keys_are_limited_separately(clock):
+    limiter = RateLimitFilter(interval=60)
+    assert limiter.filter(record("Queue full", "queue"))
+    assert limiter.filter(record("Dropped payload", "payload"))
+    assert not limiter.filter(record("Queue full", "queue"))
+    assert not limiter.filter(record("Dropped payload", "payload"))
+    # Records without a key are never limited
+    assert all(limiter.filter(record("Trial saved")) for _ in range(5))
+
+def test_setup_logging_writes_rate_limited_json(clock, json_log):
+    setup_logging("INFO", str(json_log), rate_limit_interval=60)
+    logger = get_logger("watcher", mouse_id="3", chamber_id="1")
+    for _ in range(20):
+        logger.warning("Processing queue full", extra={"rate_limit": "queue_shed"})
+    logger.debug("Below the level")
+    logger.info("Trial processed")
+    clock.now += 61
+    logger.warning("Processing queue full", extra={"rate_limit": "queue_shed"})
+    entries = read_entries(json_log)
+    assert [entry["message"] for entry in entries] == [
+        "Processing queue full", "Trial processed", "Processing queue full (19 more in the last 61 s)"]
+    assert entries[0]["level"] == "WARNING" and entries[0]["logger"] == "training.watcher"
+    assert entries[0]["mouse_id"] == "3" and entries[0]["chamber_id"] == "1"
+
+def test_context_is_left_out_when_unset(json_log):
+    setup_logging("DEBUG", str(json_log))
+    get_logger("store").debug("Wrote batch")
+    get_logger("ingest", mouse_id="7").error("Failed", exc_info=ValueError("bad row"))
+    entries = read_entries(json_log)
+    assert "mouse_id" not in entries[0] and "chamber_id" not in entries[0]
+    assert entries[1]["mouse_id"] == "7" and "ValueError: bad row" in entries[1]["exception"]
@@ -0,0 +1,74 @@
+from statistics import NormalDist
+import numpy as np
+import pytest
+from metrics import (_corrected_rates, _z, false_alarm, hit_rate, response_counts, responsivity_index,
+                     rolling_signal_detection, sensitivity_index, signal_detection, trial_latencies)
+
+@pytest.mark.parametrize("p", [1e-6, 0.001, 0.02, 0.02425, 0.1, 0.3, 0.5, 0.7, 0.9, 0.98, 0.999, 1 - 1e-6])
+def test_inverse_normal(p):
+    assert _z(p) == pytest.approx(NormalDist().inv_cdf(p), abs=1e-6)
+
+def test_inverse_normal_on_arrays():
+    p = np.array([0.01, 0.5, 0.99])
+    assert np.allclose(_z(p), [NormalDist().inv_cdf(x) for x in p], atol=1e-6)
+
+def test_sensitivity_and_responsivity():
+    # 40 hits of 50 go trials, 5 false alarms of 20 no-go trials, with the log-linear correction
+    hits, false_alarms = 40.5 / 51, 5.5 / 21
+    z = NormalDist().inv_cdf
+    assert sensitivity_index(40, 6, 4, 15, 5) == pytest.approx(z(hits) - z(false_alarms), abs=1e-6)
+    assert responsivity_index(40, 6, 4, 15, 5) == pytest.approx(-(z(hits) + z(false_alarms)) / 2, abs=1e-6)
+
+def test_perfect_and_empty_counts_stay_finite():
+    assert np.isfinite(sensitivity_index(50, 0, 0, 20, 0))
+    assert sensitivity_index(0, 0, 0, 0, 0) == pytest.approx(0)
+
+def test_corrected_rates_on_scalars_and_arrays():
+    counts = np.array([[40, 6, 4, 15, 5], [10, 10, 0, 3, 7], [0, 0, 0, 0, 0]])
+    hits, false_alarms = _corrected_rates(*counts.T.astype(float))
+    for row, hit, false_alarm_rate in zip(counts, hits, false_alarms):
+        correct, incorrect, omission, c_wh, i_wh = row
+        assert (hit, false_alarm_rate) == pytest.approx(_corrected_rates(*row))
+        assert hit == pytest.approx(hit_rate(correct + 0.5, incorrect, omission + 0.5) / 100)
+        assert false_alarm_rate == pytest.approx(false_alarm(c_wh + 0.5, i_wh + 0.5) / 100)
+
+def test_vectorized_matches_scalar():
+    counts = np.array([[40, 6, 4, 15, 5], [10, 10, 0, 3, 7], [0, 0, 5, 0, 0]])
+    d, c = signal_detection(*counts.T)
+    for row, d_row, c_row in zip(counts, d, c):
+        assert d_row == pytest.approx(sensitivity_index(*row))
+        assert c_row == pytest.approx(responsivity_index(*row))
+
+def test_rolling_window():
+    go = [1, 0, 0, 0, 0, 0, 500, 0, 800, 0, 5000]
+    nogo = [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 5000]
+    miss = [0, 1, 0, 0, 0, 0, 0, 600, 800, 0, 5000]
+    trials = np.array([miss] * 10 + [go, nogo] * 10)
+    d, _ = rolling_signal_detection(trials, window=20)
+    assert d[-1] == pytest.approx(sensitivity_index(10, 0, 0, 10, 0))
+    d_all, _ = rolling_signal_detection(trials)
+    assert d_all[-1] == pytest.approx(sensitivity_index(10, 10, 0, 10, 0))
+
+def test_response_counts():
+    go = [1, 0, 0, 0, 0, 0, 500, 0, 800, 0, 5000]
+    wrong = [0, 1, 0, 0, 0, 0, 0, 600, 800, 0, 5000]
+    withheld = [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 5000]
+    failed = [0, 0, 0, 0, 0, 1, 0, 0, 300, 0, 5000]
+    trials = np.array([go, wrong, withheld, failed])
+    assert list(response_counts("rcpt_viti_2", trials)) == [1, 0, 1, 0]
+    assert list(response_counts("hab1", trials)) == [1, 1, 0, 1]
+    assert list(response_counts("hab2", trials)) == [1, 0, 0, 0]
+    assert list(response_counts("5csr_citi_10", go)) == [0]
+
+def test_trial_latencies_follow_the_firmware_columns():
+    go = [1, 0, 0, 0, 0, 0, 500, 0, 900, 0, 5000]
+    wrong = [0, 1, 0, 0, 0, 0, 0, 600, 950, 0, 5000]
+    # inhibitionTrial: premature latency in column 8, reward latency in column 9
+    failed = [0, 0, 0, 0, 0, 1, 0, 0, 250, 1200, 0]
+    withheld = [0, 0, 0, 0, 1, 0, 0, 0, 0, 1100, 0]
+    latencies = trial_latencies(np.array([go, wrong, failed, withheld]))
+    assert latencies["Correct"].tolist() == [500]
+    assert latencies["Incorrect"].tolist() == [600]
+    assert latencies["Reward"].tolist() == [900, 950, 1200, 1100]
+    assert latencies["Premature"].tolist() == [250]
+    assert trial_latencies(withheld)["Reward"].tolist() == [1100]
@@ -0,0 +1,52 @@
+import json
+from outbox import Outbox
+
+def test_resend_until_acked(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.jsonl"))
+    outbox.add("mouse_3/stage", "hab1 a1")
+    assert outbox.due(60) == []
+    # Backdated instead of sleeping
+    for record in outbox.pending.values():
+        record["time"] -= 5
+    assert outbox.due(2) == [("mouse_3/stage", "hab1 a1")]
+    # The clock restarts with every resend
+    assert outbox.due(2) == []
+    outbox.ack("mouse_3/stage")
+    for record in outbox.pending.values():
+        record["time"] -= 5
+    assert outbox.due(2) == []
+    outbox.close()
+
+def test_newer_command_supersedes(tmp_path):
+    outbox = Outbox(str(tmp_path / "outbox.jsonl"))
+    first = outbox.add("mouse_3/stage", "hab1 a1")
+    second = outbox.add("mouse_3/stage", "hab2 b2")
+    outbox.add("mouse_4/stage", "hab1 c3")
+    assert second > first
+    assert sorted(record["payload"] for record in outbox.pending.values()) == ["hab1 c3", "hab2 b2"]
+    outbox.close()
+
+def test_pending_commands_survive_a_restart(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    outbox.add("mouse_3/stage", "hab1 a1")
+    outbox.add("mouse_4/stage", "hab1 b2")
+    outbox.ack("mouse_3/stage")
+    outbox.close()
+    with open(path, "a") as f:
+        f.write('{"seq": 9, "topic"')
+    outbox = Outbox(path)
+    assert [record["payload"] for record in outbox.pending.values()] == ["hab1 b2"]
+    assert outbox.add("mouse_4/stage", "hab2 c3") == 3
+    outbox.close()
+    with open(path) as f:
+        assert [json.loads(line)["payload"] for line in f] == ["hab1 b2", "hab2 c3"]
+
+def test_log_starts_over_once_everything_is_acked(tmp_path):
+    path = str(tmp_path / "outbox.jsonl")
+    outbox = Outbox(path)
+    outbox.add("mouse_3/stage", "hab1 a1")
+    outbox.ack("mouse_3/stage")
+    outbox.close()
+    with open(path) as f:
+        assert f.read() == ""
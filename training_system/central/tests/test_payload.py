@@ -0,0 +1,54 @@
+import numpy as np
+from ingest import TrialIngest
+from payload import TRIAL_DTYPE, decode_payloads, encode_trial, format_rows, is_binary, is_valid
+from segments import read_trials
+
+ROW = [1, 0, 0, 0, 0, 0, 512, 0, 830, 0, 4000]
+
+def test_encode_decode_round_trip():
+    rows = [ROW, [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 4000], [0, 1, 0, 0, 0, 0, 0, 70000, 1200, 0, 6000]]
+    payloads = [encode_trial(row, seq, device_ms=1000 * seq) for seq, row in enumerate(rows, 1)]
+    assert all(len(payload) == TRIAL_DTYPE.itemsize == 36 for payload in payloads)
+    assert all(is_binary(payload) and is_valid(payload) for payload in payloads)
+    records, trials = decode_payloads(payloads)
+    assert trials.tolist() == rows
+    assert records["seq"].tolist() == [1, 2, 3] and records["device_ms"].tolist() == [1000, 2000, 3000]
+    assert format_rows(trials)[0] == b"1 0 0 0 0 0 512 0 830 0 4000\n"
+
+def test_ascii_rows_are_not_binary():
+    assert not is_binary(b"1 0 0 0 0 0 512 0 830 0 4000")
+    assert not is_binary(b"")
+    assert not is_valid(encode_trial(ROW, 1)[:-1])
+    assert not is_valid(b"\x02" + encode_trial(ROW, 1)[1:])
+
+def ingest(tmp_path, payloads):
+    directory = str(tmp_path / "trials")
+    trial_ingest = TrialIngest(directory)
+    for payload in payloads:
+        trial_ingest.put(payload)
+    trial_ingest.close()
+    return [line.decode() for line in read_trials(directory)]
+
+def test_seq_gaps_duplicates_and_restarts(tmp_path, caplog):
+    seqs = [1, 2, 2, 5, 6, 1, 2]
+    rows = ingest(tmp_path, [encode_trial([1, 0, 0, 0, 0, 0, seq, 0, 800, 0, 4000], seq) for seq in seqs])
+    # The repeated 2 is dropped, everything else is kept in order
+    assert [int(row.split()[6]) for row in rows] == [1, 2, 5, 6, 1, 2]
+    assert "Missing 2 trial(s) before seq 5" in caplog.text
+    assert "Chamber restarted, seq went from 6 to 1" in caplog.text
+    assert "Dropped 1 duplicate trial(s)" in caplog.text
+
+def test_mixed_ascii_binary_and_unsupported(tmp_path, caplog):
+    payloads = [b"1 0 0 0 0 0 500 0 800 0 4000\n", encode_trial(ROW, 1), b"\x07" + bytes(35), encode_trial(ROW, 2)]
+    rows = ingest(tmp_path, payloads)
+    assert rows == ["1 0 0 0 0 0 500 0 800 0 4000\n", "1 0 0 0 0 0 512 0 830 0 4000\n", "1 0 0 0 0 0 512 0 830 0 4000\n"]
+    assert "Dropped unsupported binary payload (36 bytes, version 7)" in caplog.text
+
+def test_seq_carries_over_between_batches(tmp_path):
+    directory = str(tmp_path / "trials")
+    trial_ingest = TrialIngest(directory)
+    trial_ingest.decode([encode_trial(ROW, 1), encode_trial(ROW, 2)])
+    lines = trial_ingest.decode([encode_trial(ROW, 2), encode_trial(ROW, 3)])
+    trial_ingest.close()
+    assert lines[0] is None and lines[1] is not None
+    assert np.array_equal(np.loadtxt(lines[1:], dtype=int), ROW)
@@ -0,0 +1,149 @@
+import signal
+import pytest
+import scheduler
+from scheduler import Scheduler
+
+class FakeStore:
+    def __init__(self, stages=None):
+        self.stages = dict(stages or {})
+
+    def latest_stage(self, mouse_id):
+        return self.stages.get(mouse_id)
+
+class FakeProcess:
+    def __init__(self, command):
+        self.command = command
+        self.returncode = None
+        self.signals = []
+
+    def poll(self):
+        return self.returncode
+
+    def send_signal(self, sig):
+        self.signals.append(sig)
+        self.returncode = 1
+
+    def wait(self):
+        return self.returncode
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "time", clock)
+    return clock
+
+@pytest.fixture
+def launched(monkeypatch):
+    processes = []
+    def popen(command, **kwargs):
+        processes.append(FakeProcess(command))
+        return processes[-1]
+    monkeypatch.setattr(scheduler.subprocess, "Popen", popen)
+    return processes
+
+def option(command, name):
+    return command[command.index(name) + 1]
+
+def end_session(scheduler_, chamber, store=None, stage=None, returncode=0):
+    session = scheduler_.running[chamber]
+    if store is not None:
+        store.stages[session["mouse_id"]] = stage
+    session["process"].returncode = returncode
+
+def make_scheduler(tmp_path, chambers, mice, store, **kwargs):
+    return Scheduler(chambers, mice, store, 3600, log_dir=str(tmp_path / "logs"), **kwargs)
+
+def test_sessions_start_from_the_latest_stored_stage(tmp_path, clock, launched):
+    store = FakeStore({"m1": "5csr_citi_8"})
+    schedule = make_scheduler(tmp_path, ["1", "2"], ["m1", "m2"], store, start_stage="hab2",
+                              main_args=["--ip_address", "10.0.0.1"])
+    schedule.step()
+    commands = [process.command for process in launched]
+    assert [option(command, "--mouse_id") for command in commands] == ["m1", "m2"]
+    assert [option(command, "--chamber_id") for command in commands] == ["1", "2"]
+    # Mice without history start at start_stage
+    assert [option(command, "--stage") for command in commands] == ["5csr_citi_8", "hab2"]
+    assert option(commands[0], "--duration") == "3600"
+    assert option(commands[0], "--ip_address") == "10.0.0.1"
+    assert "--terminate_stage" not in commands[0]
+
+def test_chambers_rotate_through_the_queue(tmp_path, clock, launched):
+    store = FakeStore()
+    schedule = make_scheduler(tmp_path, ["1", "2"], ["m1", "m2", "m3"], store)
+    schedule.step()
+    assert [session["mouse_id"] for session in schedule.running.values()] == ["m1", "m2"]
+    assert schedule.queue == [("m3", 0.0)]
+
+    clock.now += 3600
+    end_session(schedule, "1", store, "hab2")
+    schedule.step()
+    # The freed chamber takes the waiting mouse, and m1 goes to the back of the queue
+    assert schedule.running["1"]["mouse_id"] == "m3"
+    assert schedule.running["2"]["mouse_id"] == "m2"
+    assert schedule.queue == [("m1", clock.now)]
+    assert schedule.sessions[0]["from_stage"] == "hab1" and schedule.sessions[0]["to_stage"] == "hab2"
+
+    clock.now += 60
+    end_session(schedule, "2")
+    schedule.step()
+    assert schedule.running["2"]["mouse_id"] == "m1"
+    assert option(launched[-1].command, "--stage") == "hab2"
+    assert not schedule.done()
+
+def test_rest_window_between_sessions(tmp_path, clock, launched):
+    store = FakeStore()
+    schedule = make_scheduler(tmp_path, ["1"], ["m1"], store, rest=7200)
+    schedule.step()
+    clock.now += 3600
+    end_session(schedule, "1", store, "hab2")
+    schedule.step()
+    assert schedule.running["1"] is None
+    assert schedule.queue == [("m1", clock.now + 7200)]
+
+    # The chamber stays free until the mouse has rested
+    clock.now += 7199
+    schedule.step()
+    assert schedule.running["1"] is None
+    clock.now += 1
+    schedule.step()
+    assert schedule.running["1"]["mouse_id"] == "m1"
+    assert len(launched) == 2
+    # Idle while the mouse rested
+    assert schedule.idle["1"] == pytest.approx(7200)
+
+def test_mice_leave_at_the_terminate_stage(tmp_path, clock, launched):
+    store = FakeStore({"m2": "5csr_viti"})
+    schedule = make_scheduler(tmp_path, ["1"], ["m1", "m2"], store, terminate="5csr_viti")
+    schedule.step()
+    assert option(launched[0].command, "--terminate_stage") == "5csr_viti"
+    # m2 already reached it and never starts
+    assert schedule.queue == [("m2", 0.0)]
+    end_session(schedule, "1", store, "5csr_viti")
+    schedule.step()
+    assert schedule.finished == ["m1", "m2"]
+    assert len(launched) == 1
+    assert schedule.done()
+
+def test_failed_session_requeues_the_mouse(tmp_path, clock, launched, capsys):
+    schedule = make_scheduler(tmp_path, ["1"], ["m1"], FakeStore())
+    schedule.step()
+    end_session(schedule, "1", returncode=2)
+    schedule.step()
+    assert "exited with code 2" in capsys.readouterr().out
+    assert schedule.sessions[0]["returncode"] == 2
+    assert schedule.running["1"]["mouse_id"] == "m1"
+
+def test_stop_interrupts_running_sessions(tmp_path, clock, launched):
+    schedule = make_scheduler(tmp_path, ["1", "2"], ["m1", "m2"], FakeStore())
+    schedule.step()
+    schedule.stop()
+    assert [process.signals for process in launched] == [[signal.SIGINT], [signal.SIGINT]]
+    assert all(session is None for session in schedule.running.values())
+    assert len(schedule.sessions) == 2
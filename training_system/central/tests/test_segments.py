@@ -0,0 +1,95 @@
+import os
+from segments import SegmentTail, SegmentWriter, load_index, parse_time, read_between, read_trials, segment_path
+
+def row(i):
+    return f"1 0 0 0 0 0 {i} 0 800 0 4000\n".encode()
+
+def write(directory, trials, start=0, now=1000.0, step=10.0, **kwargs):
+    writer = SegmentWriter(directory, **kwargs)
+    for i in range(start, start + trials):
+        writer.append([row(i)], now=now + i * step)
+    writer.close()
+    return writer
+
+def test_rotation_compresses_closed_segments(tmp_path):
+    directory = str(tmp_path)
+    writer = write(directory, 100, max_bytes=300, index_interval=50)
+    assert writer.segment > 3
+    for segment in range(1, writer.segment):
+        assert os.path.exists(segment_path(directory, segment, compressed=True))
+        assert not os.path.exists(segment_path(directory, segment))
+    # The live segment stays plain for the next writer
+    assert os.path.exists(segment_path(directory, writer.segment))
+    assert set(load_index(directory)[1]) == set(range(1, writer.segment))
+
+def test_read_trials_across_segments(tmp_path):
+    directory = str(tmp_path)
+    write(directory, 100, max_bytes=300, index_interval=50)
+    assert read_trials(directory) == [row(i) for i in range(100)]
+    assert read_trials(directory, 17, 63) == [row(i) for i in range(17, 63)]
+    assert read_trials(directory, 99) == [row(99)]
+    assert read_trials(directory, 100) == []
+    assert read_trials(str(tmp_path / "missing")) == []
+
+def test_read_between_times(tmp_path):
+    directory = str(tmp_path)
+    # One index entry a minute, a trial every 10 s
+    write(directory, 60, max_bytes=10_000, index_interval=60)
+    rows = read_between(directory, 1000.0 + 200, 1000.0 + 300)
+    numbers = [int(line.split()[6]) for line in rows]
+    assert set(range(20, 30)) <= set(numbers) and len(numbers) <= 30
+
+def test_writer_continues_an_existing_log(tmp_path):
+    directory = str(tmp_path)
+    write(directory, 30, max_bytes=300)
+    writer = write(directory, 30, start=30, max_bytes=300)
+    assert writer.trials == 60
+    assert read_trials(directory) == [row(i) for i in range(60)]
+
+def test_tail_follows_rotation_and_compression(tmp_path):
+    directory = str(tmp_path)
+    tail = SegmentTail(directory)
+    assert tail.read() == b""
+    writer = SegmentWriter(directory, max_bytes=300)
+    seen = b""
+    for i in range(80):
+        writer.append([row(i)], now=1000.0 + i)
+        if i % 7 == 0:
+            seen += tail.read()
+    writer.close()
+    seen += tail.read()
+    assert seen == b"".join(row(i) for i in range(80))
+
+def test_tail_leaves_partial_rows(tmp_path):
+    directory = str(tmp_path)
+    SegmentWriter(directory).append([row(0)], now=1000.0)
+    with open(segment_path(directory, 1), "ab") as f:
+        f.write(b"1 0 0")
+    tail = SegmentTail(directory)
+    assert tail.read() == row(0)
+    with open(segment_path(directory, 1), "ab") as f:
+        f.write(b" 0 0 0 1 0 800 0 4000\n")
+    assert tail.read() == row(1)
+
+def test_parse_time():
+    assert [parse_time(value) for value in ["90s", "30m", "1h", "2d", "15"]] == [90, 1800, 3600, 172800, 15]
+
+def test_rows_are_written_before_their_index_entry(tmp_path, monkeypatch):
+    writer = SegmentWriter(str(tmp_path), index_interval=0)
+    sizes = []
+    add_entry = writer.add_entry
+    def checked_add_entry(record):
+        sizes.append(os.path.getsize(segment_path(str(tmp_path), record["segment"])))
+        add_entry(record)
+    monkeypatch.setattr(writer, "add_entry", checked_add_entry)
+    writer.append([row(0), row(1)], now=0)
+    writer.append([row(2)], now=1)
+    writer.close()
+    assert sizes == [len(row(0) + row(1)), len(row(0) + row(1) + row(2))]
+
+def test_entry_without_a_segment_reads_as_empty(tmp_path):
+    writer = SegmentWriter(str(tmp_path))
+    writer.append([row(0), row(1)], now=0)
+    writer.close()
+    os.remove(segment_path(str(tmp_path), 1))
+    assert read_trials(str(tmp_path)) == []
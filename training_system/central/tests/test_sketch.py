@@ -0,0 +1,61 @@
+import random
+import numpy as np
+import pytest
+from sketch import LatencySketch, merge_latency_sketches, new_latency_sketches
+
+def latencies(seed, n=5000):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(6.5, 0.5) for _ in range(n)]
+
+@pytest.mark.parametrize("q", [0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+def test_quantiles_within_accuracy(q):
+    values = latencies(1)
+    sketch = LatencySketch(accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+    exact = np.quantile(values, q, method="lower")
+    assert abs(sketch.quantile(q) - exact) <= 0.01 * exact * 1.001
+
+def test_mean_and_extremes():
+    sketch = LatencySketch()
+    for value in [0, 100, 200, 300]:
+        sketch.add(value)
+    assert sketch.mean() == 150 and sketch.quantile(0) == 0 and sketch.quantile(1) == 300
+    assert LatencySketch().median() == 0 and LatencySketch().mean() == 0
+
+def test_merge_equals_one_sketch_of_everything():
+    first, second = latencies(2), latencies(3, 1000)
+    a, b, both = LatencySketch(), LatencySketch(), LatencySketch()
+    for value in first:
+        a.add(value)
+        both.add(value)
+    for value in second:
+        b.add(value)
+        both.add(value)
+    a.merge(b)
+    assert a.count == both.count and a.buckets == both.buckets
+    assert a.total == pytest.approx(both.total) and (a.min, a.max) == (both.min, both.max)
+    for q in [0.25, 0.5, 0.9]:
+        assert a.quantile(q) == both.quantile(q)
+
+def test_merge_rejects_other_accuracy():
+    with pytest.raises(ValueError):
+        LatencySketch(0.01).merge(LatencySketch(0.02))
+
+def test_dict_round_trip():
+    sketch = LatencySketch()
+    for value in latencies(4, 200):
+        sketch.add(value)
+    restored = LatencySketch.from_dict(sketch.to_dict())
+    assert restored.to_dict() == sketch.to_dict()
+    assert restored.p90() == sketch.p90() and restored.iqr() == sketch.iqr()
+    assert LatencySketch.from_dict(LatencySketch().to_dict()).count == 0
+
+def test_merge_latency_sketches():
+    sessions = [new_latency_sketches(), new_latency_sketches()]
+    sessions[0]["Correct"].add(500)
+    sessions[1]["Correct"].add(700)
+    sessions[1]["Reward"].add(900)
+    merged = merge_latency_sketches(sessions)
+    assert merged["Correct"].count == 2 and merged["Reward"].count == 1 and merged["Incorrect"].count == 0
+    assert sessions[0]["Correct"].count == 1
@@ -0,0 +1,14 @@
+from store import TrialStore
+
+def test_failed_batch_does_not_stop_the_writer(tmp_path, caplog):
+    store = TrialStore(str(tmp_path / "training.db"), batch_size=1, flush_interval=0.05)
+    # Too few values for the trials table
+    store.queue.put(("trial", ("s1", "1")))
+    session_id = store.start_session("1", "hab1", "c1")
+    store.add_trial(session_id, "1", "hab1", 1, [1, 0, 0, 0, 0, 0, 500, 0, 800, 0, 5000])
+    store.end_session(session_id)
+    store.close()
+    assert store.failed == 1
+    assert "batch rolled back" in caplog.text
+    assert store.query("SELECT mouse_id, cohort FROM sessions WHERE ended_at IS NOT NULL") == [("1", "c1")]
+    assert store.query("SELECT correct_latency FROM trials") == [(500.0,)]
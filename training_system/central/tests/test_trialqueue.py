@@ -0,0 +1,65 @@
+import threading
+import time
+import pytest
+from trialqueue import BLOCK, DROP, SHED, TrialQueue
+
+def test_default_policy_blocks():
+    assert TrialQueue().policy == BLOCK
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        TrialQueue(policy="skip")
+
+def test_batch_in_hand_does_not_overload():
+    queue = TrialQueue(max_depth=50, policy=DROP)
+    # One reconnect burst, larger than the queue
+    queue.put(list(range(80)))
+    batch = queue.get(timeout=0)
+    assert len(batch) == 80
+    assert not queue.overloaded()
+    queue.put(list(range(49)))
+    assert not queue.overloaded()
+    queue.put([0])
+    assert queue.overloaded()
+    queue.done(batch)
+    assert queue.stats()["processing"] == 0 and queue.stats()["depth"] == 50
+
+def test_overloaded_and_accepting_share_the_bound():
+    drop, shed = TrialQueue(max_depth=3, policy=DROP), TrialQueue(max_depth=3, policy=SHED)
+    for queue in [drop, shed]:
+        queue.put([1, 2])
+    assert not drop.overloaded() and shed.accepting()
+    for queue in [drop, shed]:
+        queue.put([3])
+    assert drop.overloaded() and not shed.accepting()
+    assert shed.stats()["shed"] == 1
+    assert drop.accepting() and not shed.overloaded()
+
+def test_block_waits_for_room():
+    queue = TrialQueue(max_depth=2, policy=BLOCK)
+    queue.put([1, 2])
+    put = threading.Thread(target=queue.put, args=([3],))
+    put.start()
+    time.sleep(0.05)
+    assert put.is_alive()
+    assert queue.get(timeout=0) == [1, 2]
+    put.join(1)
+    assert not put.is_alive()
+    assert queue.get(timeout=0) == [3]
+    assert queue.stats()["blocked_seconds"] > 0
+
+def test_block_lets_an_oversized_batch_into_an_empty_queue():
+    queue = TrialQueue(max_depth=2, policy=BLOCK)
+    queue.put([1, 2, 3, 4])
+    assert queue.stats()["depth"] == 4
+
+def test_get_times_out():
+    assert TrialQueue().get(timeout=0.01) is None
+
+def test_stats_count_drops():
+    queue = TrialQueue(policy=DROP)
+    queue.put([1, 2, 3])
+    queue.dropped(plots=1, snapshots=3)
+    stats = queue.stats()
+    assert stats["trials"] == 3 and stats["peak_depth"] == 3
+    assert stats["dropped_plots"] == 1 and stats["dropped_snapshots"] == 3
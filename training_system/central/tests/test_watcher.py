@@ -0,0 +1,59 @@
+import pytest
+from segments import SegmentWriter
+from watcher import Watcher
+
+class FakeMqtt:
+    def __init__(self, userdata=None):
+        self.userdata = {"chamber_id": "1", **(userdata or {})}
+
+    def publish(self, *args, **kwargs):
+        pass
+
+    def user_data_get(self):
+        return self.userdata
+
+@pytest.fixture
+def watcher(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    watcher = Watcher("1", "rcpt_viti_2", None, FakeMqtt(), plots=False)
+    yield watcher
+    watcher.anomalies.close()
+
+def test_rcpt_latencies_from_firmware_rows(watcher):
+    go = [1, 0, 0, 0, 0, 0, 600, 0, 900, 0, 4000]
+    # inhibitionTrial rows: premature latency in column 8, reward latency in column 9
+    failed = [0, 0, 0, 0, 0, 1, 0, 0, 250, 1200, 0]
+    withheld = [0, 0, 0, 0, 1, 0, 0, 0, 0, 1100, 0]
+    for trial in [go, failed, withheld] * 4:
+        watcher.process_trial(trial, render=False, snapshot=False)
+    metrics = watcher.metrics
+    assert metrics["Mean Premature Latency"] == pytest.approx(250)
+    assert metrics["Mean Reward Latency"] == pytest.approx((900 + 1200 + 1100) / 3)
+    assert metrics["Mean Correct Latency"] == pytest.approx(600)
+    assert watcher.latencies["Reward"].count == 12 and watcher.latencies["Premature"].count == 4
+    assert metrics["Count"] == 8
+
+class UnwrittenIngest:
+    """ Holds its rows until closed, like a TrialIngest whose writer thread has not run yet. """
+
+    def __init__(self, directory, rows):
+        self.segments = SegmentWriter(directory)
+        self.pending = rows
+
+    def depth(self):
+        return len(self.pending)
+
+    def close(self):
+        if self.pending:
+            self.segments.append(self.pending)
+            self.pending = []
+        self.segments.close()
+
+def test_stop_processes_trials_the_ingest_has_not_written(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ingest = UnwrittenIngest("mouse_1/trials", [b"1 0 0 0 0 0 600 0 900 0 4000\n"] * 3)
+    watcher = Watcher("1", "5csr_viti", None, FakeMqtt({"ingest": ingest}), plots=False)
+    watcher.start()
+    watcher.stop()
+    watcher.anomalies.close()
+    assert watcher.metrics["Correct"] == 3
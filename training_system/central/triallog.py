@@ -0,0 +1,142 @@
+''' Readers for the trial logs and metric snapshots written by mqtt.py and watcher.py '''
+import json
+import os
+import re
+import time
+import numpy as np
+from metrics import STAGE_SEQUENCE
+from segments import INDEX_NAME, read_trials
+
+# Column order of every row of the trial log, as published by the firmware
+TRIAL_COLUMNS = ["Correct", "Incorrect", "Premature", "Omission", "Correct Withholding",
+                 "Incorrect Withholding", "Correct Latency", "Incorrect Latency",
+                 "Reward Latency", "Premature Latency", "Inter Trial Duration"]
+
+MOUSE_DIR_PATTERN = re.compile(r"^mouse_(.+)$")
+
+def trial_log_path(mouse_dir):
+    """ Single-file trial log of sessions recorded before the log was segmented. """
+    mouse_id = mouse_id_from_dir(mouse_dir)
+    return os.path.join(mouse_dir, f"mouse_{mouse_id}.txt")
+
+def trial_segments_dir(mouse_dir):
+    return os.path.join(mouse_dir, "trials")
+
+def has_trial_log(mouse_dir):
+    return os.path.isfile(os.path.join(trial_segments_dir(mouse_dir), INDEX_NAME)) or os.path.isfile(trial_log_path(mouse_dir))
+
+def trial_log_files(mouse_dir):
+    """ The segments and index of the trial log, or the single file of older sessions. """
+    directory = trial_segments_dir(mouse_dir)
+    if os.path.isdir(directory):
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+    return [trial_log_path(mouse_dir)]
+
+def session_label(mouse_dir):
+    """ Session id written by the watcher, or the trial log's modification time for older sessions. """
+    path = os.path.join(mouse_dir, "session.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)["session_id"]
+    mtime = max(os.stat(path).st_mtime for path in trial_log_files(mouse_dir))
+    return time.strftime("%Y%m%dT%H%M%S", time.localtime(mtime))
+
+def mouse_id_from_dir(mouse_dir):
+    match = MOUSE_DIR_PATTERN.match(os.path.basename(os.path.normpath(mouse_dir)))
+    return match.group(1) if match else None
+
+def find_mouse_dirs(roots):
+    """ Recursively finds every mouse_<id> directory that contains its trial log. """
+    mouse_dirs = []
+    for root in roots:
+        for dirpath, dirnames, _ in os.walk(root):
+            for dirname in dirnames:
+                path = os.path.join(dirpath, dirname)
+                if MOUSE_DIR_PATTERN.match(dirname) and has_trial_log(path):
+                    mouse_dirs.append(path)
+    return sorted(mouse_dirs)
+
+def resolve_mouse_dirs(paths):
+    """ Keeps paths that are mouse_<id> directories and searches the others for them. """
+    mouse_dirs = [path for path in paths if mouse_id_from_dir(path) and has_trial_log(path)]
+    return mouse_dirs + find_mouse_dirs([path for path in paths if path not in mouse_dirs])
+
+def parse_trials(lines):
+    """ Parses trial log lines (str or bytes) into an (N, 11) array, skipping malformed rows. """
+    rows = []
+    for line in lines:
+        values = line.split()
+        if len(values) != len(TRIAL_COLUMNS):
+            continue
+        try:
+            rows.append([float(value) for value in values])
+        except ValueError:
+            continue
+    return np.array(rows, dtype=float).reshape(-1, len(TRIAL_COLUMNS))
+
+def load_trials(path):
+    """ Returns the trial log as an (N, 11) array, skipping malformed rows. """
+    if not os.path.exists(path) or os.stat(path).st_size == 0:
+        return np.empty((0, len(TRIAL_COLUMNS)))
+    with open(path) as f:
+        return parse_trials(f)
+
+def load_mouse_trials(mouse_dir, start=0, stop=None):
+    """ Returns trials start to stop of a mouse_<id> directory as an (N, 11) array, from either log layout. """
+    directory = trial_segments_dir(mouse_dir)
+    if os.path.isdir(directory):
+        return parse_trials(read_trials(directory, start, stop))
+    return load_trials(trial_log_path(mouse_dir))[start:stop]
+
+def load_metrics_log(path):
+    """ Parses a <stage>/data.txt file into one metrics dict per trial. """
+    snapshots = []
+    current = {}
+    if not os.path.exists(path):
+        return snapshots
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("-" * 10):
+                if current:
+                    snapshots.append(current)
+                current = {}
+            elif ": " in line:
+                key, value = line.split(": ", 1)
+                try:
+                    current[key] = float(value)
+                except ValueError:
+                    current[key] = value
+    if current:
+        snapshots.append(current)
+    return snapshots
+
+def stage_segments(mouse_dir, n_trials):
+    """
+    Splits a session's trial log into (stage, start, stop) row ranges.
+
+    The trial log has no stage column, so the number of trials per stage is taken
+    from the last snapshot of each <stage>/data.txt, in training order. Rows left
+    over (e.g. trials that arrived after the last snapshot) go to the last stage.
+    """
+    segments = []
+    start = 0
+    for stage in STAGE_SEQUENCE:
+        snapshots = load_metrics_log(os.path.join(mouse_dir, stage, "data.txt"))
+        if not snapshots:
+            continue
+        stop = min(start + int(snapshots[-1].get("Total Trials", 0)), n_trials)
+        segments.append([stage, start, stop])
+        start = stop
+    if segments:
+        segments[-1][2] = n_trials
+    return [tuple(segment) for segment in segments]
+
+def session_files(mouse_dir):
+    """ Every file a session summary is computed from. """
+    paths = trial_log_files(mouse_dir)
+    for stage in STAGE_SEQUENCE:
+        path = os.path.join(mouse_dir, stage, "data.txt")
+        if os.path.exists(path):
+            paths.append(path)
+    return paths
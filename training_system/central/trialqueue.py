@@ -0,0 +1,86 @@
+''' Bounded queue between reading trials from the trial log and processing them, with an overload policy '''
+import threading
+import time
+
+BLOCK, DROP, SHED = "block", "drop", "shed"
+POLICIES = [BLOCK, DROP, SHED]
+
+class TrialQueue:
+    """
+    Holds batches of trials read by the observer thread until the processing thread
+    takes them. Its depth counts the trials waiting, not the batch being processed,
+    so a single burst after a reconnect does not overload it on its own.
+    Once the depth reaches max_depth, the policy decides what gives:
+    - block: put() waits for room, holding up the observer thread;
+    - drop: trials are still queued, but while overloaded() their plots and metric
+      snapshots are skipped, which the caller counts with dropped();
+    - shed: accepting() is false, so the caller leaves new trials in the trial log,
+      the disk-only path, and reads them once the queue has drained.
+    Trials themselves are never dropped.
+    """
+
+    def __init__(self, max_depth=50, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown overload policy '{policy}'")
+        self.max_depth = max_depth
+        self.policy = policy
+        self.condition = threading.Condition()
+        self.batches = []
+        self.depth = 0
+        self.processing = 0
+        self.counters = {"trials": 0, "peak_depth": 0, "blocked_seconds": 0.0, "shed": 0,
+                         "dropped_plots": 0, "dropped_snapshots": 0}
+
+    def accepting(self):
+        """ False while a shed queue is full. Each refusal is counted. """
+        with self.condition:
+            if self.policy == SHED and self.depth >= self.max_depth:
+                self.counters["shed"] += 1
+                return False
+            return True
+
+    def put(self, trials):
+        with self.condition:
+            if self.policy == BLOCK:
+                start = time.monotonic()
+                # A batch larger than the queue is let in once it is empty
+                while self.depth and self.depth + len(trials) > self.max_depth:
+                    self.condition.wait()
+                self.counters["blocked_seconds"] += time.monotonic() - start
+            self.batches.append(trials)
+            self.depth += len(trials)
+            self.counters["trials"] += len(trials)
+            self.counters["peak_depth"] = max(self.counters["peak_depth"], self.depth)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """ Returns the oldest batch, or None after timeout seconds without one. """
+        with self.condition:
+            if not self.batches:
+                self.condition.wait(timeout)
+            if not self.batches:
+                return None
+            trials = self.batches.pop(0)
+            self.depth -= len(trials)
+            self.processing = len(trials)
+            self.condition.notify_all()
+            return trials
+
+    def done(self, trials):
+        """ Marks the batch taken by get() as processed. """
+        with self.condition:
+            self.processing -= len(trials)
+
+    def overloaded(self):
+        with self.condition:
+            return self.policy == DROP and self.depth >= self.max_depth
+
+    def dropped(self, plots=0, snapshots=0):
+        with self.condition:
+            self.counters["dropped_plots"] += plots
+            self.counters["dropped_snapshots"] += snapshots
+
+    def stats(self):
+        with self.condition:
+            return {"policy": self.policy, "depth": self.depth, "processing": self.processing,
+                    "max_depth": self.max_depth, **self.counters}
@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 import os
+from log import get_logger
 
 def generate_plot(mouse_id, stage, metrics):
     """Generates and saves a performance plot for the given mouse and stage."""
@@ -537,6 +538,6 @@ def generate_plot(mouse_id, stage, metrics):
     return file_path
 
 def visualize(mouse_id, stage, metrics):
-    """Generates and saves the plot, printing the file path."""
+    """Generates and saves the plot, logging the file path."""
     file_path = generate_plot(mouse_id, stage, metrics)
-    print(f"Saved plot: {file_path}")
+    get_logger("visual", mouse_id).debug(f"Saved plot: {file_path}")
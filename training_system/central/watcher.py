@@ -1,26 +1,50 @@
 import os
 import shutil
 import time
+import uuid
+import json
+import threading
+from collections import deque
 import numpy as np
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from metrics import *
-from visual import visualize
-from mqtt import wait_for_ping  # Import the wait_for_ping function from your MQTT module
+from sketch import LATENCY_TYPES, new_latency_sketches
+from dashboard import metrics_payload
+from triallog import parse_trials, trial_segments_dir
+from segments import SegmentTail
+from mqtt import wait_for_ping, publish_stage  # Import the wait_for_ping function from your MQTT module
+from log import get_logger
+from anomaly import AnomalyMonitor
+from trialqueue import BLOCK, TrialQueue
 
 class Watcher(FileSystemEventHandler):
     """ Watches txt and updates metrics when new data is added. """
-    STAGE_SEQUENCE = ["hab1", "hab2", "5csr_citi_10", "5csr_citi_8", 
-                      "5csr_citi_4", "5csr_citi_2", "5csr_viti", 
-                      "rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", 
-                      "rcpt_viti_15"]
+    STAGE_SEQUENCE = STAGE_SEQUENCE
+    # Number of trials in the rolling signal detection window
+    SDT_WINDOW = 50
 
-    def __init__(self, mouse_id, stage, terminate, mqtt):
+    def __init__(self, mouse_id, stage, terminate, mqtt, threshold_latency="Mean Correct Latency", store=None, cohort=None,
+                 dashboard=False, plots=True, alert_hook=None, inactivity_timeout=600, queue_policy=BLOCK, max_queue=50):
         self.mouse_id = mouse_id
         self.stage = stage
         self.mqtt = mqtt
         self.terminate_stage = terminate
+        self.threshold_latency = threshold_latency
+        self.store = store
+        self.dashboard = dashboard
+        self.plots = plots
+        self.log = get_logger("watcher", mouse_id, mqtt.user_data_get().get('chamber_id'))
+        # Hardware fault detection runs on its own thread and publishes to mouse_<chamber_id>/alert
+        self.anomalies = AnomalyMonitor(mouse_id, mqtt.user_data_get().get('chamber_id'),
+                                        lambda topic, payload: self.mqtt.publish(topic, payload, qos=1),
+                                        alert_hook, inactivity_timeout=inactivity_timeout)
+        self.session_id = store.start_session(mouse_id, stage, cohort) if store else uuid.uuid4().hex
         self.mouse_dir = self.create_mouse_directory()  # Ensures fresh directory
+        # Identifies this session to the exporters once the directory is archived
+        with open(os.path.join(self.mouse_dir, "session.json"), "w") as f:
+            json.dump({"session_id": self.session_id, "mouse_id": mouse_id, "start_stage": stage,
+                       "started_at": time.time(), "cohort": cohort}, f)
         # Initialize metrics for the current stage
         self.metrics = {
             "Total Trials": 0,
@@ -36,56 +60,175 @@ class Watcher(FileSystemEventHandler):
             "Cumulative Premature Latency": 0,
             "Count": 0
         }
-        self.last_modified_time = 0
+        # Per-outcome latency distributions for the current stage
+        self.latencies = new_latency_sketches()
+        self.reset_sdt_window()
+        # Follows the segments of the trial log as the ingest writer rotates them
+        self.trial_log = SegmentTail(trial_segments_dir(self.mouse_dir))
+        self.terminated = False
+        # Trials read by the observer thread wait here for the processing thread
+        self.queue = TrialQueue(max_queue, queue_policy)
+        self.read_lock = threading.Lock()
+        self.overloaded = False
+        self.running = True
+        # Set by start_watching. No stage is published after it, so the chamber is left idle for the next mouse.
+        self.ends_at = None
+        self.processor = threading.Thread(target=self.process_loop, name="TrialProcessor", daemon=True)
 
     def create_mouse_directory(self):
-        """ Overwrites the existing 'mouse_{mouse_id}' directory to start fresh. """
+        """
+        Overwrites the existing 'mouse_{mouse_id}' directory to start fresh. The trial log
+        is kept: the ingest writer started it afresh and may already have written trials.
+        """
         folder_path = f"mouse_{self.mouse_id}"
         
         if os.path.exists(folder_path):
-            shutil.rmtree(folder_path)
-            print(f"Deleted existing directory: {folder_path}")
+            for name in os.listdir(folder_path):
+                path = os.path.join(folder_path, name)
+                if path == trial_segments_dir(folder_path):
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            self.log.info(f"Deleted existing directory: {folder_path}")
 
-        os.makedirs(folder_path, exist_ok=True)
-        print(f"Created fresh directory: {folder_path}")
+        # Created before watching starts, so the first segment's events are not missed
+        os.makedirs(trial_segments_dir(folder_path), exist_ok=True)
+        self.log.info(f"Created fresh directory: {folder_path}")
         
         return folder_path
 
+    def reset_sdt_window(self):
+        """ Clears the rolling (correct, incorrect, omission, correct withholding, incorrect withholding) counts. """
+        self.sdt_window = deque(maxlen=self.SDT_WINDOW)
+        self.sdt_window_counts = np.zeros(5)
+
+    def update_sdt_window(self, trial):
+        """ Adds a trial's outcome counts to the rolling window, dropping the oldest trial once full. """
+        outcome = np.asarray(trial)[[0, 1, 3, 4, 5]]
+        if len(self.sdt_window) == self.sdt_window.maxlen:
+            self.sdt_window_counts -= self.sdt_window[0]
+        self.sdt_window.append(outcome)
+        self.sdt_window_counts += outcome
+
     def on_modified(self, event):
-        print("Modified file path:", event.src_path)
         """ Detects file updates and triggers metric computation. """
-        if event.src_path.endswith(f"mouse_{self.mouse_id}.txt"):
-            print("test123")
-            current_time = time.time()
-            if current_time - self.last_modified_time < 1:
+        if os.path.dirname(event.src_path) == os.path.abspath(trial_segments_dir(self.mouse_dir)) and \
+                event.src_path.endswith(".txt"):
+            # No debounce is needed: events for rows already read find nothing new
+            self.log.debug(f"{event.src_path} has been updated. Queueing new trials...")
+            self.enqueue_new_trials()
+
+    def enqueue_new_trials(self):
+        """ Queues the trials appended since the last read, unless a shedding queue is full. """
+        with self.read_lock:
+            if not self.queue.accepting():
+                # Left in the trial log until the queue has drained
+                self.log.warning(f"Processing queue full, new trials stay on disk until it drains: {self.queue_stats()}",
+                                 extra={"rate_limit": "queue_shed"})
                 return
-            
-            self.last_modified_time = current_time
-            print(f"{self.mouse_dir}/mouse_{self.mouse_id}.txt has been updated. Recomputing metrics...")
-            self.update_metrics()
-
-    def update_metrics(self):
-        """ Processes only the latest data row and updates metrics accordingly. """
-        if not os.path.exists(f"{self.mouse_dir}/mouse_{self.mouse_id}.txt") or os.stat(f"{self.mouse_dir}/mouse_{self.mouse_id}.txt").st_size == 0:
-            print("Warning: txt is empty. Skipping computation.")
-            return
+            trials = self.read_new_trials()
+            if len(trials):
+                self.queue.put(trials)
+
+    def start(self):
+        self.processor.start()
+
+    def stop(self):
+        """ Processes the trials still queued or shed to disk and stops the processing thread. """
+        ingest = self.mqtt.user_data_get().get('ingest')
+        if ingest:
+            # Trials received but not yet written are written first, so they are read below
+            ingest.close()
+        self.running = False
+        self.processor.join()
+        with self.read_lock:
+            trials = self.read_new_trials()
+        if len(trials):
+            self.update_metrics(trials)
 
-        try:
-            data = np.loadtxt(f"{self.mouse_dir}/mouse_{self.mouse_id}.txt", delimiter=" ")
-        except Exception as e:
-            print(f"Error reading txt: {e}")
+    def process_loop(self):
+        while True:
+            trials = self.queue.get(timeout=1)
+            if trials is None:
+                if not self.running:
+                    return
+                # Catches up on trials shed to disk, and on any the observer missed
+                self.enqueue_new_trials()
+                continue
+            try:
+                self.update_metrics(trials)
+            except Exception:
+                self.log.exception(f"Failed to process {len(trials)} trial(s).")
+            finally:
+                self.queue.done(trials)
+
+    def queue_stats(self):
+        """ Depth and overload counters of the processing queue, with the payloads waiting for the trial log. """
+        ingest = self.mqtt.user_data_get().get('ingest')
+        return {**self.queue.stats(), "ingest_depth": ingest.depth() if ingest else 0}
+
+    def read_new_trials(self):
+        """ Returns the complete rows appended to the trial log since the last call. """
+        # A row still being written is left for the next call
+        lines = self.trial_log.read().splitlines()
+        trials = parse_trials(lines)
+        if len(trials) < len([line for line in lines if line.strip()]):
+            self.log.warning("Skipped malformed rows in txt.")
+        return trials
+
+    def update_metrics(self, trials=None):
+        """
+        Processes a batch of trials, by default every trial appended since the last read,
+        so a burst of trials after a reconnect is caught up in one pass, then publishes
+        the stage for the next trial.
+        """
+        trials = self.read_new_trials() if trials is None else trials
+        if len(trials) == 0:
             return
+        if len(trials) > 1:
+            self.log.info(f"Catching up on {len(trials)} trials.")
 
-        if len(data) == 0:
+        # Under the drop policy, plots and metric snapshots are skipped while the queue is full
+        overloaded = self.queue.overloaded()
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if overloaded:
+                self.log.warning(f"Processing queue overloaded, skipping plots and snapshots: {self.queue_stats()}")
+            else:
+                self.log.info(f"Processing queue drained: {self.queue_stats()}")
+        if overloaded:
+            self.queue.dropped(plots=1)
+        for i, trial in enumerate(trials):
+            # Only the latest state is drawn when catching up
+            self.process_trial(trial, render=(i == len(trials) - 1) and not overloaded, snapshot=not overloaded)
+
+        if self.terminated:
+            # start_watching ends the session, the chamber is left idle for the next mouse
+            self.log.info("Terminating...")
+            return
+        if not self.running or self.expired():
+            # The session is ending, so no further trial is started
             return
 
-        # Handle the case of a single row
-        if data.ndim == 1:
-            latest_trial = data
+        # Before publishing stage info, wait for a ping
+        if wait_for_ping(self.mqtt, timeout=100):
+            if self.expired():
+                return
+            publish_stage(self.mqtt, self.stage)
+            self.log.debug(f"Published stage '{self.stage}' after receiving ping.")
         else:
-            latest_trial = data[-1, :]
+            self.log.warning("Ping not received within timeout. Stage not published.")
 
+    def expired(self):
+        return self.ends_at is not None and time.time() >= self.ends_at
 
+    def process_trial(self, latest_trial, render=True, snapshot=True):
+        """
+        Updates metrics with a single trial and advances the stage once its threshold is met.
+        The metrics are snapshotted if snapshot is set, and always before a stage advances.
+        """
         # Update metrics based solely on the latest trial
         self.metrics["Total Trials"] += 1
         self.metrics["Correct"] += latest_trial[0]
@@ -100,30 +243,23 @@ class Watcher(FileSystemEventHandler):
         self.metrics["Cumulative Premature Latency"] += latest_trial[9]
         self.metrics["Inter Trial Duration"] = latest_trial[10]
 
-        # Hab 1 and 2 threshold
-        if latest_trial[8] > 0:
-            if self.stage == "hab1":
-                self.metrics["Count"] += 1
-            elif self.stage == "hab2":
-                if latest_trial[0] > 0:
-                    self.metrics["Count"] += 1
+        # Only count a latency towards the outcome it was measured for
+        for latency_type, values in trial_latencies(latest_trial).items():
+            for value in values:
+                self.latencies[latency_type].add(value)
 
+        # Responses counted towards the Hab and rCPT thresholds
         #TODO: Implement CPT threshold (sort it into count)
-        if self.stage in ["rcpt_viti_2_to_1", "rcpt_viti_2", "rcpt_viti_175", "rcpt_viti_15"]:
-            # Go Trial
-            if latest_trial[4]==0 and latest_trial[5]==0:
-                if latest_trial[0] > 0:
-                    self.metrics["Count"] += 1
-            # No Go Trial
-            else:
-                if latest_trial[4] > 0:
-                    self.metrics["Count"] += 1
+        self.metrics["Count"] += int(response_counts(self.stage, latest_trial)[0])
 
         # Compute derived metrics based on the latest trial
-        self.metrics["Mean Correct Latency"] = self.metrics["Cumulative Correct Latency"] / self.metrics["Total Trials"]
-        self.metrics["Mean Incorrect Latency"] = self.metrics["Cumulative Incorrect Latency"] / self.metrics["Total Trials"]
-        self.metrics["Mean Reward Latency"] = self.metrics["Cumulative Reward Latency"] / self.metrics["Total Trials"]
-        self.metrics["Mean Premature Latency"] = self.metrics["Cumulative Premature Latency"] / self.metrics["Total Trials"]
+        # Means are taken over the trials where that latency occurred, not over all trials
+        for latency_type in LATENCY_TYPES:
+            sketch = self.latencies[latency_type]
+            self.metrics[f"Mean {latency_type} Latency"] = sketch.mean()
+            self.metrics[f"Median {latency_type} Latency"] = sketch.median()
+            self.metrics[f"P90 {latency_type} Latency"] = sketch.p90()
+            self.metrics[f"IQR {latency_type} Latency"] = sketch.iqr()
 
         self.metrics["Correct Percentage"] = correct_perc(self.metrics["Correct"], self.metrics["Incorrect"])
         self.metrics["Omission Percentage"] = omission_perc(self.metrics["Omission"], self.metrics["Correct"], self.metrics["Incorrect"])
@@ -131,29 +267,48 @@ class Watcher(FileSystemEventHandler):
         self.metrics["Difference Withholding"] = diff_wh(self.metrics["Correct Withholding Percentage"], self.metrics["Omission Percentage"])
         self.metrics["False Alarm Rate"] = false_alarm(self.metrics["Correct Withholding"], self.metrics["Incorrect Withholding"])
         self.metrics["Hit Rate"] = hit_rate(self.metrics["Correct"], self.metrics["Incorrect"], self.metrics["Omission"])
+        sdt_counts = (self.metrics["Correct"], self.metrics["Incorrect"], self.metrics["Omission"],
+                      self.metrics["Correct Withholding"], self.metrics["Incorrect Withholding"])
+        self.metrics["Sensitivity Index"] = sensitivity_index(*sdt_counts)
+        self.metrics["Responsivity Index"] = responsivity_index(*sdt_counts)
+        self.update_sdt_window(latest_trial)
+        self.anomalies.observe(self.stage, latest_trial)
+        self.metrics["Rolling Sensitivity Index"] = sensitivity_index(*self.sdt_window_counts)
+        self.metrics["Rolling Responsivity Index"] = responsivity_index(*self.sdt_window_counts)
+
+        self.log.info(f"Trial {self.metrics['Total Trials']} at {self.stage}: {self.metrics['Correct']:.0f} correct, "
+                      f"count {self.metrics['Count']:.0f}")
 
-        print(f"Total Trials: {self.metrics['Total Trials']}")
-        print(f"Updated Metrics for Mouse {self.mouse_id}, Stage {self.stage}")
+        # Compute threshold and potentially advance to the next stage
+        threshold = compute_threshold(task=self.stage, metrics=self.metrics, latency=self.threshold_latency)
 
-        # Visualization
-        visualize(self.mouse_id, self.stage, self.metrics)
+        # Queue the trial and metrics for the longitudinal store
+        if self.store:
+            self.store.add_trial(self.session_id, self.mouse_id, self.stage, self.metrics["Total Trials"], latest_trial)
+        if snapshot or threshold:
+            if self.store:
+                self.store.add_metric_snapshot(self.session_id, self.mouse_id, self.stage, self.metrics)
+            # Save metrics to data.txt, whose last snapshot per stage also marks the stage boundaries
+            self.save_metrics()
+        else:
+            self.queue.dropped(snapshots=1)
 
-        # Save metrics to data.txt
-        self.save_metrics()
+        # Visualization, either streamed to the dashboard or rendered to a PNG
+        if render or threshold:
+            self.render()
 
-        # Compute threshold and potentially advance to the next stage
-        threshold = compute_threshold(task=self.stage, metrics=self.metrics)
         if threshold:
-            print(f"Threshold met! Advancing from {self.stage} to next stage...")
+            self.log.info(f"Threshold met! Advancing from {self.stage} to next stage...")
             self.advance_stage()
-        else:
-            # Before publishing stage info, wait for a ping
-            if wait_for_ping(self.mqtt, timeout=100):
-                topic = f"{self.mouse_dir}/stage"
-                self.mqtt.publish(topic, self.stage)
-                print(f"Published stage '{self.stage}' to topic '{topic}' after receiving ping.")
-            else:
-                print("Ping not received within timeout. Stage not published.")
+
+    def render(self):
+        """ Streams the current metrics to the dashboard or renders them to a PNG. """
+        if self.dashboard:
+            self.mqtt.publish(f"{self.mouse_dir}/metrics", metrics_payload(self.mouse_id, self.stage, self.metrics), retain=True)
+        elif self.plots:
+            # Imported on first use so that matplotlib stays off the startup path
+            from visual import visualize
+            visualize(self.mouse_id, self.stage, self.metrics)
 
     def save_metrics(self):
         """ Saves current metrics to 'mouse_{mouse_id}/{stage}/data.txt'. """
@@ -177,23 +332,38 @@ class Watcher(FileSystemEventHandler):
             f.write(f"Mean Incorrect Latency: {self.metrics['Mean Incorrect Latency']:.2f}\n")
             f.write(f"Mean Reward Latency: {self.metrics['Mean Reward Latency']:.2f}\n")
             f.write(f"Mean Premature Latency: {self.metrics['Mean Premature Latency']:.2f}\n")
+            for latency_type in LATENCY_TYPES:
+                for statistic in ["Median", "P90", "IQR"]:
+                    key = f"{statistic} {latency_type} Latency"
+                    f.write(f"{key}: {self.metrics[key]:.2f}\n")
             f.write(f"Correct Percentage: {self.metrics['Correct Percentage']:.2f}\n")
             f.write(f"Omission Percentage: {self.metrics['Omission Percentage']:.2f}\n")
             f.write(f"Correct Withholding Percentage: {self.metrics['Correct Withholding Percentage']:.2f}\n")
             f.write(f"Difference Withholding: {self.metrics['Difference Withholding']:.2f}\n")
             f.write(f"False Alarm Rate: {self.metrics['False Alarm Rate']:.2f}\n")
             f.write(f"Hit Rate: {self.metrics['Hit Rate']:.2f}\n")
+            f.write(f"Sensitivity Index: {self.metrics['Sensitivity Index']:.2f}\n")
+            f.write(f"Responsivity Index: {self.metrics['Responsivity Index']:.2f}\n")
+            f.write(f"Rolling Sensitivity Index: {self.metrics['Rolling Sensitivity Index']:.2f}\n")
+            f.write(f"Rolling Responsivity Index: {self.metrics['Rolling Responsivity Index']:.2f}\n")
             f.write(f"Inter Trial Duration: {self.metrics['Inter Trial Duration']:.2f}\n")
             f.write("-" * 40 + "\n")
 
-        print(f"Metrics saved to {file_path}")
+        # Latency sketches can be merged with those of other sessions later on
+        with open(os.path.join(stage_folder, "latency.json"), "w") as f:
+            json.dump({latency_type: sketch.to_dict() for latency_type, sketch in self.latencies.items()}, f)
+
+        self.log.debug(f"Metrics saved to {file_path}")
 
     def advance_stage(self):
         """ Advances to the next stage and resets metrics completely for the new stage. """
         current_index = self.STAGE_SEQUENCE.index(self.stage)
         if current_index < len(self.STAGE_SEQUENCE) - 1:
+            if self.store:
+                self.store.add_stage_transition(self.session_id, self.mouse_id, self.stage,
+                                                self.STAGE_SEQUENCE[current_index + 1], self.metrics["Total Trials"])
             self.stage = self.STAGE_SEQUENCE[current_index + 1]
-            print(f"New stage: {self.stage}")
+            self.log.info(f"New stage: {self.stage}")
             # Reset all metrics for the new stage
             self.metrics = {
                 "Total Trials": 0,
@@ -210,37 +380,43 @@ class Watcher(FileSystemEventHandler):
                 "Count": 0,
                 "Inter Trial Duration": 0
             }
-            # Wait for ping before publishing the new stage.
-            if wait_for_ping(self.mqtt, timeout=100):
-                topic = f"{self.mouse_dir}/stage"
-                self.mqtt.publish(topic, self.stage)
-                print(f"Published new stage '{self.stage}' to topic '{topic}' after receiving ping.")
-            else:
-                print("Ping not received within timeout. New stage not published.")
-
+            self.latencies = new_latency_sketches()
+            self.reset_sdt_window()
+            # The new stage is published once the pending trials are processed
             if self.stage == self.terminate_stage:
-                print("Terminating...")
-                exit()
+                self.terminated = True
         else:
-            print("Final stage reached. No further advancement.")
+            self.log.info("Final stage reached. No further advancement.")
 
-def start_watching(mouse_id, stage, duration, terminate, mqtt_client):
-    # Watch the subdirectory that contains the file.
+def start_watching(mouse_id, stage, duration, terminate, mqtt_client, threshold_latency="Mean Correct Latency",
+                   store=None, cohort=None, dashboard=False, plots=True, alert_hook=None, inactivity_timeout=600,
+                   queue_policy=BLOCK, max_queue=50):
+    # Watch the mouse directory, whose trials subdirectory holds the trial log segments.
     dir_to_watch = os.path.abspath(f"mouse_{mouse_id}")
-    print("Watching directory:", dir_to_watch)
-    event_handler = Watcher(mouse_id, stage, terminate, mqtt_client)
+    event_handler = Watcher(mouse_id, stage, terminate, mqtt_client, threshold_latency, store, cohort, dashboard, plots,
+                            alert_hook, inactivity_timeout, queue_policy, max_queue)
+    event_handler.log.info(f"Watching directory: {dir_to_watch}")
+    event_handler.start()
     observer = Observer()
-    observer.schedule(event_handler, dir_to_watch, recursive=False)
+    observer.schedule(event_handler, dir_to_watch, recursive=True)
     observer.start()
 
     start_time = time.time()
+    event_handler.ends_at = start_time + duration
     try:
-        while time.time() - start_time < duration:
+        # The session also ends once the terminate stage is reached
+        while time.time() - start_time < duration and not event_handler.terminated:
             time.sleep(1)
     except KeyboardInterrupt:
-        print("Watcher manually stopped.")
+        event_handler.log.info("Watcher manually stopped.")
     
     observer.stop()
     observer.join()
-    print("Watcher process ended.")
+    event_handler.stop()
+    event_handler.log.info(f"Processing queue: {event_handler.queue_stats()}")
+    event_handler.anomalies.close()
+    if store:
+        store.end_session(event_handler.session_id)
+    event_handler.log.info("Watcher process ended.")
+    return event_handler.terminated
 
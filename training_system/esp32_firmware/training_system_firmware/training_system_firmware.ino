@@ -53,7 +53,12 @@ const unsigned long feedOpTime =
 const char* subjectID = "mouse_3";
 const char* ssid = "TP-Link_5E1F";
 const char* password = "13111014";
-const char* mqttServer = "192.168.0.69";
+// Brokers in the order of the chamber's entry in the central brokers config:
+// primary first, then standbys, tried in turn while none can be reached
+const char* mqttServers[] = {"192.168.0.69"};
+const int mqttServerCount = sizeof(mqttServers) / sizeof(mqttServers[0]);
+// Send trials as packed binary payloads (TrialPayload) instead of ASCII rows
+const bool binaryPayload = false;
 
 // ------------------------- Global variables -------------------------
 // Touchscreen
@@ -65,12 +70,27 @@ char topicPub[30];
 char topicReq[30];
 char clientID[30];
 WiFiClient espClient;
+int mqttServerIndex = 0;
 PubSubClient client(espClient);
 long lastMsg = 0;
 char msg[50];
 char outgoingMsg[100];
 int value = 0;
 unsigned long lastCentralComputerPing = 0;
+// Id of the last stage command run, see callback()
+String lastCommandId = "";
+// Binary trial payload, little-endian as on the ESP32. Must match
+// TRIAL_DTYPE in central/payload.py, and change payloadVersion with it.
+const uint8_t payloadVersion = 1;
+struct __attribute__((packed)) TrialPayload {
+  uint8_t version;
+  uint8_t outcomes[6];
+  uint8_t reserved;
+  uint32_t seq;
+  uint32_t deviceMs;
+  uint32_t latencies[5];
+};
+uint32_t trialSeq = 0;
 // Training
 bool twoToOne[15] =
   {false, false, false, false, false,
@@ -153,27 +173,72 @@ void extinguishChoices() {
   * @brief Attempts to connect to MQTT network if not connected
   *
   * This function will attempt to connect to the MQTT network if currently
-  * disconnected.
+  * disconnected. The session is persistent, so stage commands published while
+  * the chamber was disconnected are delivered once it reconnects. Every failed
+  * attempt moves on to the next broker in mqttServers.
   */
 void reconnect() {
   // Loop until reconnected
   while (!client.connected()) {
     Serial.print("Attempting MQTT connection...");
-    // Attempt to connect
-    if (client.connect(clientID)) {
+    // Attempt to connect with a persistent session (cleanSession = false), so
+    // the broker keeps stage commands sent while this chamber was offline
+    if (client.connect(clientID, NULL, NULL, NULL, 0, false, NULL, false)) {
       Serial.println("connected");
-      // Subscribe
-      client.subscribe(topicSub);
+      // Subscribe with QoS 1 so queued stage commands are delivered on reconnect
+      client.subscribe(topicSub, 1);
     } else {
       Serial.print("failed, rc=");
       Serial.print(client.state());
-      Serial.println(" try again in 5 seconds");
+      // Fail over to the next broker of the list
+      mqttServerIndex = (mqttServerIndex + 1) % mqttServerCount;
+      client.setServer(mqttServers[mqttServerIndex], 1883);
+      Serial.print(" try ");
+      Serial.print(mqttServers[mqttServerIndex]);
+      Serial.println(" in 5 seconds");
       // Wait 5 seconds before retrying
       delay(5000);
     }
   }
 }
 
+/**
+  * @brief Reports the data of one trial via MQTT
+  *
+  * Publishes the trial as an ASCII row of 11 space separated values, or as a
+  * TrialPayload if binaryPayload is set. Binary payloads also carry a sequence
+  * number, so the central computer can detect lost trials, and the device time.
+  */
+void publishTrial(int positive, int negative, int premature, int omission,
+  int positiveWithhold, int negativeWithhold, unsigned long correctLatency,
+  unsigned long incorrectLatency, unsigned long rewardLatency,
+  unsigned long prematureLatency, unsigned long interTrialDuration) {
+  trialSeq += 1;
+  if (!client.connected()) {
+    reconnect();
+  }
+  if (binaryPayload) {
+    TrialPayload payload = {
+      payloadVersion,
+      {(uint8_t)positive, (uint8_t)negative, (uint8_t)premature,
+        (uint8_t)omission, (uint8_t)positiveWithhold, (uint8_t)negativeWithhold},
+      0,
+      trialSeq,
+      (uint32_t)millis(),
+      {correctLatency, incorrectLatency, rewardLatency, prematureLatency,
+        interTrialDuration}
+    };
+    client.publish(topicPub, (const uint8_t*)&payload, sizeof(payload));
+  }
+  else {
+    sprintf(outgoingMsg, "%d %d %d %d %d %d %lu %lu %lu %lu %lu", positive,
+      negative, premature, omission, positiveWithhold, negativeWithhold,
+      correctLatency, incorrectLatency, rewardLatency, prematureLatency,
+      interTrialDuration);
+    client.publish(topicPub, outgoingMsg);
+  }
+}
+
 /**
   * @brief Interprets incoming MQTT messages
   *
@@ -192,6 +257,19 @@ void callback(char* topic, byte* message, unsigned int length) {
       messageTemp += (char)message[i];
     }
     Serial.println();
+    // Commands are "<stage> <id>". The central computer resends a command until
+    // it gets a trial for it, and the broker may also redeliver the original
+    // after a reconnect, so a command whose id was just run is a duplicate.
+    int separator = messageTemp.indexOf(' ');
+    if (separator >= 0) {
+      String commandId = messageTemp.substring(separator + 1);
+      messageTemp = messageTemp.substring(0, separator);
+      if (commandId == lastCommandId) {
+        Serial.println("Duplicate command ignored");
+        return;
+      }
+      lastCommandId = commandId;
+    }
     // Place all central computer commands here!
     if (messageTemp == "hab1") {
       hab1();
@@ -350,11 +428,7 @@ void hab1() {
   unsigned long prematureLatency = 0;
 
   rewardLatency = magOp(true);
-  sprintf(outgoingMsg, "0 0 0 0 0 0 0 0 %d 0 0", rewardLatency);
-  if (!client.connected()) {
-    reconnect();
-  }
-  client.publish(topicPub, outgoingMsg);
+  publishTrial(0, 0, 0, 0, 0, 0, 0, 0, rewardLatency, 0, 0);
   interTrialPeriod(4000);
 }
 
@@ -402,11 +476,8 @@ void hab2() {
       break;
     }
   }
-  sprintf(outgoingMsg, "%d 0 0 %d 0 0 %d 0 %d 0 0", positive, omission, correctLatency, rewardLatency);
-  if (!client.connected()) {
-    reconnect();
-  }
-  client.publish(topicPub, outgoingMsg);
+  publishTrial(positive, 0, 0, omission, 0, 0, correctLatency, 0, rewardLatency,
+    0, 0);
   interTrialPeriod(4000);
 }
 
@@ -477,11 +548,8 @@ void fiveChoice(unsigned long stimulusDuration,
     }
     delay(10);
   }
-  sprintf(outgoingMsg, "%d %d 0 %d 0 0 %d %d %d 0 %d", positive, negative, omission, correctLatency, incorrectLatency, rewardLatency, interTrialDuration);
-  if (!client.connected()) {
-    reconnect();
-  }
-  client.publish(topicPub, outgoingMsg);
+  publishTrial(positive, negative, 0, omission, 0, 0, correctLatency,
+    incorrectLatency, rewardLatency, 0, interTrialDuration);
   interTrialPeriod(interTrialDuration);
 }
 
@@ -534,11 +602,8 @@ void inhibitionTrial(unsigned long duration) {
     }
     delay(10);
   }
-  sprintf(outgoingMsg, "0 0 0 0 %d %d 0 0 %d %d 0", positiveWithhold, negativeWithhold, prematureLatency, rewardLatency);
-  if (!client.connected()) {
-    reconnect();
-  }
-  client.publish(topicPub, outgoingMsg);
+  publishTrial(0, 0, 0, 0, positiveWithhold, negativeWithhold, 0, 0,
+    prematureLatency, rewardLatency, 0);
   interTrialPeriod(4000);
 }
 
@@ -587,7 +652,7 @@ void setup() {
     Serial.println(WiFi.localIP());
 
   // MQTT initialization
-  client.setServer(mqttServer, 1883);
+  client.setServer(mqttServers[mqttServerIndex], 1883);
   client.setCallback(callback);
 
   // GPIO initialization